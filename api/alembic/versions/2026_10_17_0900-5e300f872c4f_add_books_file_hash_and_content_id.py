@@ -0,0 +1,36 @@
+"""Add books.file_hash and books.content_id
+
+Revision ID: 5e300f872c4f
+Revises: 794f259a88ed
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5e300f872c4f'
+down_revision: Union[str, Sequence[str], None] = '794f259a88ed'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('books', sa.Column('file_hash', sa.String(), nullable=True))
+    op.add_column('books', sa.Column('content_id', sa.Uuid(), nullable=True))
+    op.execute("update books set content_id = id where content_id is null")
+    op.alter_column('books', 'content_id', nullable=False)
+
+    op.create_index('idx_books_file_hash', 'books', ['file_hash'])
+    op.create_index('idx_books_content_id', 'books', ['content_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_books_content_id', table_name='books')
+    op.drop_index('idx_books_file_hash', table_name='books')
+    op.drop_column('books', 'content_id')
+    op.drop_column('books', 'file_hash')
@@ -0,0 +1,35 @@
+"""Reference fragment range in narration_queue instead of a copy of the fragments
+
+Revision ID: a3c1f07d9b42
+Revises: 5e300f872c4f
+Create Date: 2026-10-17 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c1f07d9b42'
+down_revision: Union[str, Sequence[str], None] = '5e300f872c4f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('narration_queue', sa.Column('last_fragment_id', sa.Integer(), nullable=True))
+    # IDs are stored as 'n-00042' in the last fragment of the last group.
+    op.execute("update narration_queue set last_fragment_id = substring(fragments -> -1 -> -1 ->> 'id' from 3)::int")
+    op.alter_column('narration_queue', 'last_fragment_id', nullable=False)
+    op.drop_column('narration_queue', 'fragments')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # The fragments can't be restored from the range, pending items have to be re-enqueued.
+    op.add_column('narration_queue', sa.Column('fragments', JSONB, nullable=False, server_default='[]'))
+    op.alter_column('narration_queue', 'fragments', server_default=None)
+    op.drop_column('narration_queue', 'last_fragment_id')
@@ -0,0 +1,29 @@
+"""Add narration_queue.timeline
+
+Revision ID: c7e2b5d14f80
+Revises: a3c1f07d9b42
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2b5d14f80'
+down_revision: Union[str, Sequence[str], None] = 'a3c1f07d9b42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Timelines of tracks narrated before are loaded from their track manifests on the next playlist update.
+    op.add_column('narration_queue', sa.Column('timeline', JSONB, nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('narration_queue', 'timeline')
@@ -0,0 +1,34 @@
+"""Add narration_queue leases and attempts
+
+Revision ID: e41d9a6b3c25
+Revises: c7e2b5d14f80
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41d9a6b3c25'
+down_revision: Union[str, Sequence[str], None] = 'c7e2b5d14f80'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('narration_queue', sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('narration_queue', sa.Column('lease_expires', sa.DateTime(), nullable=True))
+    op.add_column('narration_queue', sa.Column('failed', sa.DateTime(), nullable=True))
+    # Tracks sent before are given one attempt, with the lease starting now.
+    op.execute("update narration_queue set attempts = 1, lease_expires = now() + interval '1 hour' "
+               "where sent is not null and completed is null")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('narration_queue', 'failed')
+    op.drop_column('narration_queue', 'lease_expires')
+    op.drop_column('narration_queue', 'attempts')
@@ -0,0 +1,30 @@
+"""Add narration_queue.text_length and narration_queue.worker
+
+Revision ID: 0b5f8e2a7d61
+Revises: e41d9a6b3c25
+Create Date: 2026-10-17 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '0b5f8e2a7d61'
+down_revision: Union[str, Sequence[str], None] = 'e41d9a6b3c25'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Unknown for the tracks enqueued before, estimates assume they are of average length.
+    op.add_column('narration_queue', sa.Column('text_length', sa.Integer(), nullable=True))
+    op.add_column('narration_queue', sa.Column('worker', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('narration_queue', 'worker')
+    op.drop_column('narration_queue', 'text_length')
@@ -0,0 +1,31 @@
+"""Add books.ingestion_attempts, books.ingestion_started and books.ingestion_error
+
+Revision ID: 6d2a9c4e1f37
+Revises: 0b5f8e2a7d61
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '6d2a9c4e1f37'
+down_revision: Union[str, Sequence[str], None] = '0b5f8e2a7d61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('books', sa.Column('ingestion_attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('books', sa.Column('ingestion_started', sa.DateTime(), nullable=True))
+    op.add_column('books', sa.Column('ingestion_error', sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('books', 'ingestion_error')
+    op.drop_column('books', 'ingestion_started')
+    op.drop_column('books', 'ingestion_attempts')
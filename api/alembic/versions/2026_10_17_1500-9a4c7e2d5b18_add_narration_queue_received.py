@@ -0,0 +1,29 @@
+"""Add narration_queue.received and narration_queue.processing_s
+
+Revision ID: 9a4c7e2d5b18
+Revises: 6d2a9c4e1f37
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4c7e2d5b18'
+down_revision: Union[str, Sequence[str], None] = '6d2a9c4e1f37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('narration_queue', sa.Column('received', sa.DateTime(), nullable=True))
+    op.add_column('narration_queue', sa.Column('processing_s', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('narration_queue', 'processing_s')
+    op.drop_column('narration_queue', 'received')
@@ -1,16 +1,17 @@
 import logging
 import uuid
-from io import BytesIO
 from typing import List
 
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Response, Depends, UploadFile
+from fastapi import APIRouter, HTTPException, Response, Depends, UploadFile
 from sqlalchemy.exc import NoResultFound
 
 from api.models import db, api
 from api.models.auth import UserDep
 from api.services.books import BookServiceDep
 from api.services.files import FilesServiceDep
+from api.services.narration_queue import NarrationQueueServiceDep
 from api.services.progress import PlaybackProgressServiceDep
+from api.utils.upload import MAX_UPLOAD_SIZE_BYTES, UploadTooLarge
 
 LOG = logging.getLogger(__name__)
 
@@ -20,12 +21,14 @@ books_router = APIRouter(tags=["Books API"])
 @books_router.post("/")
 def create_book(file: UploadFile,
                 user: UserDep,
-                book_service: BookServiceDep,
-                background_tasks: BackgroundTasks) -> api.BookOverview:
-    if file.size > 15 * 1024 * 1024:
+                book_service: BookServiceDep) -> api.BookOverview:
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE_BYTES:
         raise HTTPException(status_code=413, detail="File too large")
 
-    return book_service.create_book(user.id, file.filename, BytesIO(file.file.read()), background_tasks)
+    try:
+        return book_service.create_book(user.id, file.filename, file.file)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large")
 
 
 @books_router.post("/{book_id}/narrate")
@@ -42,6 +45,20 @@ def narrate_book(book_id: uuid.UUID,
     book_service.narrate_book(book_id, request)
 
 
+@books_router.get("/{book_id}/narration-eta")
+def get_narration_eta(book_id: uuid.UUID,
+                      user: UserDep,
+                      book_service: BookServiceDep,
+                      narration_queue_service: NarrationQueueServiceDep) -> api.NarrationEta:
+    is_owner = book_service.is_owner(user.id, book_id)
+    if is_owner is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    if not is_owner and not user.has_any_role(["admin"]):
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+
+    return narration_queue_service.get_eta(book_id)
+
+
 @books_router.get("/")
 def list_books(
         user: UserDep,
@@ -5,6 +5,7 @@ from typing import Annotated
 from fastapi import APIRouter, Request, HTTPException, Response
 from fastapi.params import Header
 
+from api.services.books import BookServiceDep
 from api.services.files import FilesServiceDep, NotModified
 
 files_router = APIRouter(tags=["Files API"])
@@ -19,6 +20,7 @@ LOG = logging.getLogger(__name__)
 @files_router.get("/{key:path}")
 def get_file(key: str,
     file_service: FilesServiceDep,
+    book_service: BookServiceDep,
     request: Request,
     if_none_match: Annotated[str | None, Header()] = ""):
 
@@ -37,6 +39,8 @@ def get_file(key: str,
 
     if range_request:
         LOG.info("Processing range: %s", range_request)
+    # Books uploaded from the same file share the files derived from it.
+    key = book_service.resolve_file_key(key)
     file_data = file_service.get_object(key, if_none_match, range_request)
 
     if file_data is None:
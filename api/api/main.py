@@ -53,14 +53,16 @@ async def lifespan(app: FastAPI):
     epub_svc = EpubService()
     rmq_client = RMQClient(Topology.default_exchange)
     openlibrary_svc = OpenlibraryService(files_svc, db_factory=openlibrary_db)
-    books_svc = BookService(files_svc, progress_svc, epub_svc, db_factory=narrator_db)
+    books_svc = BookService(files_svc, progress_svc, epub_svc, rmq_client, settings_svc, db_factory=narrator_db)
     procurement_svc = ProcurementService(db_factory=narrator_db)
-    narration_queue_svc = NarrationQueueService(rmq_client, settings_svc, files_svc, db_factory=narrator_db)
+    narration_queue_svc = NarrationQueueService(rmq_client, settings_svc, files_svc, books_svc.manifest_cache,
+                                                books_svc.track_manifest_cache, db_factory=narrator_db)
 
     # Start background processing tasks.
     start_narration_task = asyncio.create_task(books_svc.start_narration_maybe())
     speech_gen_task = asyncio.create_task(narration_queue_svc.generate_speech_maybe())
     complete_narration_task = asyncio.create_task(books_svc.complete_narration_maybe())
+    retry_ingestion_task = asyncio.create_task(books_svc.retry_ingestion_maybe())
 
     def configure(channel: BlockingChannel):
         channel.exchange_declare(Topology.default_exchange, ExchangeType.topic, durable=True)
@@ -68,16 +70,25 @@ async def lifespan(app: FastAPI):
         channel.queue_bind(Topology.api_queue, Topology.default_exchange, "phonemes")
         channel.queue_bind(Topology.api_queue, Topology.default_exchange, "speech")
         channel.queue_bind(Topology.api_queue, Topology.default_exchange, "narrate-response")
+        channel.queue_declare(Topology.ingestion_queue, durable=True, arguments={"x-queue-type": "quorum"})
+        channel.queue_bind(Topology.ingestion_queue, Topology.default_exchange, "ingest")
 
     rmq_client.configure(configure)
 
     rmq_client.set_queue_message_handler(Topology.api_queue, rmq.NarrateResponse, narration_queue_svc.handle_response_msg)
+    # Ingestion is handled by its own threads, so a large book doesn't hold back the narration responses.
+    # Set to 0 to leave the ingestion to other instances.
+    ingestion_concurrency = int(os.getenv("INGESTION_CONCURRENCY", 1))
+    if ingestion_concurrency > 0:
+        rmq_client.set_queue_concurrency(Topology.ingestion_queue, ingestion_concurrency)
+        rmq_client.set_queue_message_handler(Topology.ingestion_queue, rmq.IngestRequest, books_svc.handle_ingest_msg)
 
     rmq_client.start_consuming()
     yield
     start_narration_task.cancel()
     speech_gen_task.cancel()
     complete_narration_task.cancel()
+    retry_ingestion_task.cancel()
     RMQClient.instance.close()
 
 
@@ -3,6 +3,7 @@ import uuid
 from fastapi import APIRouter, Request
 from sqlalchemy.exc import NoResultFound
 
+from api.models import api
 from api.models.auth import AdminUser
 from api.services.books import BookServiceDep
 from api.services.files import FilesServiceDep
@@ -50,6 +51,20 @@ def resend_narration_requests(
     narration_queue_service.resend(queue_ids)
 
 
+@maintenance_router.get("/narration-metrics")
+def get_narration_metrics(
+        user: AdminUser,
+        narration_queue_service: NarrationQueueServiceDep,
+        window_min: int = 60
+) -> api.NarrationMetrics:
+    return narration_queue_service.get_metrics(window_min)
+
+
+@maintenance_router.get("/manifest-cache")
+def get_manifest_cache_stats(user: AdminUser, book_service: BookServiceDep) -> dict:
+    return book_service.manifest_cache.stats()
+
+
 @maintenance_router.get("/debug-headers")
 async def debug_headers(request: Request, admin: AdminUser):
     return {
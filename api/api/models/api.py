@@ -1,4 +1,5 @@
 import uuid
+from datetime import datetime
 from typing import Optional, Generic, List, TypeVar
 
 from fastapi import Query
@@ -73,7 +74,7 @@ class BookDetails(BookMetadata):
     def from_orm(cls, book: db.Book):
         return BookDetails(id=book.id,
                            owner_id=book.owner_id,
-                           book_file_key=f"{book.id}/epub-files/fragmented.epub",
+                           book_file_key=f"{book.content_id}/epub-files/fragmented.epub",
                            status=book.status,
                            cover=book.cover,
                            title=book.title,
@@ -96,3 +97,37 @@ class TableOfContentsItem(BaseModel):
     href: str
     title: Optional[str] = None
     narrate: bool = True
+
+
+class NarrationThroughput(BaseModel):
+    worker: Optional[str]
+    tts_model: str
+    voice: str
+    tracks: int
+    tracks_per_min: float
+    # Processing time per second of the audio, below 1 is faster than real time.
+    real_time_factor: Optional[float]
+    # Time from sending the track until a worker started narrating it, i.e. the round trip measured by the API minus the
+    # time the worker spent on the track.
+    avg_queue_wait_s: Optional[float]
+    avg_processing_s: Optional[float]
+    chars_per_sec: Optional[float]
+
+
+class NarrationMetrics(BaseModel):
+    window_min: int
+    throughput: List[NarrationThroughput]
+    pending_tracks: int
+    in_flight_tracks: int
+    failed_tracks: int
+    consumers: int
+
+
+class NarrationEta(BaseModel):
+    book_id: uuid.UUID
+    status: str
+    remaining_tracks: int
+    remaining_chars: int
+    remaining_audio_duration_s: Optional[float] = None
+    eta_s: Optional[float] = None
+    estimated_completion: Optional[datetime] = None
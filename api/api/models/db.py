@@ -10,7 +10,7 @@ from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 from api.models import domain
 from api.utils.db import PydanticType, PydanticList
-from common_lib.models.tts import FragmentGroups
+from common_lib.models.tts import FragmentDuration
 
 
 class Base(DeclarativeBase):
@@ -23,6 +23,9 @@ class Base(DeclarativeBase):
 
 
 class BookStatus(StrEnum):
+    # Initial processing of the uploaded book failed, see Book.ingestion_error.
+    failed = "failed"
+
     # Just uploaded book is going through initial processing.
     processing = "processing"
 
@@ -95,6 +98,18 @@ class Book(Base):
 
     narration_request: Mapped[List[TocItem]] = mapped_column(type_=PydanticList(TocItem), default=[])
 
+    # blake3 hash of the uploaded file.
+    file_hash: Mapped[Optional[str]]
+    # ID of the book whose files derived from the content (fragmented EPUB, narration manifest, audio, playlists)
+    # are used by this book. Books uploaded from the same file share them, otherwise it's the ID of the book itself.
+    content_id: Mapped[uuid.UUID]
+
+    # Number of times the ingestion was started and when it was started last, to retry the stuck ones.
+    ingestion_attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+    ingestion_started: Mapped[Optional[datetime.datetime]]
+    # Error of the last failed ingestion.
+    ingestion_error: Mapped[Optional[str]]
+
     # TODO: Add errors field. JSONB array of dictionaries. Any processing / validation errors encountered
     #  should be stored there and displayed in UI.
 
@@ -130,15 +145,32 @@ class NarrationQueue(Base):
     track_base_name: Mapped[str]
     # ID of the first fragment in the track.
     order: Mapped[int]
-    fragments: Mapped[FragmentGroups] = mapped_column(type_=PydanticType(FragmentGroups), nullable=False)
+    # ID of the last fragment in the track. The fragments themselves are read from the narration manifest.
+    last_fragment_id: Mapped[int]
+    # Number of characters of the text in the track.
+    text_length: Mapped[Optional[int]]
     # When track was added to the queue.
     added: Mapped[datetime.datetime]
 
     # When track was sent for narration.
     sent: Mapped[Optional[datetime.datetime]]
+    # How many times the track was sent for narration.
+    attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+    # The track is sent again if it's not narrated by then.
+    lease_expires: Mapped[Optional[datetime.datetime]]
+    # When the track was given up on after MAX_ATTEMPTS.
+    failed: Mapped[Optional[datetime.datetime]]
     # How long it took to narrate this track.
     narration_time_s: Mapped[Optional[float]]
+    # Worker that narrated the track.
+    worker: Mapped[Optional[str]]
     completed: Mapped[Optional[datetime.datetime]]
+    # When the response was received, by the clock of the API like sent.
+    received: Mapped[Optional[datetime.datetime]]
+    # Time the worker spent on the track, from getting the request until responding.
+    processing_s: Mapped[Optional[float]]
 
     duration_s: Mapped[Optional[float]]
     size_bytes: Mapped[Optional[int]]
+    # Durations of the narrated fragments, used to render the playlist.
+    timeline: Mapped[Optional[List[FragmentDuration]]] = mapped_column(type_=PydanticList(FragmentDuration))
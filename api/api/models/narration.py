@@ -66,7 +66,7 @@ class AudioTrack(BaseModel):
                 LOG.debug("Actual number of tracks: %d", len(result))
                 LOG.debug("Expected track length around: %d", avg_len)
                 LOG.debug("Actual track lengths: %s",
-                          [sum([g.length() for g in t.fragment_groups]) for t in result])
+                          [sum([g.length() for g in t.fragment_groups.root]) for t in result])
 
             return result
 
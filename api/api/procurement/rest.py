@@ -1,10 +1,10 @@
-from io import BytesIO
 from zipfile import BadZipFile
 
 from fastapi import APIRouter, UploadFile, BackgroundTasks, HTTPException
 
 from api.models.auth import UserDep
 from api.procurement import ProcurementServiceDep
+from api.utils.upload import MAX_UPLOAD_SIZE_BYTES, UploadTooLarge, spool_upload
 
 procurement_router = APIRouter(prefix="/procurement", tags=["Procurement API"])
 
@@ -14,10 +14,16 @@ def upload(file: UploadFile,
            user: UserDep,
            procurement_service: ProcurementServiceDep,
            background_tasks: BackgroundTasks):
-    if file.size > 15 * 1024 * 1024:
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE_BYTES:
         raise HTTPException(status_code=413, detail="File too large")
 
     try:
-        procurement_service.upload(file.filename, BytesIO(file.file.read()))
-    except BadZipFile:
-        raise HTTPException(status_code=400, detail="Invalid zip file")
+        upload = spool_upload(file.file)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    with upload.file:
+        try:
+            procurement_service.upload(file.filename, upload)
+        except BadZipFile:
+            raise HTTPException(status_code=400, detail="Invalid zip file")
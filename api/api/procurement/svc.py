@@ -1,12 +1,11 @@
 import logging
-from io import BytesIO
 from typing import Annotated, Optional, Tuple, List, Dict
 
-from blake3 import blake3
 from sqlalchemy import select, text
 
 from api.procurement.domain import IdMatch, ImageMatch, ContentMatch
 from api.procurement.models import EpubFile, MetadataId, ImagePhash, ContentSignature
+from api.utils.upload import SpooledUpload
 from common_lib.db import transactional
 from common_lib.service import Service
 from epub_lib import Epub
@@ -20,10 +19,8 @@ class ProcurementService(Service):
         pass
 
     @transactional
-    def upload(self, filename: str, body: BytesIO):
-        hasher = blake3()
-        hasher.update(body.getbuffer())
-        file_hash = hasher.hexdigest()
+    def upload(self, filename: str, upload: SpooledUpload):
+        file_hash = upload.file_hash
 
         epub_file_maybe = self._find_file_by_hash(file_hash)
         if epub_file_maybe is not None:
@@ -31,7 +28,7 @@ class ProcurementService(Service):
             return
 
         # Extract metadata
-        epub = Epub(body, filename=filename)
+        epub = Epub(upload.file, filename=filename)
         metadata: dict = epub.package.metadata.model_dump(exclude_none=True)
 
         id_matches, ids_to_store = self._match_identifiers(epub)
@@ -47,7 +44,7 @@ class ProcurementService(Service):
 
         epub_file = EpubFile(file_name=filename,
                              file_hash=file_hash,
-                             file_size_bytes=len(body.getbuffer()),
+                             file_size_bytes=upload.size_bytes,
                              raw_metadata=metadata,
                              id_matches=id_matches,
                              cover_matches=image_matches,
@@ -1,31 +1,72 @@
 import json
+import shutil
+import threading
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor
 
 import asyncio
 import logging
 import m3u8
 import uuid
-from datetime import datetime, UTC
+from datetime import datetime, UTC, timedelta
 from fastapi import BackgroundTasks
 from io import BytesIO
-from sqlalchemy import update, text, select
+from sqlalchemy import update, text, select, delete, or_, and_
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.sql.functions import count
-from typing import Annotated, List
+from typing import Annotated, List, Optional, IO
 
 from api.models import api, db, domain
 from api.models.db import NarrationQueue
-from api.models.narration import NarrationManifest
 from api.services.epub import EpubServiceDep
 from api.services.files import FilesServiceDep
+from api.services.manifest_cache import ManifestCache, TrackManifestCache, MANIFEST_KEY, JSON_MANIFEST_KEY
 from api.services.progress import PlaybackProgressServiceDep
+from api.services.settings import SettingsServiceDep
+from api.utils.compact_manifest import CompactManifest
+from api.utils.covers import generate_cover_derivatives, cover_derivative_key, cover_derivative_url
 from api.utils.imgproxy import ImgProxy
+from api.utils.scheduling import START_NARRATION, DISPATCH_SPEECH, COMPLETE_NARRATION
+from api.utils.upload import spool_upload, CHUNK_SIZE_BYTES
+from common_lib import RMQClientDep
 from common_lib.db import transactional
+from common_lib.models import rmq
 from common_lib.service import Service
-from epub_lib import Epub
+from epub_lib import Epub, EpubRewriter
 
 LOG = logging.getLogger(__name__)
 
-executor = ProcessPoolExecutor(max_workers=4)
+INGESTION_WORKERS = 4
+executor = ProcessPoolExecutor(max_workers=INGESTION_WORKERS)
+
+# Maximum number of book IDs mapped to their content IDs kept in memory.
+CONTENT_ID_CACHE_SIZE = 4096
+
+# Statuses of the books whose ingestion is done, so their content files can be shared by the duplicates.
+INGESTED_STATUSES = [
+    db.BookStatus.ready_for_metadata_review,
+    db.BookStatus.ready_for_content_review,
+    db.BookStatus.ready_for_toc_review,
+    db.BookStatus.queued,
+    db.BookStatus.narrating,
+    db.BookStatus.ready,
+]
+
+# Files of a book that are never shared with other books uploaded from the same file.
+PER_BOOK_FILE_PREFIXES = ("images/",)
+
+# Ingestion is retried this many times before the book is marked as failed.
+MAX_INGESTION_ATTEMPTS = 3
+# Books still processing after this long since the ingestion was requested are requested again, in case the request
+# was lost or the worker died.
+INGESTION_TIMEOUT_SEC = 3600
+# Books never picked up by the ingestion this long after the upload are requested again, in case publishing failed.
+INGESTION_PUBLISH_GRACE_SEC = 300
+INGESTION_SWEEP_INTERVAL_SEC = 300
+
+# The narration loops are woken up by events, the periodic run is only a safety net for missed ones.
+# TODO: Move the interval into system configuration.
+NARRATION_SWEEP_INTERVAL_SEC = 60
 
 
 # noinspection PyTypeChecker
@@ -34,19 +75,58 @@ class BookService(Service):
                  files_service: FilesServiceDep,
                  playback_progress_service: PlaybackProgressServiceDep,
                  epub_service: EpubServiceDep,
+                 rmq_client: RMQClientDep,
+                 settings_service: SettingsServiceDep,
                  **kwargs):
         self.files_service = files_service
         self.playback_progress_service = playback_progress_service
         self.epub_service = epub_service
+        self.rmq_client = rmq_client
+        self.settings_service = settings_service
 
         self.img_proxy = ImgProxy()
+        self.manifest_cache = ManifestCache(files_service)
+        self.track_manifest_cache = TrackManifestCache()
+        # Content IDs by book ID, in the order of use. The content ID of a book never changes.
+        self._content_ids: OrderedDict[uuid.UUID, uuid.UUID] = OrderedDict()
+        self._content_ids_lock = threading.Lock()
+
+    def create_book(self, user_id: uuid.UUID, file_name: str, stream: IO[bytes]) -> api.BookOverview:
+        """Stores the uploaded book and schedules its ingestion. Heavy processing is done by the ingestion worker.
+
+        The source file is spooled and hashed first, and uploaded to the object store only if the same file isn't
+        ingested yet. A duplicate shares the files of the book ingested from it instead.
+        """
+        book_id = uuid.uuid4()
+        upload = spool_upload(stream)
+        LOG.debug("Received %s bytes of book %s, hash: %s", upload.size_bytes, book_id, upload.file_hash)
 
-    @transactional
-    def create_book(self, user_id: uuid.UUID, file_name: str, file_bytes: BytesIO,
-                    background_tasks: BackgroundTasks):
+        with upload.file:
+            book_overview = self._insert_book(book_id, user_id, file_name, upload.file, upload.file_hash)
+            if book_overview.status != db.BookStatus.processing:
+                return book_overview
+
+            try:
+                upload.file.seek(0)
+                with self.files_service.multipart_upload(f"{book_id}/epub-files/source.epub") as source_upload:
+                    shutil.copyfileobj(upload.file, source_upload, CHUNK_SIZE_BYTES)
+            except:
+                self._delete_book_record(book_id)
+                raise
+
+        # Publish only after the transaction is committed, so the worker is guaranteed to see the book.
+        try:
+            self.rmq_client.publish("ingest", rmq.IngestRequest(book_id=book_overview.id))
+        except Exception:
+            LOG.warning("Failed to request ingestion of book %s, it will be requested again later.", book_overview.id,
+                        exc_info=True)
+        return book_overview
 
+    @transactional
+    def _insert_book(self, book_id: uuid.UUID, user_id: uuid.UUID, file_name: str,
+                     file: IO[bytes], file_hash: str) -> api.BookOverview:
         # Extract metadata
-        epub = Epub(file_bytes, filename=file_name)
+        epub = Epub(file, filename=file_name)
         titles = epub.package.metadata.get_title()
         authors = epub.package.metadata.get_authors()
         descriptions = epub.package.metadata.get_descriptions()
@@ -56,55 +136,187 @@ class BookService(Service):
 
         # TODO: process identifiers.
 
-        book_id = uuid.uuid4()
+        book = db.Book(id=book_id,
+                       owner_id=user_id,
+                       file_name=file_name,
+                       created_time=datetime.now(UTC),
+                       status=db.BookStatus.processing,
+                       title=titles[0],
+                       authors=authors,
+                       description=descriptions[0] if len(descriptions) > 0 else None,
+                       file_hash=file_hash,
+                       content_id=book_id
+                       )
+
+        content_book = self._find_ingested_book(file_hash)
+        if content_book is not None:
+            LOG.info("Book %s is uploaded from the same file as %s, sharing its content.", book_id, content_book.id)
+            book.content_id = content_book.content_id
+            book.status = db.BookStatus.ready_for_toc_review
+            # Metadata is kept per book, but the cover derived from the content can be reused.
+            if self.files_service.exists(cover_derivative_key(book.content_id, "cover")):
+                book.cover = cover_derivative_url(book.content_id, "cover")
+
+        self.db.add(book)
+
+        return api.BookOverview.from_orm(book)
+
+    @transactional
+    def _delete_book_record(self, book_id: uuid.UUID):
+        self.db.execute(delete(db.Book).where(db.Book.id == book_id))
+
+    def handle_ingest_msg(self, payload: rmq.IngestRequest):
+        LOG.info("Got ingestion request for book %s.", payload.book_id)
+        try:
+            book = self.get_book_overview(payload.book_id)
+        except NoResultFound:
+            LOG.warning("Book %s not found, it must have been deleted. Skipping ingestion.", payload.book_id)
+            return
+
+        if book.status != db.BookStatus.processing:
+            LOG.info("Book %s is already ingested (status: %s). Skipping ingestion.", book.id, book.status)
+            return
+
+        attempt = self._start_ingestion(book.id)
+        if attempt is None:
+            LOG.warning("Book %s not found, it must have been deleted. Skipping ingestion.", payload.book_id)
+            return
+
+        try:
+            cover_thumbnail_path = self._ingest_book(book.id, book.pdf_file_name)
+        except Exception as e:
+            if attempt < MAX_INGESTION_ATTEMPTS:
+                LOG.warning("Failed to ingest book %s (attempt %s of %s), it will be retried.", book.id, attempt,
+                            MAX_INGESTION_ATTEMPTS, exc_info=True)
+                # The message is rejected and delivered again.
+                raise
+            LOG.error("Failed to ingest book %s after %s attempts.", book.id, attempt, exc_info=True)
+            self._fail_ingestion(book.id, str(e) or type(e).__name__)
+            return
+
+        self._complete_ingestion(book.id, cover_thumbnail_path)
+        LOG.info("Ingestion of book %s completed.", book.id)
+
+    @transactional
+    def _start_ingestion(self, book_id: uuid.UUID) -> Optional[int]:
+        """Records the start of an ingestion attempt. Returns the number of the attempt."""
+        # noinspection PyTypeChecker
+        return self.db.execute(update(db.Book)
+                               .where(db.Book.id == book_id)
+                               .values(ingestion_attempts=db.Book.ingestion_attempts + 1,
+                                       ingestion_started=datetime.now(UTC))
+                               .returning(db.Book.ingestion_attempts)).scalar_one_or_none()
+
+    @transactional
+    def _fail_ingestion(self, book_id: uuid.UUID, error: str):
+        self.db.execute(update(db.Book)
+                        .where(db.Book.id == book_id)
+                        .where(db.Book.status == db.BookStatus.processing)
+                        .values(status=db.BookStatus.failed, ingestion_error=error))
+
+    async def retry_ingestion_maybe(self):
+        while True:
+            try:
+                for book_id in self._find_stuck_ingestions():
+                    self.rmq_client.publish("ingest", rmq.IngestRequest(book_id=book_id))
+            except:
+                LOG.info("Error while retrying stuck ingestions, will try again later.", exc_info=True)
+            await asyncio.sleep(INGESTION_SWEEP_INTERVAL_SEC)
+
+    @transactional
+    def _find_stuck_ingestions(self) -> List[uuid.UUID]:
+        """Returns books whose ingestion should be requested again. Books out of attempts are marked as failed."""
+        now = datetime.now(UTC)
+        stuck = (
+            update(db.Book)
+            .where(db.Book.status == db.BookStatus.processing)
+            .where(or_(and_(db.Book.ingestion_started.is_(None),
+                            db.Book.created_time < now - timedelta(seconds=INGESTION_PUBLISH_GRACE_SEC)),
+                       db.Book.ingestion_started < now - timedelta(seconds=INGESTION_TIMEOUT_SEC)))
+        )
+        # noinspection PyTypeChecker
+        failed_ids = self.db.scalars(stuck.where(db.Book.ingestion_attempts >= MAX_INGESTION_ATTEMPTS)
+                                     .values(status=db.BookStatus.failed,
+                                             ingestion_error="Ingestion did not complete.")
+                                     .returning(db.Book.id)).all()
+        if failed_ids:
+            LOG.error("Ingestion of books %s did not complete after %s attempts.", failed_ids, MAX_INGESTION_ATTEMPTS)
+
+        # The start is reset, so the request is not repeated until it times out again.
+        # noinspection PyTypeChecker
+        retry_ids = self.db.scalars(stuck.values(ingestion_started=now).returning(db.Book.id)).all()
+        if retry_ids:
+            LOG.warning("Ingestion of books %s is stuck, requesting it again.", retry_ids)
+        return retry_ids
+
+    def _find_ingested_book(self, file_hash: str) -> Optional[db.Book]:
+        """Returns the oldest book uploaded from the file with the given hash, that's done with the ingestion."""
+        stmt = (
+            select(db.Book)
+            .where(db.Book.file_hash == file_hash)
+            .where(db.Book.status.in_(INGESTED_STATUSES))
+            .order_by(db.Book.created_time)
+            .limit(1)
+        )
+        return self.db.scalars(stmt).first()
+
+    def _ingest_book(self, book_id: uuid.UUID, file_name: str) -> Optional[str]:
+        """Processes the source EPUB file and uploads all derived files. Returns the cover thumbnail path."""
+        file_bytes = self.files_service.get_book_file(book_id, "epub-files/source.epub")
+        epub = Epub(file_bytes, filename=file_name)
+
         cover_image_maybe = epub.get_cover_image()
         cover_thumbnail_path = None
+        cover_derivatives = None
         if cover_image_maybe is not None:
             image_name, mime_type, image_bytes = cover_image_maybe
-            # TODO: compress image right away.
             cover_image_key = f"{book_id}/images/{image_name}"
             self.files_service.upload_file(cover_image_key, image_bytes)
             cover_thumbnail_path = self.img_proxy.build_url(cover_image_key)
+            # Resized in the background while the content is processed.
+            cover_derivatives = executor.submit(generate_cover_derivatives, image_bytes)
 
-        file_bytes.seek(0)
-        self.files_service.upload_file(f"{book_id}/epub-files/source.epub", file_bytes)
-
+        # All the modifications are applied in a single pass over the archive.
+        rewriter = EpubRewriter(epub)
+        self.epub_service.remove_links(rewriter)
         # Fragment map only includes spine-item to fragment-id mapping.
-        file_bytes = self.epub_service.remove_links(file_bytes)
-        file_bytes, fragment_map = self.epub_service.inline_fragments(file_bytes)
+        fragment_map = self.epub_service.inline_fragments(rewriter, executor)
 
         # Narration manifest includes navigation items along with the content fragments.
         publication_content = epub.get_publication_content()
         narration_manifest = self.epub_service.build_narration_manifest(publication_content, fragment_map)
-        narration_manifest_bytes = narration_manifest.model_dump_json().encode()
-        self.files_service.upload_file(f"{book_id}/narration-manifest.json", narration_manifest_bytes)
+        compact_manifest = CompactManifest.from_manifest(narration_manifest)
+        self.files_service.upload_file(f"{book_id}/{MANIFEST_KEY}", compact_manifest.data)
+        # The JSON export is kept for compatibility.
+        self.files_service.upload_file(f"{book_id}/{JSON_MANIFEST_KEY}", narration_manifest.model_dump_json().encode())
+        self.manifest_cache.invalidate(book_id)
 
         # Use narration manifest to build the fragment map. This way, it includes the chapter titles.
-        epub = Epub(file_bytes, filename=file_name)
-        file_bytes = epub.add_manifest_item(
+        rewriter.add_manifest_item(
             id="fragment-map",
             href="fragment-map.json",
             media_type="application/json",
-            body=json.dumps(narration_manifest.to_fragment_map())
+            body=json.dumps(compact_manifest.to_fragment_map())
         )
-        self.files_service.upload_file(f"{book_id}/epub-files/fragmented.epub", file_bytes)
+        self.files_service.upload_file(f"{book_id}/epub-files/fragmented.epub", rewriter.write())
 
-        # TODO: Compress images;
-
-        book = db.Book(id=book_id,
-                       owner_id=user_id,
-                       file_name=file_name,
-                       created_time=datetime.now(UTC),
-                       status=db.BookStatus.ready_for_toc_review,
-                       cover=cover_thumbnail_path,
-                       title=titles[0],
-                       authors=authors,
-                       description=descriptions[0] if len(descriptions) > 0 else None
-                       )
+        if cover_derivatives is not None:
+            try:
+                for name, derivative_bytes in cover_derivatives.result().items():
+                    self.files_service.upload_file(cover_derivative_key(book_id, name), derivative_bytes)
+                cover_thumbnail_path = cover_derivative_url(book_id, "cover")
+            except Exception:
+                LOG.warning("Failed to generate cover derivatives of book %s, falling back to imgproxy.", book_id,
+                            exc_info=True)
 
-        self.db.add(book)
+        return cover_thumbnail_path
 
-        return api.BookOverview.from_orm(book)
+    @transactional
+    def _complete_ingestion(self, book_id: uuid.UUID, cover_thumbnail_path: Optional[str]):
+        self.db.execute(update(db.Book)
+                        .where(db.Book.id == book_id)
+                        .where(db.Book.status == db.BookStatus.processing)
+                        .values(cover=cover_thumbnail_path, status=db.BookStatus.ready_for_toc_review))
 
     def _set_status(self, book_id: uuid.UUID, status: db.BookStatus):
         self.db.execute(update(db.Book).where(db.Book.id == book_id).values(status=status))
@@ -124,14 +336,79 @@ class BookService(Service):
     def get_book_overview(self, book_id: uuid.UUID) -> api.BookOverview:
         return api.BookOverview.from_orm(self.db.get_one(db.Book, book_id))
 
+    def get_content_id(self, book_id: uuid.UUID) -> Optional[uuid.UUID]:
+        """Returns the ID of the book whose content files are used by the given book. It never changes."""
+        with self._content_ids_lock:
+            content_id = self._content_ids.get(book_id)
+            if content_id is not None:
+                self._content_ids.move_to_end(book_id)
+                return content_id
+
+        content_id = self._load_content_id(book_id)
+        if content_id is None:
+            # Not cached, the book might not be created yet.
+            return None
+        with self._content_ids_lock:
+            self._content_ids[book_id] = content_id
+            while len(self._content_ids) > CONTENT_ID_CACHE_SIZE:
+                self._content_ids.popitem(last=False)
+        return content_id
+
+    @transactional
+    def _load_content_id(self, book_id: uuid.UUID) -> Optional[uuid.UUID]:
+        return self.db.execute(select(db.Book.content_id).where(db.Book.id == book_id)).scalar_one_or_none()
+
+    def resolve_file_key(self, key: str) -> str:
+        """Maps the key of a book file to the key it's stored under, which differs for files shared by books."""
+        book_id_str, _, file_name = key.partition("/")
+        try:
+            book_id = uuid.UUID(book_id_str)
+        except ValueError:
+            return key
+
+        if file_name.startswith(PER_BOOK_FILE_PREFIXES):
+            return key
+
+        content_id = self.get_content_id(book_id)
+        if content_id is None or content_id == book_id:
+            return key
+        return f"{content_id}/{file_name}"
+
     @transactional
     def delete_book(self, user_id: uuid.UUID, book_id: uuid.UUID):
         book = self.db.get_one(db.Book, book_id)
 
         self.playback_progress_service.delete(user_id=user_id, book_id=book_id)
-        self.files_service.delete_book_files(book_id=book_id)
+
+        successor_id = self.db.scalars(
+            select(db.Book.id)
+            .where(db.Book.content_id == book.content_id)
+            .where(db.Book.id != book_id)
+            .order_by(db.Book.created_time)
+            .limit(1)
+        ).first()
+        if successor_id is None:
+            # The last book using the content, so the content files go as well.
+            self.db.execute(delete(db.NarrationQueue).where(db.NarrationQueue.book_id == book_id))
+            self.files_service.delete_book_files(book_id=book.content_id)
+            self.manifest_cache.invalidate(book.content_id)
+            self.track_manifest_cache.invalidate(book.content_id)
+            if book.content_id != book_id:
+                self.files_service.delete_book_files(book_id=book_id)
+        else:
+            # Narration of the content is kept for the remaining books, along with the content files.
+            self.db.execute(update(db.NarrationQueue)
+                            .where(db.NarrationQueue.book_id == book_id)
+                            .values(book_id=successor_id))
+            if book.content_id != book_id:
+                self.files_service.delete_book_files(book_id=book_id)
+            else:
+                for prefix in PER_BOOK_FILE_PREFIXES:
+                    self.files_service.delete_files(f"{book_id}/{prefix}")
 
         self.db.delete(book)
+        with self._content_ids_lock:
+            self._content_ids.pop(book_id, None)
 
     @transactional
     def get_stats(self, book_id: uuid.UUID) -> dict:
@@ -267,12 +544,16 @@ class BookService(Service):
                 self._do_start_narration_maybe()
             except:
                 LOG.info("Error while selecting book to narrate, will try again later.", exc_info=True)
-            # TODO: Move the delay duration into system configuration.
-            await asyncio.sleep(15)
+            await START_NARRATION.wait(NARRATION_SWEEP_INTERVAL_SEC)
 
     @transactional
     def _do_start_narration_maybe(self):
-        """If no books are being narrated, pick one from the queue."""
+        """Picks books from the queue until the limit of concurrently narrated books is reached.
+
+        The next book is the oldest queued one of the owner with the fewest books being narrated, so a user with many
+        or long books doesn't block the others.
+        """
+        max_narrating_books = self.settings_service.get_system_settings().max_narrating_books
 
         # Count books with the status
         count_stmt = (
@@ -280,25 +561,34 @@ class BookService(Service):
             .where(db.Book.status == db.BookStatus.narrating)
         )
         count_narrating = self.db.execute(count_stmt).scalar()
-        if count_narrating > 0:
+        if count_narrating >= max_narrating_books:
             LOG.info("%s books already being narrated, not adding more.", count_narrating)
             return
 
-        # Select one book to be narrated.
         query_text = """select b.id
                         from books b
                         where b.status = :status
-                        order by b.created_time
+                        order by (select count(*)
+                                  from books n
+                                  where n.owner_id = b.owner_id
+                                    and n.status = :narrating_status),
+                                 b.created_time
                         limit 1
                      """
-        book_id_maybe = self.db.execute(text(query_text), {"status": db.BookStatus.queued}).one_or_none()
-        if book_id_maybe is None:
-            LOG.info("The queue seem to be empty. Doing nothing.")
-            return
-        else:
+        for _ in range(max_narrating_books - count_narrating):
+            book_id_maybe = self.db.execute(text(query_text), {"status": db.BookStatus.queued,
+                                                               "narrating_status": db.BookStatus.narrating}
+                                            ).one_or_none()
+            if book_id_maybe is None:
+                LOG.info("The queue seem to be empty. Doing nothing.")
+                return
+
             book_id = book_id_maybe[0]
             LOG.info("Starting narration of book %s.", book_id)
             self._set_status(book_id, db.BookStatus.narrating)
+            DISPATCH_SPEECH.fire_after_commit(self.db)
+            # The content might be narrated already for another book uploaded from the same file.
+            COMPLETE_NARRATION.fire_after_commit(self.db)
 
     async def complete_narration_maybe(self):
         await asyncio.sleep(5)
@@ -309,27 +599,34 @@ class BookService(Service):
                 self._do_complete_narration_maybe()
             except:
                 LOG.info("Error while checking if book narration completed, will try again later.", exc_info=True)
-            # TODO: Move the delay duration into system configuration.
-            await asyncio.sleep(15)
+            await COMPLETE_NARRATION.wait(NARRATION_SWEEP_INTERVAL_SEC)
 
     @transactional
     def _do_complete_narration_maybe(self):
         """Update status if narration of a book is complete."""
+        # Narration of the content might be requested by other books uploaded from the same file.
+        # Failed tracks don't block the book, they are left out of the playlist and can be resent by an admin.
         query_text = """select b.id,
-                               (select count(*) from narration_queue q where q.completed is null and q.book_id = b.id) as pending_count
+                               (select count(*)
+                                from narration_queue q
+                                         join books qb on qb.id = q.book_id
+                                where q.completed is null
+                                  and q.failed is null
+                                  and qb.content_id = b.content_id) as pending_count
                         from books b
                         where b.status = 'narrating';
                      """
-        book_narration_stats_maybe = self.db.execute(text(query_text)).one_or_none()
-        if book_narration_stats_maybe is None:
+        book_narration_stats = self.db.execute(text(query_text)).all()
+        if not book_narration_stats:
             LOG.info("No book is being narrated, doing nothing.")
             return
 
-        book_id, pending_count = book_narration_stats_maybe
-        if pending_count == 0:
-            LOG.info("Narration of book %s completed.", book_id)
-            # TODO: Implement some kind of sanity check and clean up narration_queue table.
-            self._set_status(book_id, db.BookStatus.ready)
+        for book_id, pending_count in book_narration_stats:
+            if pending_count == 0:
+                LOG.info("Narration of book %s completed.", book_id)
+                # TODO: Implement some kind of sanity check and clean up narration_queue table.
+                self._set_status(book_id, db.BookStatus.ready)
+                START_NARRATION.fire_after_commit(self.db)
 
     @transactional
     def get_book_details(self, book_id: uuid.UUID) -> api.BookDetails:
@@ -337,19 +634,14 @@ class BookService(Service):
 
     @transactional
     def get_table_of_contents(self, book_id: uuid.UUID) -> List[api.TableOfContentsItem]:
-        manifest_bytes = self.files_service.get_book_file(book_id, "narration-manifest.json")
-        manifest: NarrationManifest = NarrationManifest.model_validate_json(manifest_bytes.getvalue())
+        content_id = self.db.get_one(db.Book, book_id).content_id
+        cached_manifest = self.manifest_cache.get(content_id)
+        if cached_manifest.toc is None:
+            cached_manifest.toc = [api.TableOfContentsItem(href=nav_item.href, title=nav_item.title,
+                                                           narrate=nav_item.narrate)
+                                   for nav_item in cached_manifest.manifest.navigation_items()]
 
-        toc_items = []
-        for content_file in manifest.root:
-            for nav_item in content_file.navigation_items:
-                href = content_file.href if nav_item.idref is None else f"{content_file.href}#{nav_item.idref}"
-                toc_items.append(api.TableOfContentsItem(
-                    href=href,
-                    title=nav_item.title,
-                    narrate=nav_item.narrate))
-
-        return toc_items
+        return list(cached_manifest.toc)
 
     @transactional
     def narrate_book(self, book_id: uuid.UUID, narration_request: List[api.TableOfContentsItem]):
@@ -363,35 +655,49 @@ class BookService(Service):
         self.db.execute(update(db.Book).where(db.Book.id == book_id)
                         .values(narration_request=db_narration_request, status=db.BookStatus.queued))
 
-        manifest_bytes = self.files_service.get_book_file(book_id, "narration-manifest.json")
-        manifest: NarrationManifest = NarrationManifest.model_validate_json(manifest_bytes.getvalue())
+        content_id = self.db.get_one(db.Book, book_id).content_id
+        manifest = self.manifest_cache.get(content_id).manifest
 
         should_narrate_map = {i.href: i.narrate for i in narration_request}
 
+        # Tracks already narrated or queued for any book sharing the content.
+        enqueued_tracks = set(self.db.scalars(
+            select(NarrationQueue.track_base_name)
+            .join(db.Book, db.Book.id == NarrationQueue.book_id)
+            .where(db.Book.content_id == content_id)
+            .where(NarrationQueue.tts_model == tts_model)
+            .where(NarrationQueue.voice == voice)
+        ))
+
         items_to_enqueue = []
-        for content_file in manifest.root:
-            for nav_item in content_file.navigation_items:
-                href = content_file.href if nav_item.idref is None else f"{content_file.href}#{nav_item.idref}"
-                should_narrate_maybe = should_narrate_map.get(href)
-                if should_narrate_maybe is None:
-                    LOG.warning("Unknown content href '%s', default to narrating it.", href)
-
-                if should_narrate_maybe is None or should_narrate_maybe:
-                    for track in nav_item.audio_tracks:
-                        queue_item = NarrationQueue(
-                            book_id=book_id,
-                            tts_model=tts_model,
-                            voice=voice,
-                            track_base_name=track.name,
-                            order=track.fragment_groups.root[0].root[0].id,
-                            fragments=track.fragment_groups,
-                            added=datetime.now(UTC)
-                        )
-                        items_to_enqueue.append(queue_item)
+        for nav_item in manifest.navigation_items():
+            should_narrate_maybe = should_narrate_map.get(nav_item.href)
+            if should_narrate_maybe is None:
+                LOG.warning("Unknown content href '%s', default to narrating it.", nav_item.href)
+
+            if should_narrate_maybe is None or should_narrate_maybe:
+                for track_index in manifest.track_indexes(nav_item.index):
+                    track_name = manifest.track_name(track_index)
+                    if track_name in enqueued_tracks:
+                        continue
+                    # The queue only references the fragments, they are read from the manifest when dispatched.
+                    first_fragment_id, last_fragment_id = manifest.track_id_range(track_index)
+                    queue_item = NarrationQueue(
+                        book_id=book_id,
+                        tts_model=tts_model,
+                        voice=voice,
+                        track_base_name=track_name,
+                        order=first_fragment_id,
+                        last_fragment_id=last_fragment_id,
+                        text_length=manifest.track_text_length(track_index),
+                        added=datetime.now(UTC)
+                    )
+                    items_to_enqueue.append(queue_item)
         self.db.add_all(items_to_enqueue)
+        START_NARRATION.fire_after_commit(self.db)
 
-        master_playlist = self._generate_master_playlist(book_id=book_id, model=tts_model, voice=voice)
-        master_playlist_key = f"{book_id}/playlists/master.m3u8"
+        master_playlist = self._generate_master_playlist(book_id=content_id, model=tts_model, voice=voice)
+        master_playlist_key = f"{content_id}/playlists/master.m3u8"
         self.files_service.upload_file(master_playlist_key, master_playlist.encode())
 
 
@@ -1,17 +1,14 @@
-from zipfile import ZipFile
-
 import logging
-import zipfile
 from bs4 import BeautifulSoup
-from io import BytesIO
-from typing import Annotated, Tuple, Dict, List
+from concurrent.futures import Executor
+from typing import Annotated, Dict, List, Optional
 
 from api.models.narration import NarrationManifest, ContentFile, NavigationItem, AudioTrack
 from api.utils.imgproxy import ImgProxy
-from api.utils.tts import process_xhtml_inplace
+from api.utils.tts import process_xhtml_inplace, renumber_fragments
 from common_lib.models.tts import FragmentGroups
 from common_lib.service import Service
-from epub_lib import Epub
+from epub_lib import EpubRewriter
 from epub_lib.model.nav import PublicationContent
 
 LOG = logging.getLogger(__name__)
@@ -23,40 +20,13 @@ class EpubService(Service):
     def __init__(self, **kwargs):
         self.img_proxy = ImgProxy()
 
-    def remove_links(self, file_bytes: BytesIO) -> BytesIO:
-        src_epub = Epub(file_bytes)
-        files_to_clean = set(src_epub.get_spine_files())
-
-        file_bytes.seek(0)
-        src_zip_file: ZipFile = ZipFile(file_bytes)
-
-        out_bytes = BytesIO()
-        with ZipFile(out_bytes, "w", zipfile.ZIP_DEFLATED) as out_zip:
-            out_zip.writestr("mimetype", src_zip_file.read("mimetype"), compress_type=zipfile.ZIP_STORED)
-
-            for fileinfo in src_zip_file.infolist():
-                if fileinfo.is_dir():
-                    continue
-
-                LOG.debug("Processing %s", fileinfo.filename)
-
-                if fileinfo.filename == "mimetype":
-                    LOG.debug("Skipping %s file...", fileinfo.filename)
-                    continue
-
-                # TODO: make it more robust/configurable. Use regexp.
-                if fileinfo.filename == "oceanofpdf.com":
-                    LOG.debug("Skipping %s file...", fileinfo.filename)
-                    continue
+    def remove_links(self, rewriter: EpubRewriter):
+        """Registers transforms removing ad links from the content files."""
+        for file in rewriter.epub.get_spine_files():
+            rewriter.transform(file, self._clean_file)
 
-                if fileinfo.filename in files_to_clean:
-                    out_zip.writestr(fileinfo.filename, self._clean_file(src_zip_file.read(fileinfo.filename)))
-                else:
-                    out_zip.writestr(fileinfo.filename, src_zip_file.read(fileinfo.filename))
-
-        out_bytes.seek(0)
-        LOG.debug("Compression ratio: %s", len(out_bytes.getvalue()) / len(file_bytes.getvalue()))
-        return out_bytes
+        # TODO: make it more robust/configurable. Use regexp.
+        rewriter.exclude("oceanofpdf.com")
 
     def _clean_file(self, spine_file_bytes: bytes) -> bytes:
         soup = BeautifulSoup(spine_file_bytes, "xml")
@@ -76,43 +46,31 @@ class EpubService(Service):
 
         return soup.encode(formatter="minimal")
 
-    def inline_fragments(self, file_bytes: BytesIO) -> Tuple[BytesIO, Dict[str, FragmentGroups]]:
+    def inline_fragments(self,
+                         rewriter: EpubRewriter,
+                         executor: Optional[Executor] = None) -> Dict[str, FragmentGroups]:
+        """Injects fragment markup into the content files. Returns fragments of each content file.
+
+        Content files are fragmented independently, in parallel if the executor is given. Fragment IDs are then
+        shifted to be globally ascending in the spine order.
+        """
         LOG.debug("Inlining fragments...")
-        src_epub = Epub(file_bytes)
-        content_files = src_epub.get_spine_files()
-
-        file_bytes.seek(0)
-        src_zip_file: ZipFile = ZipFile(file_bytes)
-
-        out_bytes = BytesIO()
-        with ZipFile(out_bytes, "w", zipfile.ZIP_DEFLATED) as out_zip:
-            out_zip.writestr("mimetype", src_zip_file.read("mimetype"), compress_type=zipfile.ZIP_STORED)
-
-            fragment_id = 0
-            fragment_map: Dict[str, FragmentGroups] = {}
-            for file in content_files:
-                content_file_bytes, file_fragments, fragment_id = process_xhtml_inplace(src_zip_file.read(file),
-                                                                                             fragment_id)
-                fragment_map[file] = file_fragments
-                out_zip.writestr(file, content_file_bytes)
-
-            for fileinfo in src_zip_file.infolist():
-                if fileinfo.is_dir():
-                    continue
-                if fileinfo.filename == "mimetype":
-                    # mimetype is added the first without compression.
-                    continue
-
-                if fileinfo.filename in content_files:
-                    # Content files are already processed.
-                    continue
-                else:
-                    LOG.debug("Processing %s", fileinfo.filename)
-                    out_zip.writestr(fileinfo.filename, src_zip_file.read(fileinfo.filename))
-
-        out_bytes.seek(0)
-        LOG.debug("Compression ratio: %s", len(out_bytes.getvalue()) / len(file_bytes.getvalue()))
-        return out_bytes, fragment_map
+        content_files = list(dict.fromkeys(rewriter.epub.get_spine_files()))
+        contents = [rewriter.render(file) for file in content_files]
+
+        map_func = executor.map if executor is not None else map
+        results = map_func(process_xhtml_inplace, contents)
+
+        fragment_id = 0
+        fragment_map: Dict[str, FragmentGroups] = {}
+        for file, (content_file_bytes, file_fragments, file_fragments_count) in zip(content_files, results):
+            content_file_bytes = renumber_fragments(content_file_bytes, file_fragments, fragment_id)
+            fragment_id += file_fragments_count
+
+            fragment_map[file] = file_fragments
+            rewriter.replace(file, content_file_bytes)
+
+        return fragment_map
 
     def build_narration_manifest(
             self, publication_content: PublicationContent, fragment_map: Dict[str, FragmentGroups]) -> NarrationManifest:
@@ -160,7 +118,7 @@ class EpubService(Service):
             else:  # multiple nav items, so need to split fragments based on idrefs from nav items.
                 reversed_nav_items: List[NavigationItem] = []
                 for nav_item in reversed(spine_item.navigation_items):
-                    item_fragments = all_fragments.remove_all_by_visited_id(nav_item.idref)
+                    item_fragments = all_fragments.remove_all_from_anchor(nav_item.idref)
 
                     if len(item_fragments) == 0:
                         LOG.warning("Spine item:\n%s", spine_item)
@@ -202,9 +160,6 @@ class EpubService(Service):
                 for audio_track in nav_item.audio_tracks:
                     for group in audio_track.fragment_groups.root:
                         for frag in group.root:
-                            # Drop all visited_ids from fragments.
-                            frag.visited_ids = []
-
                             if last_seen_id >= frag.id:
                                 LOG.warning("Content file: %s", content_file.href)
                                 LOG.warning("Nav item: %s", nav_item.idref)
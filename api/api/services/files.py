@@ -27,6 +27,68 @@ class NotModified(HTTPException):
         super().__init__(status_code=304)
 
 
+class MultipartUpload:
+    """Uploads an object in parts while the content is being written.
+
+    Content is buffered up to the minimal part size of S3. Objects smaller than that are uploaded with a single PUT.
+    The upload is aborted if the context exits with an error.
+    """
+    MIN_PART_SIZE_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket_name: str, key: str, content_type: str):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.content_type = content_type
+
+        self._buffer = bytearray()
+        self._upload_id: Optional[str] = None
+        self._parts: List[dict] = []
+
+    def __enter__(self) -> "MultipartUpload":
+        return self
+
+    def write(self, data: bytes):
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.MIN_PART_SIZE_BYTES:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name,
+                                                              Key=self.key,
+                                                              ContentType=self.content_type)
+            self._upload_id = response["UploadId"]
+
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(Body=bytes(self._buffer),
+                                              Bucket=self.bucket_name,
+                                              Key=self.key,
+                                              PartNumber=part_number,
+                                              UploadId=self._upload_id)
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer.clear()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            if self._upload_id is not None:
+                LOG.info("Aborting multipart upload of %s.", self.key)
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id)
+            return
+
+        if self._upload_id is None:
+            self.s3_client.put_object(Body=bytes(self._buffer), Bucket=self.bucket_name, Key=self.key,
+                                      ContentType=self.content_type)
+            return
+
+        if self._buffer:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket_name,
+                                                 Key=self.key,
+                                                 UploadId=self._upload_id,
+                                                 MultipartUpload={"Parts": self._parts})
+
+
 class FilesService(Service):
     """A service to manage files stored in an object store."""
 
@@ -41,10 +103,18 @@ class FilesService(Service):
         self.bucket_name = os.getenv("S3_BUCKET", "narrator")
 
     def upload_file(self, key: str, body: BytesIO):
+        self.s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=key, ContentType=self._guess_type(key))
+
+    def multipart_upload(self, key: str) -> MultipartUpload:
+        """Returns a context manager uploading the content written into it."""
+        return MultipartUpload(self.s3_client, self.bucket_name, key, self._guess_type(key))
+
+    @staticmethod
+    def _guess_type(key: str) -> str:
         mime_type, encoding = mimetypes.guess_type(key)
         if mime_type is None:
             raise ValueError(f"Failed to guess mimetype for '{key}'")
-        self.s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=key, ContentType=mime_type)
+        return mime_type
 
     def get_object(self, key: str, if_none_match: Optional[str] = "", range: Optional[str] = "bytes=0-") -> Optional[
         FileData]:
@@ -100,7 +170,10 @@ class FilesService(Service):
             )
 
     def delete_book_files(self, book_id):
-        keys = self.list_files(f"{book_id}/")
+        self.delete_files(f"{book_id}/")
+
+    def delete_files(self, path_prefix: str):
+        keys = self.list_files(path_prefix)
         LOG.info("Deleting %s files \n%s", len(keys), keys)
         if keys:
             self._delete_objects(keys)
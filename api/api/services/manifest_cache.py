@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, List, Dict, Tuple
+
+from api.models import api
+from api.models.narration import NarrationManifest
+from api.services.files import NotModified
+from api.utils.compact_manifest import CompactManifest
+from common_lib.models.tts import TrackManifest
+
+LOG = logging.getLogger(__name__)
+
+MANIFEST_KEY = "narration-manifest.bin"
+# Books ingested before the compact manifest was introduced only have the JSON one.
+JSON_MANIFEST_KEY = "narration-manifest.json"
+
+# Manifests of the narrated tracks by queue ID, along with the time the track was completed.
+TrackManifests = Dict[int, Tuple[datetime, Optional[TrackManifest]]]
+
+
+@dataclass
+class CachedManifest:
+    key: str
+    etag: str
+    manifest: CompactManifest
+    # Size of the manifest document, used to bound the cache.
+    size_bytes: int
+    # Table of contents derived from the manifest, built on the first request.
+    toc: Optional[List[api.TableOfContentsItem]] = None
+
+
+class ManifestCache:
+    """LRU cache of parsed narration manifests keyed by the book ID.
+
+    Cached entries are validated with a conditional GET on every access, so manifests uploaded by other instances are
+    picked up as well. The cache is bounded by the total size of the manifest documents.
+    """
+
+    def __init__(self, files_service, max_size_bytes: Optional[int] = None):
+        self.files_service = files_service
+        self.max_size_bytes = max_size_bytes if max_size_bytes is not None else \
+            int(os.getenv("MANIFEST_CACHE_SIZE_MB", "64")) * 1024 * 1024
+
+        self._entries: OrderedDict[uuid.UUID, CachedManifest] = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, book_id: uuid.UUID) -> CachedManifest:
+        with self._lock:
+            entry = self._entries.get(book_id)
+
+        keys = [f"{book_id}/{MANIFEST_KEY}", f"{book_id}/{JSON_MANIFEST_KEY}"]
+        if entry is not None:
+            # Validate the cached entry against the file it was read from.
+            keys.remove(entry.key)
+            keys.insert(0, entry.key)
+
+        file_data = None
+        for key in keys:
+            try:
+                file_data = self.files_service.get_object(key, if_none_match=entry.etag if entry else "")
+            except NotModified:
+                with self._lock:
+                    self.hits += 1
+                    if book_id in self._entries:
+                        self._entries.move_to_end(book_id)
+                return entry
+            if file_data is not None:
+                break
+
+        if file_data is None:
+            self.invalidate(book_id)
+            raise FileNotFoundError(f"Narration manifest of book {book_id} not found.")
+
+        if key.endswith(JSON_MANIFEST_KEY):
+            manifest = CompactManifest.from_manifest(NarrationManifest.model_validate_json(file_data.body))
+        else:
+            manifest = CompactManifest(file_data.body)
+        entry = CachedManifest(key=key, etag=file_data.etag, manifest=manifest, size_bytes=len(manifest.data))
+        with self._lock:
+            self.misses += 1
+            self._remove(book_id)
+            if entry.size_bytes <= self.max_size_bytes:
+                self._entries[book_id] = entry
+                self._size_bytes += entry.size_bytes
+                self._evict()
+        return entry
+
+    def invalidate(self, book_id: uuid.UUID):
+        with self._lock:
+            self._remove(book_id)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size_bytes,
+                "max_size_bytes": self.max_size_bytes,
+            }
+
+    def _remove(self, book_id: uuid.UUID):
+        entry = self._entries.pop(book_id, None)
+        if entry is not None:
+            self._size_bytes -= entry.size_bytes
+
+    def _evict(self):
+        while self._size_bytes > self.max_size_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._size_bytes -= entry.size_bytes
+            self.evictions += 1
+
+
+class TrackManifestCache:
+    """LRU cache of the manifests of narrated tracks keyed by the content ID, TTS model and voice of a playlist.
+
+    Lets a narration response load only the tracks completed since the previous one. Entries are written from the RMQ
+    handler threads, so access is locked, and the cache is bounded by the total number of tracks.
+    """
+
+    def __init__(self, max_tracks: Optional[int] = None):
+        self.max_tracks = max_tracks if max_tracks is not None else \
+            int(os.getenv("TRACK_MANIFEST_CACHE_TRACKS", "20000"))
+
+        self._entries: OrderedDict[Tuple[uuid.UUID, str, str], TrackManifests] = OrderedDict()
+        self._tracks = 0
+        self._lock = threading.Lock()
+
+    def get(self, content_id: uuid.UUID, tts_model: str, voice: str) -> TrackManifests:
+        key = (content_id, tts_model, voice)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return {}
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, content_id: uuid.UUID, tts_model: str, voice: str, tracks: TrackManifests):
+        key = (content_id, tts_model, voice)
+        with self._lock:
+            self._remove(key)
+            if len(tracks) <= self.max_tracks:
+                self._entries[key] = dict(tracks)
+                self._tracks += len(tracks)
+                self._evict()
+
+    def invalidate(self, content_id: uuid.UUID, tts_model: Optional[str] = None, voice: Optional[str] = None):
+        """Drops the playlist, or all the playlists of the content if the TTS model and voice are not given."""
+        with self._lock:
+            if tts_model is not None and voice is not None:
+                self._remove((content_id, tts_model, voice))
+                return
+            for key in [key for key in self._entries if key[0] == content_id]:
+                self._remove(key)
+
+    def _remove(self, key: Tuple[uuid.UUID, str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._tracks -= len(entry)
+
+    def _evict(self):
+        while self._tracks > self.max_tracks:
+            _, entry = self._entries.popitem(last=False)
+            self._tracks -= len(entry)
@@ -1,35 +1,58 @@
 from io import BytesIO
 
-import asyncio
 import logging
+import math
 import m3u8
-from datetime import datetime, UTC
-from typing import Sequence, List, Annotated
+import uuid
+from datetime import datetime, UTC, timedelta
+from typing import Sequence, List, Annotated, Set, Dict, Tuple, Optional
 
 from sqlalchemy import select, text, update
 
-from api.models import db
+from api.models import db, api
 from api.services.files import FilesServiceDep
+from api.services.manifest_cache import ManifestCache, TrackManifestCache
 from api.services.settings import SettingsServiceDep
+from api.utils.scheduling import DISPATCH_SPEECH, COMPLETE_NARRATION
 from common_lib import RMQClientDep
 from common_lib.db import transactional
 from common_lib.models import rmq, tts
 from common_lib.models.tts import TrackManifest
-from common_lib.rmq import Topology
+from common_lib.rmq import Topology, QueueState
 from common_lib.service import Service
 
 LOG = logging.getLogger(__name__)
 
+# Number of recently narrated tracks the speed of the workers is estimated from.
+NARRATION_TIME_SAMPLE_SIZE = 20
+
+# A track that isn't narrated in LEASE_FACTOR times the expected time is sent again, up to MAX_ATTEMPTS times.
+LEASE_FACTOR = 3
+MIN_LEASE_SEC = 300
+# Expected narration time of a track if there is no data yet.
+DEFAULT_NARRATION_TIME_SEC = 120
+MAX_ATTEMPTS = 3
+
+# Number of recently narrated tracks the narration rate used for ETAs is measured on.
+RATE_SAMPLE_SIZE = 100
+
 
 class NarrationQueueService(Service):
     def __init__(self,
                  rmq_client: RMQClientDep,
                  settings_service: SettingsServiceDep,
                  files_service: FilesServiceDep,
+                 manifest_cache: ManifestCache,
+                 track_manifest_cache: TrackManifestCache,
                  **kwargs):
         self.rmq_client = rmq_client
         self.settings_service = settings_service
         self.files_service = files_service
+        self.manifest_cache = manifest_cache
+        self.track_manifest_cache = track_manifest_cache
+        # State of the narration queue as of the last dispatch. The RMQ channel isn't thread-safe, so it's read by the
+        # dispatch loop only and the request threads serve this copy.
+        self._queue_state: Optional[QueueState] = None
 
     async def generate_speech_maybe(self):
         while True:
@@ -39,8 +62,9 @@ class NarrationQueueService(Service):
             except:
                 LOG.info("Error while triggering speech generation, will try again later.", exc_info=True)
 
+            # Woken up when a book starts being narrated or a track is done, the interval is a safety net.
             settings = self.settings_service.get_system_settings()
-            await asyncio.sleep(settings.speech_generation_interval_sec)
+            await DISPATCH_SPEECH.wait(settings.speech_generation_interval_sec)
 
     @transactional
     def _do_generate_speech_maybe(self):
@@ -49,86 +73,315 @@ class NarrationQueueService(Service):
             LOG.info("Speech generation is disabled. Doing nothing.")
             return
 
-        message_num = 0
-        message_num += self.rmq_client.get_queue_size(Topology.narration_queue)
+        avg_narration_time_s = self._avg_narration_time_s()
+        self._expire_leases()
 
-        if message_num > system_settings.speech_generation_queue_size_threshold:
+        queue_state = self.rmq_client.get_queue_state(Topology.narration_queue)
+        self._queue_state = queue_state
+        target_depth = self._target_queue_depth(queue_state.consumer_count, avg_narration_time_s,
+                                                system_settings.speech_generation_buffer_sec)
+        limit = target_depth - queue_state.message_count
+        LOG.debug("Narration queue has %s messages and %s consumers, target depth is %s.",
+                  queue_state.message_count, queue_state.consumer_count, target_depth)
+        if limit <= 0:
             return
 
-        # Get next 10 tracks to generate and publish them to RMQ.
+        # Get next tracks to generate and publish them to RMQ.
+        # Tracks of the content might be enqueued by any of the books uploaded from the same file.
+        # Owners of the books being narrated take turns, one track each (round-robin). Tracks of an owner's books are
+        # taken in the order the books were created, so they are completed one after another.
+        # Within that, the tracks right after the position of anyone listening to the content go first: the lookahead
+        # counts all tracks following the position, so once they are narrated the order falls back to the book order.
         # noinspection SqlDialectInspection
-        query_text = """WITH BooksToNarrate as (select b.id, b.created_time
+        query_text = """WITH BooksToNarrate as (select distinct on (b.content_id) b.content_id, b.owner_id, b.created_time
                                                 from books b
                                                 where b.status = 'narrating'
-                                                order by b.created_time
-                                                limit 1)
-                        SELECT *
+                                                order by b.content_id, b.created_time),
+                             Positions as (select distinct n.content_id,
+                                                           substring(p.data ->> 'fragment_id' from 3)::int as fragment_id
+                                           from playback_progress p
+                                                    join books pb on pb.id = p.book_id
+                                                    join BooksToNarrate n on n.content_id = pb.content_id
+                                           where p.data ->> 'fragment_id' ~ '^n-[0-9]+$'),
+                             Ahead as (select q.id,
+                                              q.sent,
+                                              row_number() over (partition by pos.content_id, pos.fragment_id
+                                                                 order by q."order") as distance
+                                       from narration_queue q
+                                                join books qb on qb.id = q.book_id
+                                                join Positions pos on pos.content_id = qb.content_id
+                                       where q.last_fragment_id >= pos.fragment_id),
+                             Urgent as (select distinct id
+                                        from Ahead
+                                        where sent is null
+                                          and distance <= :lookahead),
+                             Candidates as (select q.id,
+                                                   row_number() over (partition by n.owner_id
+                                                                      order by u.id is null, n.created_time, q."order")
+                                                       as owner_turn,
+                                                   u.id is not null as urgent,
+                                                   n.created_time
+                                            from narration_queue q
+                                                     join books qb on qb.id = q.book_id
+                                                     join BooksToNarrate n on n.content_id = qb.content_id
+                                                     left join Urgent u on u.id = q.id
+                                            where q.sent is null
+                                              and q.completed is null
+                                              and q.failed is null)
+                        SELECT q.*
                         FROM narration_queue q
-                        WHERE q.book_id in (SELECT id FROM BooksToNarrate)
-                          and q.sent is null
-                        ORDER BY q."order"
-                        LIMIT 10 FOR UPDATE
+                                 JOIN Candidates c on c.id = q.id
+                        ORDER BY c.owner_turn, c.urgent desc, c.created_time
+                        LIMIT :limit FOR UPDATE OF q
                      """
 
-        stmt = select(db.NarrationQueue).from_statement(text(query_text))
+        stmt = select(db.NarrationQueue).from_statement(text(query_text)).params(
+            lookahead=system_settings.narration_lookahead_tracks, limit=limit)
         # noinspection PyTypeChecker
         db_records: Sequence[db.NarrationQueue] = self.db.scalars(stmt).all()
         if len(db_records):
-            stmt = update(db.NarrationQueue).where(db.NarrationQueue.id.in_([r.id for r in db_records])).values(
-                sent=datetime.now(UTC))
-            # noinspection PyTypeChecker
-            self.db.execute(stmt)
+            lease_sec = self._lease_sec(avg_narration_time_s, system_settings.speech_generation_buffer_sec)
+            self._send(list(db_records), lease_sec)
+
+    def _mark_sent(self, queue_ids: List[int], lease_sec: float):
+        now = datetime.now(UTC)
+        stmt = (
+            update(db.NarrationQueue)
+            .where(db.NarrationQueue.id.in_(queue_ids))
+            .values(sent=now,
+                    attempts=db.NarrationQueue.attempts + 1,
+                    lease_expires=now + timedelta(seconds=lease_sec),
+                    completed=None,
+                    failed=None)
+        )
+        # noinspection PyTypeChecker
+        self.db.execute(stmt)
+
+    @staticmethod
+    def _lease_sec(avg_narration_time_s: Optional[float], buffer_sec: float) -> float:
+        """How long a sent track may take: it waits in the queue for up to buffer_sec and is then narrated."""
+        expected_sec = buffer_sec + (avg_narration_time_s or DEFAULT_NARRATION_TIME_SEC)
+        return max(MIN_LEASE_SEC, LEASE_FACTOR * expected_sec)
+
+    def _expire_leases(self):
+        """Tracks not narrated before their lease expired are sent again, or marked as failed after MAX_ATTEMPTS."""
+        now = datetime.now(UTC)
+        expired = (
+            update(db.NarrationQueue)
+            .where(db.NarrationQueue.completed.is_(None))
+            .where(db.NarrationQueue.failed.is_(None))
+            .where(db.NarrationQueue.lease_expires < now)
+        )
+        # noinspection PyTypeChecker
+        failed_ids = self.db.scalars(expired.where(db.NarrationQueue.attempts >= MAX_ATTEMPTS)
+                                     .values(failed=now, lease_expires=None)
+                                     .returning(db.NarrationQueue.id)).all()
+        if failed_ids:
+            LOG.error("Narration of tracks %s failed after %s attempts.", failed_ids, MAX_ATTEMPTS)
+            # The book might be complete now, with the failed tracks missing.
+            COMPLETE_NARRATION.fire_after_commit(self.db)
+
+        # Sent again by the regular dispatch, so the order of tracks is kept.
+        # noinspection PyTypeChecker
+        retry_ids = self.db.scalars(expired.values(sent=None, lease_expires=None)
+                                    .returning(db.NarrationQueue.id)).all()
+        if retry_ids:
+            LOG.warning("Leases of tracks %s expired, will send them again.", retry_ids)
+
+    def _avg_narration_time_s(self) -> Optional[float]:
+        """Average time a worker spends on a track, over the recently narrated ones."""
+        query_text = """select avg(r.narration_time_s)
+                        from (select q.narration_time_s
+                              from narration_queue q
+                              where q.completed is not null
+                                and q.narration_time_s > 0
+                              order by q.completed desc
+                              limit :sample_size) r
+                     """
+        return self.db.execute(text(query_text), {"sample_size": NARRATION_TIME_SAMPLE_SIZE}).scalar()
 
-            self._send_rmq_messages(list(db_records))
+    @staticmethod
+    def _target_queue_depth(consumer_count: int, avg_narration_time_s: Optional[float], buffer_sec: float) -> int:
+        """Number of queued tracks keeping every worker busy for buffer_sec after it's done with the current track.
+        Each worker gets at least one, so it can start the next track right away."""
+        if consumer_count == 0:
+            return 0
+        if not avg_narration_time_s:
+            return consumer_count
+        return consumer_count * max(1, math.ceil(buffer_sec / avg_narration_time_s))
 
-    def _send_rmq_messages(self, queue_entries: List[db.NarrationQueue]):
+    def _send(self, queue_entries: List[db.NarrationQueue], lease_sec: float):
+        """Marks the tracks as sent and publishes their requests.
+
+        All requests are built before anything is marked as sent, so a track that can't be narrated doesn't leave the
+        rest of the batch half-sent. Such a track is marked as failed instead of being picked again on every dispatch.
+        """
+        messages = self._build_messages(queue_entries)
+        failed_ids = [entry.id for entry in queue_entries if entry.id not in messages]
+        if failed_ids:
+            self._mark_failed(failed_ids)
+        if messages:
+            self._mark_sent(list(messages.keys()), lease_sec)
+        for msg in messages.values():
+            self.rmq_client.publish("narrate", msg)
+
+    def _build_messages(self, queue_entries: List[db.NarrationQueue]) -> Dict[int, rmq.NarrateRequest]:
+        # Audio is stored with the content, so it's shared by the books uploaded from the same file.
+        content_ids = self._content_ids({entry.book_id for entry in queue_entries})
+        messages = {}
         for entry in queue_entries:
-            msg = rmq.NarrateRequest(
+            content_id = content_ids[entry.book_id]
+            fragments = self._get_fragments(content_id, entry)
+            if fragments is None:
+                continue
+            messages[entry.id] = rmq.NarrateRequest(
                 queue_id=entry.id,
-                book_id=entry.book_id,
+                book_id=content_id,
                 tts_model=entry.tts_model,
                 voice=entry.voice,
                 track_base_name=entry.track_base_name,
                 order=entry.order,
-                fragments=entry.fragments
+                fragments=fragments
             )
-            self.rmq_client.publish("narrate", msg)
+        return messages
+
+    def _get_fragments(self, content_id: uuid.UUID, entry: db.NarrationQueue) -> Optional[tts.FragmentGroups]:
+        """Reads fragments of the queued track from the narration manifest of the content."""
+        manifest = self.manifest_cache.get(content_id).manifest
+        track_index = manifest.find_track(entry.order)
+        if track_index is None or manifest.track_id_range(track_index) != (entry.order, entry.last_fragment_id):
+            LOG.error("Track %s-%s of queue item %s is not in the narration manifest of %s.", entry.order,
+                      entry.last_fragment_id, entry.id, content_id)
+            return None
+        return manifest.audio_track(track_index).fragment_groups
+
+    def _mark_failed(self, queue_ids: List[int]):
+        stmt = (
+            update(db.NarrationQueue)
+            .where(db.NarrationQueue.id.in_(queue_ids))
+            .values(failed=datetime.now(UTC), lease_expires=None)
+        )
+        # noinspection PyTypeChecker
+        self.db.execute(stmt)
+        # The book might be complete now, with the failed tracks missing.
+        COMPLETE_NARRATION.fire_after_commit(self.db)
+
+    def _content_ids(self, book_ids: Set[uuid.UUID]) -> Dict[uuid.UUID, uuid.UUID]:
+        stmt = select(db.Book.id, db.Book.content_id).where(db.Book.id.in_(book_ids))
+        return {book_id: content_id for book_id, content_id in self.db.execute(stmt)}
 
-    @transactional
     def handle_response_msg(self, payload: rmq.NarrateResponse):
         LOG.info("Got response for narration request %s. Will update the playlist.", payload.queue_id)
+        result = self._record_response(payload)
+        if result is None:
+            return
+        playlist_key, playlist = result
+        # Uploaded after the transaction is committed, so it's not held open by the S3 request.
+        self.files_service.upload_file(playlist_key, BytesIO(playlist.encode()))
+
+    @transactional
+    def _record_response(self, payload: rmq.NarrateResponse) -> Optional[Tuple[str, str]]:
+        """Stores the narration result and renders the playlist of the content from the stored data.
+        Returns the playlist key and the playlist, or None if there is nothing to update."""
         db_record = self.db.get(db.NarrationQueue, payload.queue_id)
+        if db_record is None:
+            LOG.warning("Narration request %s not found, the book must have been deleted.", payload.queue_id)
+            return None
+        if db_record.completed is not None:
+            # The track was sent again after its lease expired, and both workers narrated it.
+            LOG.info("Narration request %s is already completed, ignoring the duplicate response.", payload.queue_id)
+            return None
+
+        # A late response is accepted even if the track was sent again or marked as failed in the meantime.
         db_record.completed = payload.completed
+        db_record.lease_expires = None
+        db_record.failed = None
         db_record.narration_time_s = payload.narration_time_s
+        db_record.worker = payload.worker
+        db_record.received = datetime.now(UTC)
+        db_record.processing_s = payload.processing_s
         db_record.duration_s = payload.duration_s
         db_record.size_bytes = payload.size_bytes
+        db_record.timeline = payload.timeline
+        # A worker is free now, and the book might be complete.
+        DISPATCH_SPEECH.fire_after_commit(self.db)
+        COMPLETE_NARRATION.fire_after_commit(self.db)
 
-        # Load all track manifests to generate the playlist
-        audio_dir = f"{db_record.book_id}/audio-files/{db_record.tts_model}/{db_record.voice}"
-        all_files = self.files_service.list_files(audio_dir)
-        track_manifest_files = [f for f in all_files if f.endswith(".json")]
-        track_manifests = []
-        for track_manifest_key in track_manifest_files:
-            file_data = self.files_service.get_object(track_manifest_key)
-            track_manifests.append(TrackManifest.model_validate_json(file_data.body))
-        # Ensure tracks are ordered correctly.
-        track_manifests.sort(key=lambda t: t.timeline[0].id)
-
-        # Or simply order by the first fragment ID? < Do this one for now.
-        # TODO: Might do complete cross-check upon book completion.
-
-        playlist_key = f"{db_record.book_id}/playlists/{db_record.tts_model}_{db_record.voice}.m3u8"
-        playlist = self._generate_playlist(track_manifests)
-        self.files_service.upload_file(playlist_key, BytesIO(playlist.encode()))
+        content_id = self._content_ids({db_record.book_id})[db_record.book_id]
+        playlist_key = f"{content_id}/playlists/{db_record.tts_model}_{db_record.voice}.m3u8"
+
+        # Tracks of the content might be enqueued by any of the books uploaded from the same file.
+        stmt = (
+            select(db.NarrationQueue.id, db.NarrationQueue.completed, db.NarrationQueue.failed)
+            .join(db.Book, db.Book.id == db.NarrationQueue.book_id)
+            .where(db.Book.content_id == content_id)
+            .where(db.NarrationQueue.tts_model == db_record.tts_model)
+            .where(db.NarrationQueue.voice == db_record.voice)
+            .order_by(db.NarrationQueue.order)
+        )
+        queue_states = self.db.execute(stmt).all()
+        completed = {queue_id: completed_time for queue_id, completed_time, _ in queue_states
+                     if completed_time is not None}
+
+        # Cached manifests of tracks narrated again since they were cached are stale.
+        cached = {queue_id: value for queue_id, value
+                  in self.track_manifest_cache.get(content_id, db_record.tts_model, db_record.voice).items()
+                  if completed.get(queue_id) == value[0]}
+        missing_ids = [queue_id for queue_id in completed if queue_id not in cached]
+        if missing_ids:
+            # noinspection PyTypeChecker
+            entries: Sequence[db.NarrationQueue] = self.db.scalars(
+                select(db.NarrationQueue).where(db.NarrationQueue.id.in_(missing_ids))).all()
+            for entry in entries:
+                cached[entry.id] = entry.completed, self._track_manifest(content_id, entry)
+
+        track_manifests = [cached[queue_id][1] for queue_id in completed if cached[queue_id][1] is not None]
+        is_complete = all(completed_time is not None or failed is not None
+                          for _, completed_time, failed in queue_states)
+        if is_complete:
+            self.track_manifest_cache.invalidate(content_id, db_record.tts_model, db_record.voice)
+        else:
+            self.track_manifest_cache.put(content_id, db_record.tts_model, db_record.voice, cached)
+        return playlist_key, self._generate_playlist(track_manifests, is_complete)
+
+    def _track_manifest(self, content_id: uuid.UUID, entry: db.NarrationQueue) -> Optional[TrackManifest]:
+        if entry.timeline is None and not self._load_timeline(content_id, entry):
+            return None
+        return TrackManifest(
+            audio_key=self._audio_key(content_id, entry),
+            track_name=entry.track_base_name,
+            size_bytes=entry.size_bytes,
+            timeline=entry.timeline,
+        )
 
-    def _generate_playlist(self, tracks: List[tts.TrackManifest]) -> str:
+    @staticmethod
+    def _audio_key(content_id: uuid.UUID, entry: db.NarrationQueue) -> str:
+        return f"{content_id}/audio-files/{entry.tts_model}/{entry.voice}/{entry.track_base_name}.aac"
+
+    def _load_timeline(self, content_id: uuid.UUID, entry: db.NarrationQueue) -> bool:
+        """Loads the timeline of a track narrated before the timeline was stored in the DB, or by an older worker,
+        from its track manifest. Returns whether the manifest was found."""
+        track_manifest_key = f"{content_id}/audio-files/{entry.tts_model}/{entry.voice}/{entry.track_base_name}.json"
+        file_data = self.files_service.get_object(track_manifest_key)
+        if file_data is None:
+            LOG.warning("Track manifest %s of narrated track %s not found, leaving it out of the playlist.",
+                        track_manifest_key, entry.id)
+            return False
+        track_manifest = TrackManifest.model_validate_json(file_data.body)
+        # Stored with the entry, so the manifest is read only once.
+        entry.timeline = track_manifest.timeline
+        entry.size_bytes = track_manifest.size_bytes
+        return True
+
+    def _generate_playlist(self, tracks: List[tts.TrackManifest], is_endlist: bool = False) -> str:
         playlist = m3u8.M3U8()
 
         playlist.version = "4"
-        playlist.target_duration = max([sum([f.duration for f in t.timeline]) for t in tracks] or [0]) + 1
+        # Must be an integer according to the HLS spec.
+        playlist.target_duration = math.ceil(max([sum([f.duration for f in t.timeline]) for t in tracks] or [0])) + 1
         playlist.media_sequence = 0
-        # TODO: Set endlist to True if the book status is ready (no narration happens).
-        playlist.is_endlist = False
+        # No more tracks are going to be added.
+        playlist.is_endlist = is_endlist
 
         for track in tracks:
             fragments = []
@@ -160,7 +413,136 @@ class NarrationQueueService(Service):
         stmt = select(db.NarrationQueue).where(db.NarrationQueue.id.in_(queue_ids))
         # noinspection PyTypeChecker
         db_records: Sequence[db.NarrationQueue] = self.db.scalars(stmt).all()
-        self._send_rmq_messages(list(db_records))
+        system_settings = self.settings_service.get_system_settings()
+        self._send(list(db_records),
+                   self._lease_sec(self._avg_narration_time_s(), system_settings.speech_generation_buffer_sec))
+
+    @transactional
+    def get_metrics(self, window_min: int = 60) -> api.NarrationMetrics:
+        """Throughput of the tracks narrated within the last window_min minutes, per worker, model and voice."""
+        since = datetime.now(UTC) - timedelta(minutes=window_min)
+        query_text = """select q.worker,
+                               q.tts_model,
+                               q.voice,
+                               count(*)                                                              as tracks,
+                               sum(q.narration_time_s) / nullif(sum(q.duration_s), 0)                as real_time_factor,
+                               avg(greatest(extract(epoch from q.received - q.sent) - q.processing_s, 0))
+                                                                                                     as avg_queue_wait_s,
+                               avg(q.narration_time_s)                                               as avg_processing_s,
+                               sum(q.text_length) / nullif(sum(q.narration_time_s) filter
+                                   (where q.text_length is not null), 0)                             as chars_per_sec
+                        from narration_queue q
+                        where q.completed >= :since
+                        group by q.worker, q.tts_model, q.voice
+                        order by q.worker, q.tts_model, q.voice
+                     """
+        throughput = [
+            api.NarrationThroughput(worker=worker, tts_model=tts_model, voice=voice, tracks=tracks,
+                                    tracks_per_min=tracks / window_min, real_time_factor=real_time_factor,
+                                    avg_queue_wait_s=avg_queue_wait_s, avg_processing_s=avg_processing_s,
+                                    chars_per_sec=chars_per_sec)
+            for worker, tts_model, voice, tracks, real_time_factor, avg_queue_wait_s, avg_processing_s, chars_per_sec
+            in self.db.execute(text(query_text), {"since": since})
+        ]
+
+        counts_query = """select count(*) filter (where q.sent is null and q.completed is null and q.failed is null),
+                                 count(*) filter (where q.sent is not null and q.completed is null and q.failed is null),
+                                 count(*) filter (where q.failed is not null)
+                          from narration_queue q
+                       """
+        pending, in_flight, failed = self.db.execute(text(counts_query)).one()
+        return api.NarrationMetrics(window_min=window_min, throughput=throughput, pending_tracks=pending,
+                                    in_flight_tracks=in_flight, failed_tracks=failed, consumers=self._consumer_count())
+
+    @transactional
+    def get_eta(self, book_id: uuid.UUID) -> api.NarrationEta:
+        """Estimates when narration of the book completes from the remaining text and the recent narration rate."""
+        book = self.db.get_one(db.Book, book_id)
+
+        # Remaining text of the books ahead in the queue, and of the book itself. Tracks of the content might be
+        # enqueued by any of the books uploaded from the same file.
+        query_text = """with Remaining as (select qb.content_id,
+                                                 count(*)           as tracks,
+                                                 sum(q.text_length) as chars,
+                                                 count(*) filter (where q.text_length is null) as unknown_length
+                                          from narration_queue q
+                                                   join books qb on qb.id = q.book_id
+                                          where q.completed is null
+                                            and q.failed is null
+                                          group by qb.content_id),
+                             Books as (select distinct on (b.content_id) b.content_id, b.status, b.created_time
+                                       from books b
+                                       where b.status in ('narrating', 'queued')
+                                       order by b.content_id, b.status = 'narrating' desc, b.created_time)
+                        select r.content_id = :content_id as own,
+                               b.status = 'narrating'      as narrating,
+                               r.tracks,
+                               coalesce(r.chars, 0)        as chars,
+                               r.unknown_length
+                        from Remaining r
+                                 join Books b on b.content_id = r.content_id
+                        where b.status = 'narrating'
+                           or b.created_time <= :created_time
+                           or r.content_id = :content_id
+                     """
+        rows = self.db.execute(text(query_text), {"content_id": book.content_id,
+                                                  "created_time": book.created_time}).all()
+
+        rate_query = """select sum(r.text_length) / nullif(sum(r.narration_time_s), 0),
+                               sum(r.duration_s) / nullif(sum(r.text_length), 0),
+                               avg(r.text_length)
+                        from (select q.text_length, q.narration_time_s, q.duration_s
+                              from narration_queue q
+                              where q.completed is not null
+                                and q.text_length is not null
+                                and q.narration_time_s > 0
+                              order by q.completed desc
+                              limit :sample_size) r
+                     """
+        chars_per_sec, audio_s_per_char, avg_track_chars = self.db.execute(
+            text(rate_query), {"sample_size": RATE_SAMPLE_SIZE}).one()
+
+        def chars(row) -> int:
+            # Tracks enqueued before their length was recorded are assumed to be of average length.
+            return row.chars + row.unknown_length * int(avg_track_chars or 0)
+
+        own = next((row for row in rows if row.own), None)
+        eta = api.NarrationEta(book_id=book_id, status=book.status,
+                               remaining_tracks=own.tracks if own else 0,
+                               remaining_chars=chars(own) if own else 0)
+        if own is None:
+            if book.status in (db.BookStatus.narrating, db.BookStatus.queued, db.BookStatus.ready):
+                eta.eta_s = 0
+            return eta
+
+        if audio_s_per_char:
+            eta.remaining_audio_duration_s = eta.remaining_chars * audio_s_per_char
+        eta.eta_s = self._estimate_eta_s(
+            remaining_chars=eta.remaining_chars,
+            remaining_tracks=eta.remaining_tracks,
+            ahead_chars=sum(chars(row) for row in rows if not row.own),
+            narrating_books=sum(1 for row in rows if row.narrating),
+            narrating=own.narrating,
+            consumers=self._consumer_count(),
+            chars_per_sec=chars_per_sec)
+        if eta.eta_s is not None:
+            eta.estimated_completion = datetime.now(UTC) + timedelta(seconds=eta.eta_s)
+        return eta
+
+    @staticmethod
+    def _estimate_eta_s(remaining_chars: int, remaining_tracks: int, ahead_chars: int, narrating_books: int,
+                        narrating: bool, consumers: int, chars_per_sec: Optional[float]) -> Optional[float]:
+        """A narrating book gets its fair share of the workers, but can't use more workers than it has tracks left.
+        A queued book waits for the text ahead of it to be narrated by all the workers."""
+        if not chars_per_sec or consumers == 0:
+            return None
+        if narrating:
+            workers = min(remaining_tracks, consumers / max(1, narrating_books))
+            return remaining_chars / (chars_per_sec * workers)
+        return (ahead_chars + remaining_chars) / (chars_per_sec * consumers)
+
+    def _consumer_count(self) -> int:
+        return self._queue_state.consumer_count if self._queue_state is not None else 0
 
 
 NarrationQueueServiceDep = Annotated[NarrationQueueService, NarrationQueueService.dep()]
@@ -6,6 +6,7 @@ from typing import Annotated, Optional
 from sqlalchemy import select, update
 
 from api.models import db
+from api.utils.scheduling import DISPATCH_SPEECH
 from common_lib.db import transactional
 from common_lib.service import Service
 
@@ -15,7 +16,14 @@ LOG = logging.getLogger(__name__)
 class SystemSettings:
     speech_generation_enabled: bool = False
     speech_generation_interval_sec: int = 30
+    # Unused, the queue depth is derived from the number of workers and their speed. Kept so stored settings load.
     speech_generation_queue_size_threshold: int = 10
+    # How long the queued tracks should keep the workers busy, in addition to the tracks being narrated.
+    speech_generation_buffer_sec: int = 30
+    # How many books are narrated at the same time. Workers are shared fairly between owners of the books.
+    max_narrating_books: int = 3
+    # How many tracks following the position of a listener are narrated before continuing in the book order.
+    narration_lookahead_tracks: int = 3
 
 
 # noinspection PyTypeChecker
@@ -51,6 +59,10 @@ class SettingsService(Service):
         else:
             self._update_settings(user_id, kind, recursive_patch(current.data, data))
 
+        if kind == "system":
+            # Speech generation might have been enabled or its limits changed.
+            DISPATCH_SPEECH.fire_after_commit(self.db)
+
 
 def default_settings(kind: str):
     if kind == "system":
@@ -0,0 +1,286 @@
+"""Compact binary encoding of the narration manifest.
+
+The JSON manifest repeats the structure of every fragment (discriminator, formatted ID, text) and has to be parsed
+as a whole. The compact encoding stores the manifest as a few flat arrays:
+
+- a string table holding fragment texts, titles and hrefs, each string stored once;
+- content files, navigation items, tracks and fragment groups as ranges into the next level;
+- fragment IDs and values (string index of the text, or index of the pause duration).
+
+The arrays are accessed in place, so the table of contents or a single track can be read without decoding the rest.
+
+Layout (little-endian): the header is MAGIC, version (u16) and number of sections (u16), followed by offset and
+length in bytes (u32 each) of every section. Sections are aligned to 8 bytes.
+"""
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Tuple, Union
+
+from api.models.narration import NarrationManifest, ContentFile, NavigationItem, AudioTrack
+from common_lib.models.tts import FragmentGroup, FragmentGroups, TextFragment, PauseFragment
+
+MAGIC = b"NRMF"
+VERSION = 1
+
+# Index of a missing string.
+NONE = 0xFFFFFFFF
+# Set in the fragment value for pauses, the rest of the bits is the index of the duration.
+PAUSE_FLAG = 0x80000000
+
+_HEADER = struct.Struct("<4sHH")
+_SECTION = struct.Struct("<II")
+_ALIGNMENT = 8
+
+# Sections in the order they are stored.
+STRING_OFFSETS = 0  # I: n_strings + 1 offsets into STRING_DATA.
+STRING_DATA = 1  # UTF-8 bytes of all strings.
+FILES = 2  # I: href, title, epub_types (joined by space) string indexes per content file.
+FILE_NAV_STARTS = 3  # I: n_files + 1 indexes into NAV_ITEMS.
+NAV_ITEMS = 4  # I: idref, title string indexes and the narrate flag per navigation item.
+NAV_TRACK_STARTS = 5  # I: n_nav_items + 1 indexes of the tracks.
+TRACK_GROUP_STARTS = 6  # I: n_tracks + 1 indexes of the groups.
+GROUP_FRAGMENT_STARTS = 7  # I: n_groups + 1 indexes of the fragments.
+FRAGMENT_IDS = 8  # I: ID per fragment.
+FRAGMENT_VALUES = 9  # I: string index of the text, or PAUSE_FLAG | index into PAUSE_DURATIONS.
+PAUSE_DURATIONS = 10  # d: distinct pause durations.
+SECTION_COUNT = 11
+
+FILE_FIELDS = 3
+NAV_ITEM_FIELDS = 3
+
+
+def is_compact_manifest(data: bytes) -> bool:
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_manifest(manifest: NarrationManifest) -> bytes:
+    strings: Dict[str, int] = {}
+
+    def string_index(value: Optional[str]) -> int:
+        if value is None:
+            return NONE
+        return strings.setdefault(value, len(strings))
+
+    pauses: Dict[float, int] = {}
+    sections = {i: array("I") for i in range(SECTION_COUNT) if i not in (STRING_DATA, PAUSE_DURATIONS)}
+    for section in (FILE_NAV_STARTS, NAV_TRACK_STARTS, TRACK_GROUP_STARTS, GROUP_FRAGMENT_STARTS):
+        sections[section].append(0)
+
+    for content_file in manifest.root:
+        sections[FILES].extend([string_index(content_file.href), string_index(content_file.title),
+                                string_index(" ".join(content_file.epub_types))])
+        for nav_item in content_file.navigation_items:
+            sections[NAV_ITEMS].extend([string_index(nav_item.idref), string_index(nav_item.title),
+                                        int(nav_item.narrate)])
+            for track in nav_item.audio_tracks:
+                for group in track.fragment_groups.root:
+                    for fragment in group.root:
+                        sections[FRAGMENT_IDS].append(fragment.id)
+                        if isinstance(fragment, PauseFragment):
+                            sections[FRAGMENT_VALUES].append(
+                                PAUSE_FLAG | pauses.setdefault(fragment.duration, len(pauses)))
+                        else:
+                            sections[FRAGMENT_VALUES].append(string_index(fragment.text))
+                    sections[GROUP_FRAGMENT_STARTS].append(len(sections[FRAGMENT_IDS]))
+                sections[TRACK_GROUP_STARTS].append(len(sections[GROUP_FRAGMENT_STARTS]) - 1)
+            sections[NAV_TRACK_STARTS].append(len(sections[TRACK_GROUP_STARTS]) - 1)
+        sections[FILE_NAV_STARTS].append(len(sections[NAV_ITEMS]) // NAV_ITEM_FIELDS)
+
+    string_data = bytearray()
+    sections[STRING_OFFSETS].append(0)
+    for value in strings:
+        string_data += value.encode()
+        sections[STRING_OFFSETS].append(len(string_data))
+
+    payloads: List[bytes] = []
+    for i in range(SECTION_COUNT):
+        if i == STRING_DATA:
+            payloads.append(bytes(string_data))
+        elif i == PAUSE_DURATIONS:
+            payloads.append(_to_bytes(array("d", pauses.keys())))
+        else:
+            payloads.append(_to_bytes(sections[i]))
+
+    out = bytearray(_HEADER.pack(MAGIC, VERSION, SECTION_COUNT))
+    table_offset = len(out)
+    out += bytes(_SECTION.size * SECTION_COUNT)
+    for i, payload in enumerate(payloads):
+        out += bytes(-len(out) % _ALIGNMENT)
+        _SECTION.pack_into(out, table_offset + i * _SECTION.size, len(out), len(payload))
+        out += payload
+    return bytes(out)
+
+
+@dataclass(frozen=True)
+class NavigationEntry:
+    """Navigation item of the manifest without its audio tracks."""
+    index: int
+    content_href: str
+    idref: Optional[str]
+    title: str
+    narrate: bool
+
+    @property
+    def href(self) -> str:
+        """The href used in the table of contents."""
+        return self.content_href if self.idref is None else f"{self.content_href}#{self.idref}"
+
+
+class CompactManifest:
+    """Reads the compact manifest in place, decoding only the requested parts."""
+
+    def __init__(self, data: bytes):
+        if not is_compact_manifest(data):
+            raise ValueError("Not a compact narration manifest.")
+        _, version, section_count = _HEADER.unpack_from(data)
+        if version != VERSION or section_count != SECTION_COUNT:
+            raise ValueError(f"Unsupported compact narration manifest version {version}.")
+
+        self.data = data
+        self._view = memoryview(data)
+        sections = [_SECTION.unpack_from(data, _HEADER.size + i * _SECTION.size) for i in range(SECTION_COUNT)]
+        self._string_data = self._view[sections[STRING_DATA][0]:sum(sections[STRING_DATA])]
+        self._arrays = {i: self._array("d" if i == PAUSE_DURATIONS else "I", *section)
+                        for i, section in enumerate(sections) if i != STRING_DATA}
+        self._navigation: Optional[List[NavigationEntry]] = None
+
+    @classmethod
+    def from_manifest(cls, manifest: NarrationManifest) -> "CompactManifest":
+        return cls(encode_manifest(manifest))
+
+    def _array(self, typecode: str, offset: int, length: int) -> Union[memoryview, array]:
+        view = self._view[offset:offset + length]
+        if sys.byteorder == "little":
+            return view.cast(typecode)
+        values = array(typecode)
+        values.frombytes(view)
+        values.byteswap()
+        return values
+
+    def string(self, index: int) -> Optional[str]:
+        if index == NONE:
+            return None
+        offsets = self._arrays[STRING_OFFSETS]
+        return str(self._string_data[offsets[index]:offsets[index + 1]], "utf-8")
+
+    def content_file_count(self) -> int:
+        return len(self._arrays[FILES]) // FILE_FIELDS
+
+    def navigation_items(self) -> List[NavigationEntry]:
+        """Returns all navigation items in the reading order, without decoding any fragments."""
+        if self._navigation is None:
+            files, nav_items, nav_starts = self._arrays[FILES], self._arrays[NAV_ITEMS], self._arrays[FILE_NAV_STARTS]
+            entries = []
+            for file_index in range(self.content_file_count()):
+                href = self.string(files[file_index * FILE_FIELDS])
+                for index in range(nav_starts[file_index], nav_starts[file_index + 1]):
+                    idref, title, narrate = nav_items[index * NAV_ITEM_FIELDS:(index + 1) * NAV_ITEM_FIELDS]
+                    entries.append(NavigationEntry(index=index, content_href=href, idref=self.string(idref),
+                                                   title=self.string(title), narrate=bool(narrate)))
+            self._navigation = entries
+        return self._navigation
+
+    def track_indexes(self, nav_index: int) -> range:
+        starts = self._arrays[NAV_TRACK_STARTS]
+        return range(starts[nav_index], starts[nav_index + 1])
+
+    def track_id_range(self, track_index: int) -> Tuple[int, int]:
+        """Returns IDs of the first and the last fragment of the track."""
+        fragment_start, fragment_end = self._track_fragments(track_index)
+        fragment_ids = self._arrays[FRAGMENT_IDS]
+        return fragment_ids[fragment_start], fragment_ids[fragment_end - 1]
+
+    def track_count(self) -> int:
+        return len(self._arrays[TRACK_GROUP_STARTS]) - 1
+
+    def find_track(self, first_fragment_id: int) -> Optional[int]:
+        """Returns index of the track starting with the given fragment. Tracks are in ascending order of IDs."""
+        fragment_ids, group_fragment_starts = self._arrays[FRAGMENT_IDS], self._arrays[GROUP_FRAGMENT_STARTS]
+        group_starts = self._arrays[TRACK_GROUP_STARTS]
+        track_count = self.track_count()
+        index = bisect_left(range(track_count), first_fragment_id,
+                            key=lambda i: fragment_ids[group_fragment_starts[group_starts[i]]])
+        if index < track_count and self.track_id_range(index)[0] == first_fragment_id:
+            return index
+        return None
+
+    def track_text_length(self, track_index: int) -> int:
+        """Number of characters of the text fragments in the track."""
+        fragment_start, fragment_end = self._track_fragments(track_index)
+        values = self._arrays[FRAGMENT_VALUES]
+        return sum(len(self.string(values[i])) for i in range(fragment_start, fragment_end)
+                   if not values[i] & PAUSE_FLAG)
+
+    def track_name(self, track_index: int) -> str:
+        first, last = self.track_id_range(track_index)
+        return f"{first}-{last}"
+
+    def audio_track(self, track_index: int) -> AudioTrack:
+        """Decodes fragments of a single track."""
+        group_starts, group_fragment_starts = self._arrays[TRACK_GROUP_STARTS], self._arrays[GROUP_FRAGMENT_STARTS]
+        groups = []
+        for group_index in range(group_starts[track_index], group_starts[track_index + 1]):
+            # noinspection PyArgumentList
+            groups.append(FragmentGroup([self._fragment(i) for i in range(group_fragment_starts[group_index],
+                                                                          group_fragment_starts[group_index + 1])]))
+        # noinspection PyArgumentList
+        return AudioTrack(name=self.track_name(track_index), fragment_groups=FragmentGroups(groups))
+
+    def audio_tracks(self, nav_index: int) -> List[AudioTrack]:
+        return [self.audio_track(i) for i in self.track_indexes(nav_index)]
+
+    def to_manifest(self) -> NarrationManifest:
+        """Decodes the whole manifest."""
+        files = self._arrays[FILES]
+        nav_starts = self._arrays[FILE_NAV_STARTS]
+        navigation = self.navigation_items()
+        content_files = []
+        for file_index in range(self.content_file_count()):
+            href, title, epub_types = files[file_index * FILE_FIELDS:(file_index + 1) * FILE_FIELDS]
+            nav_items = [NavigationItem(idref=entry.idref, title=entry.title, narrate=entry.narrate,
+                                        audio_tracks=self.audio_tracks(entry.index))
+                         for entry in navigation[nav_starts[file_index]:nav_starts[file_index + 1]]]
+            content_files.append(ContentFile(href=self.string(href), title=self.string(title),
+                                             epub_types=self.string(epub_types).split(),
+                                             navigation_items=nav_items))
+        # noinspection PyArgumentList
+        return NarrationManifest(content_files)
+
+    def to_json(self) -> bytes:
+        """Exports the manifest in the JSON format."""
+        return self.to_manifest().model_dump_json().encode()
+
+    def to_fragment_map(self) -> List:
+        """The same as NarrationManifest.to_fragment_map, but without decoding the fragment texts."""
+        fragment_ids = self._arrays[FRAGMENT_IDS]
+        result = []
+        for entry in self.navigation_items():
+            tracks = self.track_indexes(entry.index)
+            fragments = []
+            if tracks:
+                fragment_start, _ = self._track_fragments(tracks[0])
+                _, fragment_end = self._track_fragments(tracks[-1])
+                fragments = [f"n-{fragment_ids[i]:05d}" for i in range(fragment_start, fragment_end)]
+            result.append({"href": entry.content_href, "title": entry.title, "fragments": fragments})
+        return result
+
+    def _track_fragments(self, track_index: int) -> Tuple[int, int]:
+        group_starts, group_fragment_starts = self._arrays[TRACK_GROUP_STARTS], self._arrays[GROUP_FRAGMENT_STARTS]
+        return group_fragment_starts[group_starts[track_index]], group_fragment_starts[group_starts[track_index + 1]]
+
+    def _fragment(self, index: int) -> Union[TextFragment, PauseFragment]:
+        fragment_id = self._arrays[FRAGMENT_IDS][index]
+        value = self._arrays[FRAGMENT_VALUES][index]
+        if value & PAUSE_FLAG:
+            return PauseFragment(id=fragment_id, duration=self._arrays[PAUSE_DURATIONS][value & ~PAUSE_FLAG])
+        return TextFragment(id=fragment_id, text=self.string(value))
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
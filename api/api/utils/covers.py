@@ -0,0 +1,43 @@
+from io import BytesIO
+from typing import Dict, Tuple
+
+from PIL import Image, ImageOps
+
+# Derivatives of the cover image generated at ingestion: name -> bounding box. The image is resized to fit the box
+# preserving its aspect ratio and never enlarged, the same as imgproxy's "rs:fit:400:600:0".
+COVER_DERIVATIVES: Dict[str, Tuple[int, int]] = {
+    "cover": (400, 600),
+    "thumbnail": (120, 180),
+}
+WEBP_QUALITY = 80
+
+
+def cover_derivative_key(book_id, name: str) -> str:
+    return f"{book_id}/covers/{name}.webp"
+
+
+def cover_derivative_url(book_id, name: str) -> str:
+    return f"/api/files/{cover_derivative_key(book_id, name)}"
+
+
+def generate_cover_derivatives(image_bytes: bytes) -> Dict[str, bytes]:
+    """Resizes the cover image to each of COVER_DERIVATIVES and encodes them as webp.
+
+    CPU heavy, meant to be run in a worker process.
+    """
+    with Image.open(BytesIO(image_bytes)) as image:
+        # Apply EXIF orientation, the derivatives don't keep the metadata.
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+
+        derivatives = {}
+        for name, size in COVER_DERIVATIVES.items():
+            resized = image.copy()
+            resized.thumbnail(size, Image.Resampling.LANCZOS)
+
+            output = BytesIO()
+            resized.save(output, format="WEBP", quality=WEBP_QUALITY)
+            derivatives[name] = output.getvalue()
+
+    return derivatives
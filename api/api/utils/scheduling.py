@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+LOG = logging.getLogger(__name__)
+
+
+class Trigger:
+    """Wakes up a background loop waiting for it. Can be fired from any thread.
+
+    Firing while the loop is busy is remembered, so the loop runs once more right after it's done.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[asyncio.Event] = None
+        # Fired before anything waited for the trigger.
+        self._pending = False
+
+    def fire(self):
+        with self._lock:
+            if self._event is None:
+                self._pending = True
+                return
+            loop, event_ = self._loop, self._event
+        LOG.debug("Firing trigger %s.", self.name)
+        loop.call_soon_threadsafe(event_.set)
+
+    def fire_after_commit(self, session: Session):
+        """Fires the trigger once the current transaction is committed, so the loop sees the changes.
+        Nothing happens if the transaction is rolled back."""
+        event.listen(session, "after_commit", lambda _: self.fire(), once=True)
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits until the trigger is fired or the timeout expires. Returns whether it was fired."""
+        with self._lock:
+            if self._event is None:
+                self._loop = asyncio.get_running_loop()
+                self._event = asyncio.Event()
+                if self._pending:
+                    self._event.set()
+            event_ = self._event
+
+        try:
+            await asyncio.wait_for(event_.wait(), timeout)
+            return True
+        except TimeoutError:
+            return False
+        finally:
+            event_.clear()
+
+
+# Triggers of the narration scheduling loops.
+START_NARRATION = Trigger("start-narration")
+DISPATCH_SPEECH = Trigger("dispatch-speech")
+COMPLETE_NARRATION = Trigger("complete-narration")
@@ -1,9 +1,12 @@
+from array import array
 from collections import deque, defaultdict
 
 import logging
+import os
 import re
 from bs4 import BeautifulSoup, Tag
-from typing import Tuple, List, Set, Optional
+from lxml import etree
+from typing import Tuple, List, Optional
 
 from common_lib.models.tts import FragmentGroups, FragmentGroupsBuilder, Token
 
@@ -16,6 +19,8 @@ def new_span(id: str) -> str:
 
 # Regex to split a string into tokens on whitespace without loosing anything.
 TOKEN_PATTERN = re.compile(r'\S+\s*|\s+')
+# Characters that are kept in the normalized text, see Token.normalize.
+WORD_PATTERN = re.compile(r'\w+')
 
 
 def tokenize_with_whitespace(text: str) -> List[str]:
@@ -27,55 +32,147 @@ def tokenize_with_whitespace(text: str) -> List[str]:
     return TOKEN_PATTERN.findall(text)
 
 
+class TokenTable:
+    """Tokens of a block tag stored as offsets into the concatenated text of its text nodes.
+
+    Token i spans text[starts[i]:starts[i + 1]], lengths[i] is the length of its normalized text and punctuation[i]
+    indicates that punctuation should be added after it in the TTS text. Text nodes are added in document order,
+    node_ends[n] is the end token index of the n-th one.
+    """
+    __slots__ = ("_parts", "_text", "starts", "lengths", "punctuation", "node_ends")
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._text: Optional[str] = None
+        self.starts = array('I', [0])
+        self.lengths = array('I')
+        self.punctuation = bytearray()
+        self.node_ends = array('I')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add_text(self, text: str):
+        if not text:
+            # No tokens, but the node is still counted.
+            self.node_ends.append(len(self.lengths))
+            return
+
+        offset = self.starts[-1]
+        token_starts = [m.start() for m in TOKEN_PATTERN.finditer(text)]
+        lengths = [0] * len(token_starts)
+
+        # Words never cross token boundaries, so a single pass over the node attributes them to tokens.
+        ascii_only = text.isascii()
+        i = 0
+        for word in WORD_PATTERN.finditer(text):
+            while i + 1 < len(token_starts) and token_starts[i + 1] <= word.start():
+                i += 1
+            lengths[i] += word.end() - word.start() if ascii_only else len(word.group().lower())
+
+        self.starts.extend([offset + s for s in token_starts[1:]])
+        self.starts.append(offset + len(text))
+        self.lengths.extend(lengths)
+        self.punctuation.extend(bytes(len(lengths)))
+        self.node_ends.append(len(self.lengths))
+        self._parts.append(text)
+        self._text = None
+
+    def add_punctuation(self):
+        """Adds punctuation after the last token, if any."""
+        if len(self) > 0:
+            self.punctuation[-1] = 1
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self._parts)
+            self._parts = [self._text]
+        return self._text
+
+    def raw_text(self, start: int, end: Optional[int] = None) -> str:
+        """Returns the original text of tokens from start up to end (exclusive), or of a single token."""
+        end = start + 1 if end is None else end
+        return self.text[self.starts[start]:self.starts[end]]
+
+    def starts_with_whitespace(self, i: int) -> bool:
+        return self.text[self.starts[i]].isspace()
+
+    def ends_with_whitespace(self, i: int) -> bool:
+        return self.text[self.starts[i + 1] - 1].isspace()
+
+    def only_empty(self) -> bool:
+        text = self.text
+        return not text or text.isspace()
+
+    def tts_text(self, start: int, end: int) -> str:
+        """Returns the text of tokens from start up to end (exclusive) cleaned up for TTS.
+
+        Runs of tokens are cleaned up at once, tokens followed by punctuation are cleaned up on their own to keep
+        the same result as Token.tts_text.
+        """
+        parts = []
+        pos = start
+        while pos < end:
+            flagged = self.punctuation.find(1, pos, end)
+            if flagged < 0:
+                parts.append(Token._clean_for_tts(self.raw_text(pos, end)))
+                break
+
+            if flagged > pos:
+                parts.append(Token._clean_for_tts(self.raw_text(pos, flagged)))
+            parts.append(Token.with_punctuation(Token._clean_for_tts(self.raw_text(flagged))))
+            pos = flagged + 1
+        return "".join(parts)
+
+
 BLOCK_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'blockquote', 'div', 'table', 'th', 'td'}
 VOID_TAGS = {'br', 'img', 'hr', 'area', 'base', 'col', 'embed', 'input', 'link', 'meta', 'param', 'source', 'track',
              'wbr'}
 ENSURE_PUNCTUATION = {'br'}
 
 
-def tokenize_tag_content(tag: Tag) -> List[Token]:
-    all_tokens: List[Token] = []
+def tokenize_tag_content(tag: Tag) -> TokenTable:
+    tokens = TokenTable()
 
     def traverse(node):
         """Do an in-order depth-first traversal of the tag tree. Tokenize each string node."""
         if isinstance(node, str):
-            node_tokens = [Token(t) for t in tokenize_with_whitespace(node)]
-            all_tokens.extend(node_tokens)
+            tokens.add_text(node)
         elif node.name:
-            if node.name in ENSURE_PUNCTUATION and len(all_tokens) > 0:
-                all_tokens[-1].add_punctuation_in_tts = True
+            if node.name in ENSURE_PUNCTUATION:
+                tokens.add_punctuation()
 
             for child in node.contents:
                 traverse(child)
 
     traverse(tag)
-    return all_tokens
+    return tokens
 
 
-def split_tokens_into_fragments(tokens: List[Token], target_length: int = 75) -> List[List[Token]]:
-    if not tokens: return []
+def split_tokens_into_fragments(tokens: TokenTable, target_length: int = 75) -> List[Tuple[int, int]]:
+    """Splits tokens into fragments of roughly target_length. Returns token index ranges of the fragments."""
+    if len(tokens) == 0: return []
 
     fragments = []
-    total_len = sum([t.length for t in tokens])
+    total_len = sum(tokens.lengths)
     num_fragments = max(1, round(total_len / target_length))
-    if num_fragments == 1: return [tokens]
+    if num_fragments == 1: return [(0, len(tokens))]
 
     avg_len = total_len / num_fragments
 
     remaining_len = avg_len
-    current_fragment: List[Token] = []
-    for token in tokens:
+    fragment_start = 0
+    for i, length in enumerate(tokens.lengths):
         if remaining_len <= 0:
             # Only split fragments where there is whitespace between edge elements.
-            if current_fragment[-1].ends_with_whitespace() or token.starts_with_whitespace():
-                fragments.append(current_fragment)
-                current_fragment = []
+            if tokens.ends_with_whitespace(i - 1) or tokens.starts_with_whitespace(i):
+                fragments.append((fragment_start, i))
+                fragment_start = i
                 remaining_len += avg_len
 
-        current_fragment.append(token)
-        remaining_len -= token.length
-    if current_fragment:
-        fragments.append(current_fragment)
+        remaining_len -= length
+    fragments.append((fragment_start, len(tokens)))
     return fragments
 
 
@@ -85,7 +182,6 @@ class FragmentInjector:
     def __init__(self,
                  tag: Tag,
                  fragments: FragmentGroupsBuilder,
-                 visited_ids: Optional[Set[str]] = None,
                  target_length: int = 75):
         # Updated content of the tag to be concatenated.
         self.new_content = ["<body>"]
@@ -94,37 +190,36 @@ class FragmentInjector:
         self.fragments = fragments
         self.target_length = target_length
 
-        # TODO: make sure to push / pop IDs encountered during tag traversal.
-        self.visited_ids = visited_ids or set()
-
-        # Unprocessed tokens in the current fragment.
-        self.frag_q = deque[Token]()
-        # Unprocessed tokens in the current tag.
-        self.tag_q = deque[Token]()
+        # Tokens of the tag, shared by the splitting and the injection passes.
+        self.tokens = TokenTable()
+        # Index of the next token to be injected and of the next text node.
+        self.position = 0
+        self.node_index = 0
+        # End of the current fragment.
+        self.fragment_end = 0
 
-        self.pending_fragments: deque[List[Token]] = deque()
+        self.pending_fragments: deque[Tuple[int, int]] = deque()
         self.current_fragment = None
 
         self.open_tag_stack = []
 
     def inject(self):
         # Split the content into fragments.
-        tag_tokens = tokenize_tag_content(self.tag)
-        if self.only_empty(tag_tokens):
+        self.tokens = tokenize_tag_content(self.tag)
+        if self.tokens.only_empty():
             return
 
-        if tag_tokens:
-            # Assuming that injection only happens on block elements such as paragraph or div.
-            # Therefore, we want to ensure punctuation is present at the end to have an appropriate pause.
-            tag_tokens[-1].add_punctuation_in_tts = True
+        # Assuming that injection only happens on block elements such as paragraph or div.
+        # Therefore, we want to ensure punctuation is present at the end to have an appropriate pause.
+        self.tokens.add_punctuation()
 
         self.fragments.next_group()
 
-        if self._scene_break(tag_tokens):
-            self.fragments.add_pause(1, [])
+        if self._scene_break(self.tokens.text):
+            self.fragments.add_pause(1)
             return
 
-        self.pending_fragments.extend(split_tokens_into_fragments(tag_tokens, target_length=self.target_length))
+        self.pending_fragments.extend(split_tokens_into_fragments(self.tokens, target_length=self.target_length))
         expected_fragment_number = len(self.pending_fragments)
 
         for child in self.tag.contents:
@@ -144,23 +239,16 @@ class FragmentInjector:
         if new_soup.body:
             for child in list(new_soup.body.contents): self.tag.append(child)
 
-    def only_empty(self, tokens: List[Token]):
-        for t in tokens:
-            if not t._tts_text.isspace():
-                return False
-        return True
-
     @staticmethod
-    def _scene_break(tokens: List[Token]):
-        """Returns True if we consider tokens to represent a scene break.
+    def _scene_break(text: str):
+        """Returns True if we consider the text to represent a scene break.
         Usually it's a number of repetitive non-word characters."""
         char_dict = defaultdict[str, int](int)
         total_count = 0
-        for t in tokens:
-            for c in t.raw_text:
-                if c.isspace(): continue
-                char_dict[c] += 1
-                total_count += 1
+        for c in text:
+            if c.isspace(): continue
+            char_dict[c] += 1
+            total_count += 1
         # Check if all the characters are non word characters.
         if len(char_dict) > 0 and total_count > 0:
             for character, count in char_dict.items():
@@ -173,19 +261,15 @@ class FragmentInjector:
         self.open_fragment_if_needed()
 
         if isinstance(node, str):
-            node_tokens = [Token(t) for t in tokenize_with_whitespace(node)]
-            self.tag_q.extend(node_tokens)
-
-            while len(self.tag_q) > 0:
-                tag_tok = self.tag_q.popleft()
-                frag_tok = self.frag_q.popleft()
-                if tag_tok.normalized_text != frag_tok.normalized_text:
-                    # This should not be happening, because both fragments and these tokens are collected the same way.
-                    raise ValueError(f"Token mismatch: '{tag_tok}' != '{frag_tok}'")
+            node_end = self.tokens.node_ends[self.node_index]
+            self.node_index += 1
 
-                self.new_content.append(tag_tok.raw_text)
+            while self.position < node_end:
+                end = min(node_end, self.fragment_end)
+                self.new_content.append(self.tokens.raw_text(self.position, end))
+                self.position = end
 
-                if len(self.frag_q) == 0 and len(self.tag_q) > 0:
+                if self.position < node_end:
                     # End of the fragment is reached, but we have more content here, so open another one.
                     self.open_fragment_if_needed()
 
@@ -213,9 +297,8 @@ class FragmentInjector:
             raise RuntimeError("Unexpected node type")
 
     def open_fragment_if_needed(self):
-        if len(self.frag_q) == 0 and len(self.pending_fragments) > 0:
-            next_fragment = self.pending_fragments.popleft()
-            self.frag_q.extend(next_fragment)
+        if self.position == self.fragment_end and len(self.pending_fragments) > 0:
+            start, self.fragment_end = self.pending_fragments.popleft()
 
             # Close the current fragment, if present
             if self.current_fragment is not None:
@@ -223,7 +306,8 @@ class FragmentInjector:
                     self.new_content.append(f"</{t_name}>")
                 self.new_content.append(f"</span>")
 
-            added_fragment = self.fragments.add_tokens(next_fragment, list(self.visited_ids))
+            text = self.tokens.tts_text(start, self.fragment_end)
+            added_fragment = self.fragments.add_text(text)
             self.current_fragment = added_fragment
 
             # Open newly added fragment and re-open all tags.
@@ -233,23 +317,204 @@ class FragmentInjector:
                 self.new_content.append(f"<{t_name} {attr_str}>" if attr_str else f"<{t_name}>")
 
 
-def process_xhtml_inplace(file_bytes: bytes, global_id_start) -> Tuple[bytes, FragmentGroups, int]:
+def local_name(element: etree.ElementBase) -> str:
+    return etree.QName(element).localname
+
+
+def tokenize_element_content(element: etree.ElementBase) -> TokenTable:
+    """Same as tokenize_tag_content, but for lxml elements."""
+    tokens = TokenTable()
+
+    def add_text(text: Optional[str]):
+        if text:
+            tokens.add_text(text)
+
+    def traverse(node):
+        if not isinstance(node.tag, str):
+            # Comments and processing instructions are treated as text, the same way BeautifulSoup does.
+            add_text(node.text)
+            return
+
+        if local_name(node) in ENSURE_PUNCTUATION:
+            tokens.add_punctuation()
+
+        add_text(node.text)
+        for child in node:
+            traverse(child)
+            add_text(child.tail)
+
+    traverse(element)
+    return tokens
+
+
+class LxmlFragmentInjector:
+    """Injects the same fragment markup as FragmentInjector, but by manipulating the lxml element tree directly."""
+
+    def __init__(self,
+                 element: etree.ElementBase,
+                 fragments: FragmentGroupsBuilder,
+                 target_length: int = 75):
+        self.element = element
+        self.fragments = fragments
+        self.target_length = target_length
+
+        # Tokens of the element, shared by the splitting and the injection passes.
+        self.tokens = TokenTable()
+        # Index of the next token to be injected and of the next text node.
+        self.position = 0
+        self.node_index = 0
+        # End of the current fragment.
+        self.fragment_end = 0
+        self.pending_fragments: deque[Tuple[int, int]] = deque()
+
+        # Span of the current fragment.
+        self.current_span: Optional[etree.ElementBase] = None
+        # Pairs of the original elements open at the current position and their copies in the current fragment.
+        self.open_tag_stack: List[Tuple[etree.ElementBase, etree.ElementBase]] = []
+        # Text to be appended at the current position.
+        self.pending_text: List[str] = []
+
+    def inject(self):
+        self.tokens = tokenize_element_content(self.element)
+        if self.tokens.only_empty():
+            return
+
+        # Assuming that injection only happens on block elements such as paragraph or div.
+        # Therefore, we want to ensure punctuation is present at the end to have an appropriate pause.
+        self.tokens.add_punctuation()
+
+        self.fragments.next_group()
+
+        if FragmentInjector._scene_break(self.tokens.text):
+            self.fragments.add_pause(1)
+            return
+
+        self.pending_fragments.extend(split_tokens_into_fragments(self.tokens, target_length=self.target_length))
+        expected_fragment_number = len(self.pending_fragments)
+
+        # Detach the original content and rebuild it wrapped into fragment spans.
+        text = self.element.text
+        children = list(self.element)
+        self.element.text = None
+        for child in children:
+            self.element.remove(child)
+
+        self.traverse_text(text)
+        for child in children:
+            self.traverse(child)
+            self.traverse_text(child.tail)
+        self.flush_text()
+
+        # Temporary sanity check if the number of fragments in the current group matches the number of pending fragments
+        actual_fragment_number = self.fragments.current_group_size()
+        if actual_fragment_number != expected_fragment_number:
+            LOG.warning("Expected %d fragments, but got %d", expected_fragment_number, actual_fragment_number)
+
+    def traverse_text(self, text: Optional[str]):
+        if not text:
+            return
+        self.open_fragment_if_needed()
+
+        node_end = self.tokens.node_ends[self.node_index]
+        self.node_index += 1
+
+        while self.position < node_end:
+            end = min(node_end, self.fragment_end)
+            self.pending_text.append(self.tokens.raw_text(self.position, end))
+            self.position = end
+
+            if self.position < node_end:
+                # End of the fragment is reached, but we have more content here, so open another one.
+                self.open_fragment_if_needed()
+
+    def traverse(self, node: etree.ElementBase):
+        if not isinstance(node.tag, str):
+            # Comments and processing instructions are treated as text, the same way BeautifulSoup does.
+            self.traverse_text(node.text)
+            return
+
+        self.open_fragment_if_needed()
+        self.flush_text()
+
+        copy = etree.SubElement(self.cursor(), node.tag, attrib=dict(node.attrib))
+        if local_name(node) in VOID_TAGS:
+            return
+
+        self.open_tag_stack.append((node, copy))
+        self.traverse_text(node.text)
+        for child in node:
+            self.traverse(child)
+            self.traverse_text(child.tail)
+        self.flush_text()
+        self.open_tag_stack.pop()
+
+    def cursor(self) -> etree.ElementBase:
+        """Returns the element where the content goes at the current position."""
+        return self.open_tag_stack[-1][1] if self.open_tag_stack else self.current_span
+
+    def flush_text(self):
+        if not self.pending_text:
+            return
+
+        text = "".join(self.pending_text)
+        self.pending_text = []
+
+        cursor = self.cursor()
+        if len(cursor) > 0:
+            cursor[-1].tail = (cursor[-1].tail or "") + text
+        else:
+            cursor.text = (cursor.text or "") + text
+
+    def open_fragment_if_needed(self):
+        if self.position == self.fragment_end and len(self.pending_fragments) > 0:
+            self.flush_text()
+
+            start, self.fragment_end = self.pending_fragments.popleft()
+            text = self.tokens.tts_text(start, self.fragment_end)
+            added_fragment = self.fragments.add_text(text)
+
+            # Open newly added fragment and re-open all tags.
+            span_tag = etree.QName(etree.QName(self.element).namespace, "span")
+            self.current_span = etree.SubElement(self.element, span_tag)
+            self.current_span.set("class", "nf")
+            self.current_span.set("id", added_fragment.formatted_id())
+            parent = self.current_span
+            for i, (original, _) in enumerate(self.open_tag_stack):
+                parent = etree.SubElement(parent, original.tag, attrib=dict(original.attrib))
+                self.open_tag_stack[i] = (original, parent)
+
+
+# Fragment injector implementation used by default, either "soup" or "lxml".
+FRAGMENT_INJECTOR = os.getenv("FRAGMENT_INJECTOR", "soup")
+
+
+def process_xhtml_inplace(file_bytes: bytes,
+                          global_id_start: int = 0,
+                          injector: Optional[str] = None) -> Tuple[bytes, FragmentGroups, int]:
+    injector = injector or FRAGMENT_INJECTOR
+    if injector == "soup":
+        return _process_xhtml_soup(file_bytes, global_id_start)
+    elif injector == "lxml":
+        return _process_xhtml_lxml(file_bytes, global_id_start)
+    else:
+        raise ValueError(f"Unknown fragment injector: {injector}")
+
+
+def _process_xhtml_soup(file_bytes: bytes, global_id_start: int) -> Tuple[bytes, FragmentGroups, int]:
     try:
         soup = BeautifulSoup(file_bytes, 'xml')
 
         fragments = FragmentGroupsBuilder(current_id=global_id_start)
 
-        visited_ids = set()
         for tag in soup.find_all():
             if tag.get("id"):
-                tag_id: str = str(tag.get("id"))
-                visited_ids.add(tag_id)
+                fragments.add_anchor(str(tag.get("id")))
 
             if tag.name not in BLOCK_TAGS: continue
             if tag.find(BLOCK_TAGS): continue
 
             # TODO: This is where a fragment group (paragraph) starts.
-            injector = FragmentInjector(tag, fragments, visited_ids)
+            injector = FragmentInjector(tag, fragments)
             injector.inject()
 
     except Exception as e:
@@ -257,3 +522,56 @@ def process_xhtml_inplace(file_bytes: bytes, global_id_start) -> Tuple[bytes, Fr
         raise e
 
     return soup.encode(formatter="minimal", encoding='utf-8'), fragments.build(), fragments.current_id
+
+
+def _process_xhtml_lxml(file_bytes: bytes, global_id_start: int) -> Tuple[bytes, FragmentGroups, int]:
+    try:
+        # Same parser settings as BeautifulSoup uses for 'xml'.
+        root = etree.fromstring(file_bytes, etree.XMLParser(recover=True))
+
+        fragments = FragmentGroupsBuilder(current_id=global_id_start)
+
+        # Take a snapshot, the tree is modified during the iteration.
+        for element in list(root.iter()):
+            if not isinstance(element.tag, str): continue
+
+            if element.get("id"):
+                fragments.add_anchor(element.get("id"))
+
+            if local_name(element) not in BLOCK_TAGS: continue
+            if any(local_name(d) in BLOCK_TAGS for d in element.iterdescendants() if isinstance(d.tag, str)): continue
+
+            injector = LxmlFragmentInjector(element, fragments)
+            injector.inject()
+
+    except Exception as e:
+        LOG.error("Failed to fragment the content: %s", e, exc_info=True)
+        raise e
+
+    file_bytes = etree.tostring(root.getroottree(), encoding="utf-8", xml_declaration=True)
+    return file_bytes, fragments.build(), fragments.current_id
+
+
+# Fragment markup as serialized by both injectors. BeautifulSoup always outputs attributes in alphabetical order.
+FRAGMENT_SPAN_PATTERN = re.compile(rb'(<span class="nf" id=")(n-\d+)(")')
+
+
+def renumber_fragments(file_bytes: bytes, fragments: FragmentGroups, offset: int) -> bytes:
+    """Shifts IDs of the fragments and of the corresponding markup by the given offset.
+
+    Allows fragmenting content files independently, each starting from 0, and making IDs globally unique afterwards.
+    """
+    if offset == 0:
+        return file_bytes
+
+    old_ids = [frag.formatted_id().encode() for frag in fragments.flatten()]
+    fragments.shift_ids(offset)
+    new_ids = dict(zip(old_ids, [frag.formatted_id().encode() for frag in fragments.flatten()]))
+
+    def replace(match: re.Match) -> bytes:
+        new_id = new_ids.get(match.group(2))
+        if new_id is None:
+            raise ValueError(f"Unknown fragment id in markup: {match.group(2).decode()}")
+        return match.group(1) + new_id + match.group(3)
+
+    return FRAGMENT_SPAN_PATTERN.sub(replace, file_bytes)
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from typing import IO, Callable, Optional
+
+from blake3 import blake3
+
+# Maximum size of an uploaded file.
+MAX_UPLOAD_SIZE_BYTES = 15 * 1024 * 1024
+# Uploads bigger than this are spooled to disk.
+MAX_IN_MEMORY_SIZE_BYTES = 1024 * 1024
+CHUNK_SIZE_BYTES = 256 * 1024
+
+
+class UploadTooLarge(ValueError):
+    def __init__(self, max_size_bytes: int):
+        super().__init__(f"Uploaded file exceeds {max_size_bytes} bytes.")
+
+
+@dataclass
+class SpooledUpload:
+    # Content of the upload, rewound to the start.
+    file: IO[bytes]
+    size_bytes: int
+    # blake3 hash of the content.
+    file_hash: str
+
+
+def spool_upload(stream: IO[bytes],
+                 max_size_bytes: int = MAX_UPLOAD_SIZE_BYTES,
+                 chunk_consumer: Optional[Callable[[bytes], None]] = None) -> SpooledUpload:
+    """Reads the stream in chunks into a spooled temporary file, hashing the content along the way.
+
+    Raises UploadTooLarge as soon as more than `max_size_bytes` is read. Each chunk is also passed to
+    `chunk_consumer`, if given, e.g. to upload the content to the object store while reading it.
+    """
+    spooled_file = SpooledTemporaryFile(max_size=MAX_IN_MEMORY_SIZE_BYTES)
+    hasher = blake3()
+    size_bytes = 0
+    try:
+        while chunk := stream.read(CHUNK_SIZE_BYTES):
+            size_bytes += len(chunk)
+            if size_bytes > max_size_bytes:
+                raise UploadTooLarge(max_size_bytes)
+
+            hasher.update(chunk)
+            spooled_file.write(chunk)
+            if chunk_consumer is not None:
+                chunk_consumer(chunk)
+    except:
+        spooled_file.close()
+        raise
+
+    spooled_file.seek(0)
+    return SpooledUpload(file=spooled_file, size_bytes=size_bytes, file_hash=hasher.hexdigest())
@@ -0,0 +1,329 @@
+"""Benchmarks the stages of book ingestion against a corpus of EPUB files.
+
+The real BookService._ingest_book is run with S3 replaced by an in-memory client. It doesn't touch the database, so
+only the processing cost is measured, including the work offloaded to the process pool and the cover derivatives.
+Each stage is timed (wall and CPU time) over several rounds keeping the best result, then peak allocated memory of
+each stage is measured with tracemalloc in a separate round, because tracing slows down the code considerably.
+
+The stages are timed by wrapping the methods called by the ingestion. remove_links and inline_fragments only register
+transforms of the archive entries, which are applied when the entries are rendered: by inline_fragments for the
+content files, and by write for the rest.
+
+CPU time includes the pool worker processes, but it's only known once they exit. Every ingestion gets its own pool,
+shut down at the end of the "ingest" stage, so the CPU time of the fragmentation and of the cover derivatives is counted
+there, and the cpu_s of inline_fragments excludes the workers. tracemalloc only sees the main process, so the memory
+round runs the work of the pool in-process instead, and peak_bytes of inline_fragments includes the fragmentation.
+
+Usage:
+    python -m scripts.benchmark_ingestion run [--corpus PATH ...] [--rounds N] [--output results.json]
+    python -m scripts.benchmark_ingestion compare base.json new.json [--threshold 0.1]
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, UTC
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Callable, Optional
+from unittest import mock
+
+from api.services import books
+from api.services.books import BookService, INGESTION_WORKERS
+from api.services.epub import EpubService
+from api.services.files import FilesService
+from api.utils.upload import spool_upload
+from epub_lib import Epub, EpubRewriter
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CORPUS = Path(__file__).parents[2] / "epub-lib" / "tests" / "test_data"
+
+STAGES = [
+    "upload",
+    "epub",
+    "remove_links",
+    "inline_fragments",
+    "get_publication_content",
+    "build_narration_manifest",
+    "add_manifest_item",
+    "write",
+    "upload_results",
+    "ingest",
+]
+
+# Changes smaller than this are considered noise regardless of the relative threshold.
+MIN_WALL_DELTA_S = 0.005
+MIN_PEAK_DELTA_BYTES = 256 * 1024
+
+
+class InMemoryS3Client:
+    """Implements the subset of the S3 client used by the ingestion, keeping the objects in memory."""
+
+    def __init__(self):
+        self.objects: Dict[str, bytes] = {}
+        self._uploads: Dict[str, List[bytes]] = {}
+
+    def put_object(self, Body: bytes, Key: str, **kwargs):
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.getvalue()
+
+    def get_object(self, Key: str, **kwargs):
+        return {"Body": BytesIO(self.objects[Key])}
+
+    def create_multipart_upload(self, Key: str, **kwargs):
+        self._uploads[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Body: bytes, UploadId: str, PartNumber: int, **kwargs):
+        self._uploads[UploadId].append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Key: str, UploadId: str, **kwargs):
+        self.objects[Key] = b"".join(self._uploads.pop(UploadId))
+
+    def abort_multipart_upload(self, UploadId: str, **kwargs):
+        self._uploads.pop(UploadId, None)
+
+
+class StageRecorder:
+    """Records wall time, CPU time and optionally peak allocated memory of each stage.
+
+    A stage entered several times, like an upload, accumulates the time of all of them. Stages may be nested, the peak
+    of an outer stage includes the peaks of the stages within it.
+    """
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results: Dict[str, dict] = {}
+        # Highest traced memory seen so far by each of the stages in progress, outermost first.
+        self._open_peaks: List[List[int]] = []
+
+    def _record_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for open_peak in self._open_peaks:
+            open_peak[0] = max(open_peak[0], peak)
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            # Resetting the peak loses it for the outer stages, so it's recorded for them first.
+            self._record_peak()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            stage_peak = [start_memory]
+            self._open_peaks.append(stage_peak)
+        start_wall = time.perf_counter()
+        start_cpu = self._cpu_time()
+        yield
+        result = {
+            "wall_s": time.perf_counter() - start_wall,
+            "cpu_s": self._cpu_time() - start_cpu,
+        }
+        if self.trace_memory:
+            self._record_peak()
+            self._open_peaks.pop()
+            result["peak_bytes"] = stage_peak[0] - start_memory
+        previous = self.results.get(name)
+        if previous is not None:
+            result = {k: max(v, previous[k]) if k == "peak_bytes" else v + previous[k] for k, v in result.items()}
+        self.results[name] = result
+
+    @staticmethod
+    def _cpu_time() -> float:
+        """CPU time of this process and of its terminated child processes."""
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    def timed(self, name: str, method: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return method(*args, **kwargs)
+
+        return wrapper
+
+
+class InProcessExecutor(Executor):
+    """Runs the submitted calls right away in the calling process."""
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def ingest(file_bytes: bytes, file_name: str, book_service: BookService, recorder: StageRecorder):
+    """Uploads the source file the same way BookService.create_book does and runs BookService._ingest_book.
+
+    The work of the process pool runs in-process while memory is traced.
+    """
+    s3_client = InMemoryS3Client()
+    files_service = book_service.files_service
+    files_service.s3_client = s3_client
+    book_id = uuid.uuid4()
+
+    with recorder.stage("upload"):
+        with files_service.multipart_upload(f"{book_id}/epub-files/source.epub") as source_upload:
+            spool_upload(BytesIO(file_bytes), chunk_consumer=source_upload.write)
+
+    # The sub-stages are timed by wrapping the methods of the service instances.
+    epub_service = book_service.epub_service
+    for name in ["remove_links", "inline_fragments", "build_narration_manifest"]:
+        setattr(epub_service, name, recorder.timed(name, getattr(EpubService, name).__get__(epub_service)))
+    files_service.upload_file = recorder.timed("upload_results", FilesService.upload_file.__get__(files_service))
+
+    if recorder.trace_memory:
+        pool = InProcessExecutor()
+    else:
+        # A pool of its own, warmed up beforehand, so the CPU time of its workers is known once it's shut down.
+        pool = ProcessPoolExecutor(max_workers=INGESTION_WORKERS)
+        wait([pool.submit(time.sleep, 0.1) for _ in range(INGESTION_WORKERS)])
+
+    with ExitStack() as patches:
+        patches.enter_context(mock.patch.object(books, "executor", pool))
+        patches.enter_context(mock.patch.object(books, "Epub", recorder.timed("epub", Epub)))
+        for cls, name in [(Epub, "get_publication_content"), (EpubRewriter, "add_manifest_item"),
+                          (EpubRewriter, "write")]:
+            patches.enter_context(mock.patch.object(cls, name, recorder.timed(name, getattr(cls, name))))
+        try:
+            with recorder.stage("ingest"):
+                book_service._ingest_book(book_id, file_name)
+                pool.shutdown(wait=True)
+        finally:
+            pool.shutdown(wait=True)
+
+
+def find_books(paths: List[Path]) -> List[Path]:
+    books = []
+    for path in paths:
+        books.extend(sorted(path.rglob("*.epub")) if path.is_dir() else [path])
+    return books
+
+
+def run(paths: List[Path], rounds: int) -> dict:
+    epub_service = EpubService.instance or EpubService()
+    files_service = FilesService.instance or FilesService()
+    book_service = BookService.instance or BookService(files_service, None, epub_service, None, None)
+
+    results = {}
+    for book in find_books(paths):
+        LOG.info("Benchmarking %s...", book.name)
+        file_bytes = book.read_bytes()
+
+        best: Dict[str, dict] = {}
+        for _ in range(rounds):
+            recorder = StageRecorder(trace_memory=False)
+            ingest(file_bytes, book.name, book_service, recorder)
+            for stage, result in recorder.results.items():
+                if stage not in best:
+                    best[stage] = result
+                else:
+                    best[stage] = {k: min(v, result[k]) for k, v in best[stage].items()}
+
+        recorder = StageRecorder(trace_memory=True)
+        tracemalloc.start()
+        try:
+            ingest(file_bytes, book.name, book_service, recorder)
+        finally:
+            tracemalloc.stop()
+        for stage, result in recorder.results.items():
+            best[stage]["peak_bytes"] = result["peak_bytes"]
+
+        results[book.name] = {
+            "size_bytes": len(file_bytes),
+            "stages": {stage: best[stage] for stage in STAGES if stage in best},
+        }
+
+    return {
+        "created": datetime.now(UTC).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rounds": rounds,
+        "books": results,
+    }
+
+
+def compare(base: dict, new: dict, threshold: float) -> List[str]:
+    """Prints changes between two runs. Returns the list of regressions."""
+    metrics: Dict[str, Callable[[float, float], bool]] = {
+        "wall_s": lambda b, n: n - b > MIN_WALL_DELTA_S,
+        "cpu_s": lambda b, n: n - b > MIN_WALL_DELTA_S,
+        "peak_bytes": lambda b, n: n - b > MIN_PEAK_DELTA_BYTES,
+    }
+
+    regressions = []
+    print(f"{'book':<40} {'stage':<26} {'metric':<10} {'base':>12} {'new':>12} {'change':>8}")
+    for book, new_book in new["books"].items():
+        base_book = base["books"].get(book)
+        if base_book is None:
+            print(f"{book:<40} missing in the base run, skipping.")
+            continue
+
+        for stage, new_stage in new_book["stages"].items():
+            base_stage = base_book["stages"].get(stage)
+            if base_stage is None:
+                continue
+
+            for metric, significant in metrics.items():
+                base_value, new_value = base_stage.get(metric), new_stage.get(metric)
+                if base_value is None or new_value is None:
+                    continue
+
+                change = (new_value - base_value) / base_value if base_value else 0.0
+                regressed = change > threshold and significant(base_value, new_value)
+                flag = " REGRESSION" if regressed else ""
+                print(f"{book[:40]:<40} {stage:<26} {metric:<10} {base_value:>12.4g} {new_value:>12.4g} "
+                      f"{change:>+8.1%}{flag}")
+                if regressed:
+                    regressions.append(f"{book} {stage} {metric}: {base_value:.4g} -> {new_value:.4g} ({change:+.1%})")
+
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark of the book ingestion stages.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Benchmark ingestion of the corpus.")
+    run_parser.add_argument("--corpus", type=Path, nargs="+", default=[DEFAULT_CORPUS],
+                            help="EPUB files or directories to search for them.")
+    run_parser.add_argument("--rounds", type=int, default=3, help="Number of timed rounds per book.")
+    run_parser.add_argument("--output", type=Path, help="File to write JSON results to, stdout by default.")
+
+    compare_parser = commands.add_parser("compare", help="Compare results of two runs.")
+    compare_parser.add_argument("base", type=Path)
+    compare_parser.add_argument("new", type=Path)
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="Relative increase considered a regression.")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        results = json.dumps(run(args.corpus, args.rounds), indent=2)
+        if args.output:
+            args.output.write_text(results)
+        else:
+            print(results)
+        return 0
+
+    regressions = compare(json.loads(args.base.read_text()), json.loads(args.new.read_text()), args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s):")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # Debug logging of the services would dominate the measurements.
+    logging.getLogger().setLevel(logging.INFO)
+    sys.exit(main())
@@ -1,8 +1,41 @@
 import uuid
+from io import BytesIO
+from pathlib import Path
+from contextlib import nullcontext
+from types import SimpleNamespace
 
-from api.services.books import BookService
+import pytest
+from sqlalchemy.dialects import postgresql
 
-books_service = BookService(None, None, None)
+from api.models import db
+from api.services.books import BookService, MAX_INGESTION_ATTEMPTS
+from api.services.epub import EpubService
+from common_lib.models import rmq
+from epub_lib import Epub
+
+books_service = BookService(None, None, None, None, None)
+
+TEST_BOOKS = Path(__file__).parents[3] / "epub-lib" / "tests" / "test_data"
+
+
+class InMemoryFilesService:
+    def __init__(self):
+        self.files = {}
+
+    def multipart_upload(self, key: str):
+        files = self.files
+
+        class Upload(BytesIO):
+            def __exit__(self, *args):
+                files[key] = self.getvalue()
+
+        return Upload()
+
+    def upload_file(self, key: str, body):
+        self.files[key] = body if isinstance(body, bytes) else body.getvalue()
+
+    def get_book_file(self, book_id, file_name) -> BytesIO:
+        return BytesIO(self.files[f"{book_id}/{file_name}"])
 
 
 class TestBooksService:
@@ -12,3 +45,133 @@ class TestBooksService:
         playlist = books_service._generate_master_playlist(id, "kokoro", "am_michael")
         print()
         print(playlist)
+
+    def test_resolve_file_key(self, monkeypatch):
+        book_id = uuid.uuid4()
+        content_id = uuid.uuid4()
+        content_ids = {book_id: content_id, content_id: content_id}
+        monkeypatch.setattr(books_service, "get_content_id", content_ids.get)
+
+        # Files derived from the content are shared.
+        assert books_service.resolve_file_key(f"{book_id}/playlists/master.m3u8") == \
+               f"{content_id}/playlists/master.m3u8"
+        assert books_service.resolve_file_key(f"{book_id}/epub-files/fragmented.epub") == \
+               f"{content_id}/epub-files/fragmented.epub"
+        # Images are kept per book.
+        assert books_service.resolve_file_key(f"{book_id}/images/covers/cover.png") == \
+               f"{book_id}/images/covers/cover.png"
+        assert books_service.resolve_file_key(f"{content_id}/playlists/master.m3u8") == \
+               f"{content_id}/playlists/master.m3u8"
+        # Unknown books and keys not starting with a book ID are left as is.
+        other_id = uuid.uuid4()
+        assert books_service.resolve_file_key(f"{other_id}/narration-manifest.json") == \
+               f"{other_id}/narration-manifest.json"
+        assert books_service.resolve_file_key("covers/gray.png") == "covers/gray.png"
+
+    def test_ingest_book(self):
+        book_id = uuid.uuid4()
+        files_service = InMemoryFilesService()
+        files_service.upload_file(f"{book_id}/epub-files/source.epub",
+                                  (TEST_BOOKS / "Dungeon_Crawler_Carl.epub").read_bytes())
+        books_service.files_service = files_service
+        books_service.epub_service = EpubService.instance or EpubService()
+
+        cover_thumbnail_path = books_service._ingest_book(book_id, "Dungeon_Crawler_Carl.epub")
+
+        assert cover_thumbnail_path == f"/api/files/{book_id}/covers/cover.webp"
+        assert f"{book_id}/covers/cover.webp" in files_service.files
+        assert f"{book_id}/covers/thumbnail.webp" in files_service.files
+        assert f"{book_id}/narration-manifest.json" in files_service.files
+        assert f"{book_id}/narration-manifest.bin" in files_service.files
+        fragmented_epub = Epub(files_service.get_book_file(book_id, "epub-files/fragmented.epub"))
+        assert "fragment-map" in fragmented_epub.manifest_item_dict
+
+    def _patch_ingestion(self, monkeypatch, attempt: int, ingest):
+        book_id = uuid.uuid4()
+        calls = {"completed": [], "failed": []}
+        overview = SimpleNamespace(id=book_id, status=db.BookStatus.processing, pdf_file_name="book.epub")
+        monkeypatch.setattr(books_service, "get_book_overview", lambda _: overview)
+        monkeypatch.setattr(books_service, "_start_ingestion", lambda _: attempt)
+        monkeypatch.setattr(books_service, "_ingest_book", ingest)
+        monkeypatch.setattr(books_service, "_complete_ingestion", lambda *args: calls["completed"].append(args))
+        monkeypatch.setattr(books_service, "_fail_ingestion", lambda *args: calls["failed"].append(args))
+        return book_id, calls
+
+    def test_handle_ingest_msg(self, monkeypatch):
+        book_id, calls = self._patch_ingestion(monkeypatch, 1, lambda *args: "cover.jpg")
+
+        books_service.handle_ingest_msg(rmq.IngestRequest(book_id=book_id))
+        assert calls == {"completed": [(book_id, "cover.jpg")], "failed": []}
+
+    def test_handle_ingest_msg_retries(self, monkeypatch):
+        def fail(*args):
+            raise ValueError("Broken EPUB")
+
+        # The message is rejected to be delivered again, while there are attempts left.
+        book_id, calls = self._patch_ingestion(monkeypatch, MAX_INGESTION_ATTEMPTS - 1, fail)
+        with pytest.raises(ValueError):
+            books_service.handle_ingest_msg(rmq.IngestRequest(book_id=book_id))
+        assert calls == {"completed": [], "failed": []}
+
+        # Then the book is marked as failed.
+        book_id, calls = self._patch_ingestion(monkeypatch, MAX_INGESTION_ATTEMPTS, fail)
+        books_service.handle_ingest_msg(rmq.IngestRequest(book_id=book_id))
+        assert calls == {"completed": [], "failed": [(book_id, "Broken EPUB")]}
+
+
+    def test_create_book_uploads_new_files_only(self, monkeypatch):
+        files_service = InMemoryFilesService()
+        published = []
+        monkeypatch.setattr(books_service, "files_service", files_service)
+        rmq_client = SimpleNamespace(publish=lambda key, msg: published.append(msg))
+        monkeypatch.setattr(books_service, "rmq_client", rmq_client)
+        content = (TEST_BOOKS / "Dungeon_Crawler_Carl.epub").read_bytes()
+
+        def insert_book(status):
+            return lambda book_id, *args: SimpleNamespace(id=book_id, status=status)
+
+        # A file that's already ingested is never uploaded.
+        monkeypatch.setattr(books_service, "_insert_book", insert_book(db.BookStatus.ready_for_toc_review))
+        books_service.create_book(uuid.uuid4(), "book.epub", BytesIO(content))
+        assert files_service.files == {}
+        assert published == []
+
+        # A new one is uploaded and then ingested.
+        monkeypatch.setattr(books_service, "_insert_book", insert_book(db.BookStatus.processing))
+        book = books_service.create_book(uuid.uuid4(), "book.epub", BytesIO(content))
+        assert files_service.files == {f"{book.id}/epub-files/source.epub": content}
+        assert [msg.book_id for msg in published] == [book.id]
+
+    def test_get_content_id(self, monkeypatch):
+        book_id = uuid.uuid4()
+        content_id = uuid.uuid4()
+        loaded = []
+
+        def load_content_id(requested_id):
+            loaded.append(requested_id)
+            return content_id if requested_id == book_id else None
+
+        monkeypatch.setattr(books_service, "_load_content_id", load_content_id)
+
+        assert books_service.get_content_id(book_id) == content_id
+        assert books_service.get_content_id(book_id) == content_id
+        # Unknown books are not cached, they might be created later.
+        other_id = uuid.uuid4()
+        assert books_service.get_content_id(other_id) is None
+        assert books_service.get_content_id(other_id) is None
+        assert loaded == [book_id, other_id, other_id]
+
+    def test_find_ingested_book_skips_failed_ingestions(self, monkeypatch):
+        statements = []
+        session = SimpleNamespace(begin_nested=nullcontext,
+                                  scalars=lambda stmt: statements.append(stmt) or SimpleNamespace(first=lambda: None))
+        db_factory = SimpleNamespace(context=SimpleNamespace(get=lambda: session),
+                                     current_session=lambda: session)
+        monkeypatch.setattr(books_service, "_db_factory", db_factory)
+
+        # A duplicate of a file whose ingestion failed is ingested again, there is no content to share.
+        assert books_service._find_ingested_book("hash") is None
+        sql = str(statements[0].compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+        assert "'ready_for_toc_review'" in sql
+        assert "'failed'" not in sql
+        assert "'processing'" not in sql
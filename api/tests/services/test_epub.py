@@ -1,4 +1,5 @@
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 
 import json
 import logging
@@ -9,15 +10,57 @@ from pathlib import Path
 import pytest
 
 from api.services.epub import EpubService
-from epub_lib import Epub
+from common_lib.models.tts import TextFragment
+from epub_lib import Epub, EpubRewriter
 
 LOG = logging.getLogger(__name__)
 
 svc = EpubService()
 
 
+TEST_BOOKS = Path(__file__).parents[3] / "epub-lib" / "tests" / "test_data"
+
+
 class TestEpubService:
 
+    def test_parallel_inline_fragments(self):
+        serial_rewriter = EpubRewriter(Epub(TEST_BOOKS / "Swing_Shift_3.epub"))
+        serial_fragment_map = svc.inline_fragments(serial_rewriter)
+
+        parallel_rewriter = EpubRewriter(Epub(TEST_BOOKS / "Swing_Shift_3.epub"))
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            parallel_fragment_map = svc.inline_fragments(parallel_rewriter, executor)
+
+        assert list(parallel_fragment_map.keys()) == list(serial_fragment_map.keys())
+        for file, fragments in serial_fragment_map.items():
+            assert parallel_fragment_map[file] == fragments
+            assert parallel_rewriter.render(file) == serial_rewriter.render(file)
+
+        fragment_ids = [f.id for groups in parallel_fragment_map.values() for f in groups.flatten()]
+        assert fragment_ids == list(range(len(fragment_ids)))
+
+    def test_single_pass_rewrite(self):
+        epub = Epub(TEST_BOOKS / "Dungeon_Crawler_Carl.epub")
+        rewriter = EpubRewriter(epub)
+        svc.remove_links(rewriter)
+        fragment_map = svc.inline_fragments(rewriter)
+
+        narration_manifest = svc.build_narration_manifest(epub.get_publication_content(), fragment_map)
+        rewriter.add_manifest_item(id="fragment-map", href="fragment-map.json", media_type="application/json",
+                                   body=json.dumps(narration_manifest.to_fragment_map()))
+        out_epub = Epub(rewriter.write())
+
+        assert out_epub.zip_file.testzip() is None
+        assert set(out_epub.get_spine_files()) == set(fragment_map.keys())
+        fragment_ids = [f.formatted_id() for groups in fragment_map.values() for f in groups.flatten()]
+        assert len(fragment_ids) > 0
+        for content_file in out_epub.get_spine_files():
+            content = out_epub._read_file(content_file).decode()
+            for fragment in fragment_map[content_file].flatten():
+                if isinstance(fragment, TextFragment):
+                    assert f'id="{fragment.formatted_id()}"' in content
+        assert json.loads(out_epub._read_file(out_epub._resource_path("fragment-map.json")))
+
     @pytest.mark.skip(reason="For manual execution.")
     def test_remove_links(self):
         src_dir_path = os.path.expanduser("~/Downloads/epub/")
@@ -27,9 +70,9 @@ class TestEpubService:
         for epub_path in epub_files:
             LOG.info("Processing: %s", epub_path)
 
-            file_bytes = BytesIO(epub_path.read_bytes())
-
-            clean_epub = svc.remove_links(file_bytes)
+            rewriter = EpubRewriter(Epub(BytesIO(epub_path.read_bytes())))
+            svc.remove_links(rewriter)
+            clean_epub = rewriter.write()
 
             file_name = dest_dir_path.joinpath(epub_path.stem + "_clean.epub")
             with open(file_name, "wb") as f:
@@ -45,9 +88,10 @@ class TestEpubService:
         for epub_path in epub_files:
             LOG.info("Processing: %s", epub_path)
 
-            file_bytes = BytesIO(epub_path.read_bytes())
-            clean_epub = svc.remove_links(file_bytes)
-            epub_with_fragments, fragments = svc.inline_fragments(clean_epub)
+            rewriter = EpubRewriter(Epub(BytesIO(epub_path.read_bytes())))
+            svc.remove_links(rewriter)
+            fragments = svc.inline_fragments(rewriter)
+            epub_with_fragments = rewriter.write()
 
             epub_file_name = dest_dir_path.joinpath(epub_path.stem + "_updated.epub")
             with open(epub_file_name, "wb") as f:
@@ -70,10 +114,10 @@ class TestEpubService:
         for epub_path in epub_files:
             LOG.info("Processing: %s", epub_path)
 
-            file_bytes = BytesIO(epub_path.read_bytes())
-            clean_epub = svc.remove_links(file_bytes)
-
-            epub_with_fragments, fragments = svc.inline_fragments(clean_epub)
+            rewriter = EpubRewriter(Epub(BytesIO(epub_path.read_bytes())))
+            svc.remove_links(rewriter)
+            fragments = svc.inline_fragments(rewriter)
+            epub_with_fragments = rewriter.write()
             epub_file_name = dest_dir_path.joinpath(epub_path.stem + "_updated.epub")
             with open(epub_file_name, "wb") as f:
                 f.write(epub_with_fragments.getvalue())
@@ -0,0 +1,60 @@
+import pytest
+
+from api.services.files import MultipartUpload
+
+
+class RecordingS3Client:
+    def __init__(self):
+        self.calls = []
+
+    def put_object(self, **kwargs):
+        self.calls.append(("put_object", kwargs))
+
+    def create_multipart_upload(self, **kwargs):
+        self.calls.append(("create_multipart_upload", kwargs))
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, **kwargs):
+        self.calls.append(("upload_part", kwargs))
+        return {"ETag": f"etag-{kwargs['PartNumber']}"}
+
+    def complete_multipart_upload(self, **kwargs):
+        self.calls.append(("complete_multipart_upload", kwargs))
+
+    def abort_multipart_upload(self, **kwargs):
+        self.calls.append(("abort_multipart_upload", kwargs))
+
+    def call_names(self):
+        return [name for name, _ in self.calls]
+
+
+class TestMultipartUpload:
+    def test_small_object_single_put(self):
+        s3_client = RecordingS3Client()
+        with MultipartUpload(s3_client, "bucket", "key.epub", "application/epub+zip") as upload:
+            upload.write(b"small")
+
+        assert s3_client.call_names() == ["put_object"]
+        assert s3_client.calls[0][1]["Body"] == b"small"
+
+    def test_large_object_in_parts(self):
+        s3_client = RecordingS3Client()
+        part = b"0" * MultipartUpload.MIN_PART_SIZE_BYTES
+        with MultipartUpload(s3_client, "bucket", "key.epub", "application/epub+zip") as upload:
+            upload.write(part)
+            upload.write(b"tail")
+
+        assert s3_client.call_names() == ["create_multipart_upload", "upload_part", "upload_part",
+                                          "complete_multipart_upload"]
+        assert s3_client.calls[2][1]["Body"] == b"tail"
+        assert s3_client.calls[3][1]["MultipartUpload"] == {
+            "Parts": [{"ETag": "etag-1", "PartNumber": 1}, {"ETag": "etag-2", "PartNumber": 2}]}
+
+    def test_abort_on_error(self):
+        s3_client = RecordingS3Client()
+        with pytest.raises(ValueError):
+            with MultipartUpload(s3_client, "bucket", "key.epub", "application/epub+zip") as upload:
+                upload.write(b"0" * MultipartUpload.MIN_PART_SIZE_BYTES)
+                raise ValueError("Failed to read")
+
+        assert s3_client.call_names() == ["create_multipart_upload", "upload_part", "abort_multipart_upload"]
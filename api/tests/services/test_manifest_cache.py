@@ -0,0 +1,125 @@
+import uuid
+from datetime import datetime, UTC
+
+import pytest
+
+from api.models.narration import NarrationManifest, ContentFile, NavigationItem
+from api.services.files import FileData, NotModified
+from api.services.manifest_cache import ManifestCache, TrackManifestCache
+from api.utils.compact_manifest import encode_manifest
+
+
+def manifest(title: str) -> NarrationManifest:
+    # noinspection PyArgumentList
+    return NarrationManifest([ContentFile(href="ch1.xhtml", navigation_items=[NavigationItem(title=title)])])
+
+
+class StubFilesService:
+    """Serves objects from memory, supporting conditional GET."""
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = 0
+
+    def put(self, key: str, body: bytes):
+        self.objects[key] = FileData(body=body, content_type="application/json", etag=f'"{uuid.uuid4()}"', range=None)
+
+    def get_object(self, key: str, if_none_match: str = "", range: str = "bytes=0-"):
+        self.requests += 1
+        file_data = self.objects.get(key)
+        if file_data is not None and file_data.etag == if_none_match:
+            raise NotModified()
+        return file_data
+
+
+class TestManifestCache:
+    def test_hit_and_refresh_on_etag_change(self):
+        book_id = uuid.uuid4()
+        files_service = StubFilesService()
+        files_service.put(f"{book_id}/narration-manifest.bin", encode_manifest(manifest("First")))
+        cache = ManifestCache(files_service, max_size_bytes=1024 * 1024)
+
+        first = cache.get(book_id)
+        assert cache.get(book_id) is first
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        files_service.put(f"{book_id}/narration-manifest.bin", encode_manifest(manifest("Second")))
+        second = cache.get(book_id)
+        assert second.manifest.navigation_items()[0].title == "Second"
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_size_bound(self):
+        files_service = StubFilesService()
+        book_ids = [uuid.uuid4() for _ in range(3)]
+        for book_id in book_ids:
+            files_service.put(f"{book_id}/narration-manifest.bin", encode_manifest(manifest("Title")))
+        entry_size = len(encode_manifest(manifest("Title")))
+        cache = ManifestCache(files_service, max_size_bytes=2 * entry_size)
+
+        for book_id in book_ids:
+            cache.get(book_id)
+
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["evictions"] == 1
+        assert stats["size_bytes"] == 2 * entry_size
+
+        # The least recently used one got evicted.
+        cache.get(book_ids[0])
+        assert cache.misses == 4
+
+    def test_invalidate(self):
+        book_id = uuid.uuid4()
+        files_service = StubFilesService()
+        files_service.put(f"{book_id}/narration-manifest.bin", encode_manifest(manifest("Title")))
+        cache = ManifestCache(files_service, max_size_bytes=1024 * 1024)
+
+        cache.get(book_id)
+        cache.invalidate(book_id)
+        assert cache.stats()["entries"] == 0
+
+        del files_service.objects[f"{book_id}/narration-manifest.bin"]
+        with pytest.raises(FileNotFoundError):
+            cache.get(book_id)
+
+    def test_json_fallback(self):
+        book_id = uuid.uuid4()
+        files_service = StubFilesService()
+        files_service.put(f"{book_id}/narration-manifest.json", manifest("Title").model_dump_json().encode())
+        cache = ManifestCache(files_service, max_size_bytes=1024 * 1024)
+
+        entry = cache.get(book_id)
+        assert entry.manifest.to_manifest() == manifest("Title")
+        assert cache.get(book_id) is entry
+
+
+class TestTrackManifestCache:
+    def test_bounded_by_tracks(self):
+        completed = datetime.now(UTC)
+        first, second = uuid.uuid4(), uuid.uuid4()
+        cache = TrackManifestCache(max_tracks=3)
+
+        cache.put(first, "kokoro", "af_heart", {1: (completed, None), 2: (completed, None)})
+        cache.put(second, "kokoro", "af_heart", {3: (completed, None)})
+        assert cache.get(first, "kokoro", "af_heart").keys() == {1, 2}
+
+        # The first playlist was used last, so the second one is evicted.
+        cache.put(second, "kokoro", "af_heart", {3: (completed, None), 4: (completed, None)})
+        assert cache.get(first, "kokoro", "af_heart") == {}
+        assert cache.get(second, "kokoro", "af_heart").keys() == {3, 4}
+
+    def test_invalidate_content(self):
+        completed = datetime.now(UTC)
+        content_id, other_id = uuid.uuid4(), uuid.uuid4()
+        cache = TrackManifestCache(max_tracks=10)
+        cache.put(content_id, "kokoro", "af_heart", {1: (completed, None)})
+        cache.put(content_id, "kokoro", "am_adam", {2: (completed, None)})
+        cache.put(other_id, "kokoro", "af_heart", {3: (completed, None)})
+
+        cache.invalidate(content_id, "kokoro", "af_heart")
+        assert cache.get(content_id, "kokoro", "af_heart") == {}
+        assert cache.get(content_id, "kokoro", "am_adam").keys() == {2}
+
+        cache.invalidate(content_id)
+        assert cache.get(content_id, "kokoro", "am_adam") == {}
+        assert cache.get(other_id, "kokoro", "af_heart").keys() == {3}
@@ -0,0 +1,101 @@
+import uuid
+from types import SimpleNamespace
+
+import m3u8
+
+from api.services.files import FileData
+from api.services.narration_queue import NarrationQueueService, MIN_LEASE_SEC, DEFAULT_NARRATION_TIME_SEC, \
+    LEASE_FACTOR
+from common_lib.models.tts import TrackManifest, FragmentDuration, FragmentGroups
+
+narration_queue_service = NarrationQueueService(None, None, None, None, None)
+
+
+def track(name: str, first_id: int) -> TrackManifest:
+    return TrackManifest(audio_key=f"book/audio-files/kokoro/am_michael/{name}.aac", track_name=name, size_bytes=1000,
+                         timeline=[FragmentDuration(id=first_id, duration=1.5),
+                                   FragmentDuration(id=first_id + 1, duration=2.25)])
+
+
+class TestNarrationQueueService:
+    def test_generate_playlist(self):
+        tracks = [track("0-1", 0), track("2-3", 2)]
+
+        playlist = m3u8.loads(narration_queue_service._generate_playlist(tracks))
+
+        assert not playlist.is_endlist
+        assert [s.uri for s in playlist.segments] == [f"/api/files/{t.audio_key}" for t in tracks]
+        assert [s.duration for s in playlist.segments] == [3.75, 3.75]
+        assert [d.id for d in playlist.segments[1].dateranges] == ["2-3", "n-00002", "n-00003"]
+
+    def test_generate_complete_playlist(self):
+        playlist = m3u8.loads(narration_queue_service._generate_playlist([track("0-1", 0)], is_endlist=True))
+
+        assert playlist.is_endlist
+
+    def test_target_queue_depth(self):
+        # No workers, nothing to queue.
+        assert narration_queue_service._target_queue_depth(0, 30, 30) == 0
+        # Unknown speed, one track per worker.
+        assert narration_queue_service._target_queue_depth(3, None, 30) == 3
+        # Slow workers still get the next track.
+        assert narration_queue_service._target_queue_depth(2, 180, 30) == 2
+        # Fast workers get enough to last the buffer.
+        assert narration_queue_service._target_queue_depth(2, 4, 30) == 16
+
+    def test_lease(self):
+        assert narration_queue_service._lease_sec(None, 30) == LEASE_FACTOR * (30 + DEFAULT_NARRATION_TIME_SEC)
+        assert narration_queue_service._lease_sec(200, 30) == LEASE_FACTOR * 230
+        # Fast workers still get some slack.
+        assert narration_queue_service._lease_sec(5, 0) == MIN_LEASE_SEC
+
+    def test_estimate_eta(self):
+        estimate = narration_queue_service._estimate_eta_s
+        # Unknown rate.
+        assert estimate(1000, 2, 0, 1, True, 2, None) is None
+        # A narrating book shares the workers with other narrating books.
+        assert estimate(1000, 10, 0, 2, True, 4, 10) == 50
+        # ...but can't use more workers than it has tracks.
+        assert estimate(1000, 1, 0, 1, True, 4, 10) == 100
+        # A queued book waits for the books ahead.
+        assert estimate(1000, 10, 3000, 1, False, 4, 10) == 100
+
+    def test_send_skips_tracks_missing_from_manifest(self, monkeypatch):
+        book_id = uuid.uuid4()
+        entries = [SimpleNamespace(id=i, book_id=book_id, tts_model="kokoro", voice="am_michael",
+                                   track_base_name=f"{i}", order=i, last_fragment_id=i) for i in range(3)]
+        calls = []
+        monkeypatch.setattr(narration_queue_service, "rmq_client",
+                            SimpleNamespace(publish=lambda key, msg: calls.append(("published", msg.queue_id))))
+        monkeypatch.setattr(narration_queue_service, "_content_ids", lambda ids: {book_id: book_id})
+        monkeypatch.setattr(narration_queue_service, "_get_fragments",
+                            lambda content_id, entry: None if entry.id == 1 else FragmentGroups([]))
+        monkeypatch.setattr(narration_queue_service, "_mark_sent", lambda ids, lease: calls.append(("sent", ids)))
+        monkeypatch.setattr(narration_queue_service, "_mark_failed", lambda ids: calls.append(("failed", ids)))
+
+        narration_queue_service._send(entries, 60)
+
+        # The mismatching track is failed, the rest are sent, and nothing is published before it's all recorded.
+        assert calls == [("failed", [1]), ("sent", [0, 2]), ("published", 0), ("published", 2)]
+
+    def test_track_manifest_of_legacy_track(self, monkeypatch):
+        content_id = uuid.uuid4()
+        manifest = track("0-1", 0)
+        files = {f"{content_id}/audio-files/kokoro/am_michael/0-1.json": manifest.model_dump_json()}
+        monkeypatch.setattr(narration_queue_service, "files_service", SimpleNamespace(
+            get_object=lambda key: FileData(body=files[key].encode(), content_type="application/json", etag="",
+                                            range=None) if key in files else None))
+
+        def legacy_entry(name: str):
+            return SimpleNamespace(id=1, tts_model="kokoro", voice="am_michael", track_base_name=name, timeline=None,
+                                   size_bytes=None)
+
+        # The timeline is read from the track manifest and stored with the entry.
+        entry = legacy_entry("0-1")
+        track_manifest = narration_queue_service._track_manifest(content_id, entry)
+        assert track_manifest.timeline == manifest.timeline
+        assert entry.timeline == manifest.timeline
+        assert entry.size_bytes == manifest.size_bytes
+
+        # A track without the manifest is left out rather than failing the response.
+        assert narration_queue_service._track_manifest(content_id, legacy_entry("2-3")) is None
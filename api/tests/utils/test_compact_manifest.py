@@ -0,0 +1,65 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from api.models.narration import NarrationManifest, ContentFile, NavigationItem, AudioTrack
+from api.services.epub import EpubService
+from api.utils.compact_manifest import CompactManifest, encode_manifest
+from common_lib.models.tts import FragmentGroup, TextFragment, PauseFragment
+from epub_lib import Epub, EpubRewriter
+
+TEST_BOOKS = Path(__file__).parents[3] / "epub-lib" / "tests" / "test_data"
+
+
+def build_manifest(book: str) -> NarrationManifest:
+    svc = EpubService.instance or EpubService()
+    epub = Epub(TEST_BOOKS / book)
+    fragment_map = svc.inline_fragments(EpubRewriter(epub))
+    return svc.build_narration_manifest(epub.get_publication_content(), fragment_map)
+
+
+class TestCompactManifest:
+    @pytest.mark.parametrize("book", ["Dungeon_Crawler_Carl.epub", "Swing_Shift_3.epub"])
+    def test_round_trip(self, book):
+        manifest = build_manifest(book)
+        compact = CompactManifest(encode_manifest(manifest))
+
+        assert compact.to_manifest() == manifest
+        assert compact.to_json() == manifest.model_dump_json().encode()
+        assert compact.to_fragment_map() == manifest.to_fragment_map()
+        assert len(compact.data) < len(manifest.model_dump_json())
+
+        for track_index in range(compact.track_count()):
+            first_id, last_id = compact.track_id_range(track_index)
+            assert compact.find_track(first_id) == track_index
+
+    def test_lazy_reads(self):
+        # noinspection PyArgumentList
+        groups = [FragmentGroup([TextFragment(id=3, text="Hello,"), TextFragment(id=4, text=" world.")]),
+                  FragmentGroup([PauseFragment(id=5, duration=1.5)])]
+        track = AudioTrack.from_fragments(groups)
+        # noinspection PyArgumentList
+        manifest = NarrationManifest([
+            ContentFile(href="title.xhtml", epub_types=["frontmatter", "titlepage"],
+                        navigation_items=[NavigationItem(title="Title", narrate=False)]),
+            ContentFile(href="ch1.xhtml", title="Chapter 1",
+                        navigation_items=[NavigationItem(idref="start", title="Chapter 1", audio_tracks=[track])]),
+        ])
+        compact = CompactManifest.from_manifest(manifest)
+
+        assert [(n.href, n.title, n.narrate) for n in compact.navigation_items()] == \
+               [("title.xhtml", "Title", False), ("ch1.xhtml#start", "Chapter 1", True)]
+        assert list(compact.track_indexes(0)) == []
+        assert list(compact.track_indexes(1)) == [0]
+        assert compact.track_id_range(0) == (3, 5)
+        assert compact.track_name(0) == track.name
+        assert compact.track_text_length(0) == len("Hello, world.")
+        assert compact.audio_track(0) == track
+        assert compact.find_track(3) == 0
+        assert compact.find_track(4) is None
+        assert compact.find_track(6) is None
+
+    def test_not_compact(self):
+        with pytest.raises(ValueError):
+            CompactManifest(json.dumps([]).encode())
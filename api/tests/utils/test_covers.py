@@ -0,0 +1,35 @@
+from io import BytesIO
+
+from PIL import Image
+
+from api.utils.covers import generate_cover_derivatives, COVER_DERIVATIVES
+
+
+def image_bytes(size, mode="RGB", format="JPEG") -> bytes:
+    output = BytesIO()
+    Image.new(mode, size, color="red").save(output, format=format)
+    return output.getvalue()
+
+
+class TestCovers:
+    def test_derivatives_fit_bounding_box(self):
+        derivatives = generate_cover_derivatives(image_bytes((1600, 2560)))
+
+        assert derivatives.keys() == COVER_DERIVATIVES.keys()
+        for name, (width, height) in COVER_DERIVATIVES.items():
+            with Image.open(BytesIO(derivatives[name])) as derivative:
+                assert derivative.format == "WEBP"
+                assert derivative.width <= width and derivative.height <= height
+                assert derivative.width == width or derivative.height == height
+
+    def test_small_image_not_enlarged(self):
+        derivatives = generate_cover_derivatives(image_bytes((100, 50)))
+
+        with Image.open(BytesIO(derivatives["cover"])) as derivative:
+            assert derivative.size == (100, 50)
+
+    def test_palette_image(self):
+        derivatives = generate_cover_derivatives(image_bytes((800, 1200), mode="P", format="GIF"))
+
+        with Image.open(BytesIO(derivatives["thumbnail"])) as derivative:
+            assert derivative.size == (120, 180)
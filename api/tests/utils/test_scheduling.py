@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from api.utils.scheduling import Trigger
+
+
+class TestTrigger:
+    def test_fire_from_another_thread(self):
+        trigger = Trigger("test")
+
+        async def run():
+            assert not await trigger.wait(0.01)
+            threading.Timer(0.01, trigger.fire).start()
+            assert await trigger.wait(5)
+            # Firing is consumed by the wait.
+            assert not await trigger.wait(0.01)
+
+        asyncio.run(run())
+
+    def test_fired_before_waiting(self):
+        trigger = Trigger("test")
+        trigger.fire()
+
+        async def run():
+            assert await trigger.wait(0.01)
+            trigger.fire()
+            assert await trigger.wait(0.01)
+
+        asyncio.run(run())
+
+    def test_fire_after_commit(self):
+        trigger = Trigger("test")
+        engine = create_engine("sqlite://")
+
+        async def run():
+            assert not await trigger.wait(0.01)
+
+            with Session(engine) as session:
+                with session.begin():
+                    trigger.fire_after_commit(session)
+                    await asyncio.sleep(0)
+                    assert not await trigger.wait(0.01)
+            assert await trigger.wait(0.01)
+
+            with Session(engine) as session:
+                session.begin()
+                trigger.fire_after_commit(session)
+                session.rollback()
+            assert not await trigger.wait(0.01)
+
+        asyncio.run(run())
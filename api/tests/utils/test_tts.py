@@ -5,17 +5,20 @@ import logging
 import os
 import pytest
 import shutil
+import time
 from bs4 import BeautifulSoup, Tag
 from io import BytesIO
 from xmldiff.main import diff_texts
 
 from api.utils.tts import tokenize_with_whitespace, split_tokens_into_fragments, FragmentInjector, \
-    process_xhtml_inplace, tokenize_tag_content
+    process_xhtml_inplace, tokenize_tag_content, renumber_fragments, TokenTable
 from common_lib.models.tts import Token, FragmentGroupsBuilder
 from epub_lib import Epub
 
 LOG = logging.getLogger(__name__)
 
+TEST_BOOKS = Path(__file__).parents[3] / "epub-lib" / "tests" / "test_data"
+
 
 # noinspection PyTypeChecker
 def assert_no_diff(left, right):
@@ -33,17 +36,17 @@ def assert_no_diff(left, right):
 class TestTts:
     def test_scene_break_detection(self):
         cases = [
-            ([Token("---")], True),
-            ([Token("___")], True),
-            ([Token("***")], True),
-            ([Token("◆◆◆")], True),
-            ([Token("✧────༺⚔༻────✧")], True),
-            ([Token("#")], True),
-            ([Token("&")], True),
-            ([Token("")], False),
-            ([Token(" ")], False),
-            ([Token("aaa")], False),
-            ([Token("888")], False),
+            ("---", True),
+            ("___", True),
+            ("***", True),
+            ("◆◆◆", True),
+            ("✧────༺⚔༻────✧", True),
+            ("#", True),
+            ("&", True),
+            ("", False),
+            (" ", False),
+            ("aaa", False),
+            ("888", False),
         ]
         for case in cases:
             assert FragmentInjector._scene_break(case[0]) == case[1], f"Expected {case[1]} for {case[0]}"
@@ -61,6 +64,48 @@ class TestTts:
         html_str = test_data_loader("3.html")
         output_html_bytes, frags, last_id = process_xhtml_inplace(html_str.encode(), 0)
 
+    def test_renumber_fragments(self, test_data_loader):
+        html_str = test_data_loader("3.html")
+        expected_bytes, expected_frags, expected_last_id = process_xhtml_inplace(html_str.encode(), 42)
+
+        output_html_bytes, frags, frags_count = process_xhtml_inplace(html_str.encode())
+        output_html_bytes = renumber_fragments(output_html_bytes, frags, 42)
+
+        assert frags_count + 42 == expected_last_id
+        assert frags == expected_frags
+        assert output_html_bytes == expected_bytes
+
+    @pytest.mark.parametrize("book", ["Dungeon_Crawler_Carl.epub", "Swing_Shift_3.epub"])
+    def test_lxml_injector_parity(self, book):
+        epub = Epub(TEST_BOOKS / book)
+        frag_id = 0
+        for content_file in epub.get_spine_files():
+            content_bytes = epub._read_file(content_file)
+
+            soup_bytes, soup_frags, soup_last_id = process_xhtml_inplace(content_bytes, frag_id, injector="soup")
+            lxml_bytes, lxml_frags, lxml_last_id = process_xhtml_inplace(content_bytes, frag_id, injector="lxml")
+
+            assert lxml_last_id == soup_last_id
+            assert lxml_frags == soup_frags
+            assert re.findall(rb'<span class="nf" id="(n-\d+)">', lxml_bytes) == \
+                   re.findall(rb'<span class="nf" id="(n-\d+)">', soup_bytes)
+            frag_id = soup_last_id
+
+    def test_unknown_injector(self):
+        with pytest.raises(ValueError):
+            process_xhtml_inplace(b"<p>This is a test</p>", injector="regex")
+
+    @pytest.mark.skip(reason="For manual execution.")
+    def test_injector_benchmark(self):
+        for book in ["Dungeon_Crawler_Carl.epub", "Swing_Shift_3.epub"]:
+            epub = Epub(TEST_BOOKS / book)
+            contents = [epub._read_file(f) for f in epub.get_spine_files()]
+            for injector in ["soup", "lxml"]:
+                start = time.perf_counter()
+                for content_bytes in contents:
+                    process_xhtml_inplace(content_bytes, injector=injector)
+                LOG.info("%s (%s): %.3fs", book, injector, time.perf_counter() - start)
+
     def test_tokenize_with_whitespace_specific(self, test_data_loader):
         cases = [" ", "\n", "\t", "\r", " word", "word ", " word "]
         for text in cases:
@@ -108,16 +153,49 @@ class TestTts:
 
                     assert False
 
+    def test_token_table_matches_tokens(self):
+        nodes = ["  Hello, my \u201cfriend\u201d!!! ", "Wait. . . ", "Stra\u00dfe\u2014and ", "\u2060more"]
+        tokens = TokenTable()
+        for node in nodes:
+            tokens.add_text(node)
+            tokens.add_punctuation()
+        expected = []
+        for node in nodes:
+            expected.extend(Token(t) for t in tokenize_with_whitespace(node))
+            expected[-1].add_punctuation_in_tts = True
+
+        assert len(tokens) == len(expected)
+        assert list(tokens.node_ends) == [4, 7, 8, 9]
+        for i, token in enumerate(expected):
+            assert tokens.raw_text(i) == token.raw_text
+            assert tokens.lengths[i] == token.length
+            assert tokens.tts_text(i, i + 1) == token.tts_text()
+        assert tokens.tts_text(0, len(tokens)) == "".join(t.tts_text() for t in expected)
+
+    def test_token_table_empty_text(self):
+        tokens = TokenTable()
+        for node in ["", "Hello ", "", "friend"]:
+            tokens.add_text(node)
+
+        assert len(tokens) == 2
+        assert list(tokens.starts) == [0, 6, 12]
+        assert list(tokens.node_ends) == [0, 1, 1, 2]
+        assert tokens.raw_text(1) == "friend"
+
     def test_split_tokens_into_fragments_one_empty_token(self):
         words = [" "]
-        tokens = [Token(word) for word in words]
+        tokens = TokenTable()
+        for word in words:
+            tokens.add_text(word)
         fragments = split_tokens_into_fragments(tokens)
 
         assert len(fragments) == 1
 
     def test_split_tokens_into_fragments_no_split(self):
         words = ["Hell ", "my", "friend!"]
-        tokens = [Token(word) for word in words]
+        tokens = TokenTable()
+        for word in words:
+            tokens.add_text(word)
         fragments = split_tokens_into_fragments(tokens, 7)
 
         assert len(fragments) == 1, "Should not split tokens without whitespace in between."
@@ -131,7 +209,7 @@ class TestTts:
         assert tag is not None
 
         fb = FragmentGroupsBuilder()
-        fi = FragmentInjector(tag, fb, set(), target_length=20)
+        fi = FragmentInjector(tag, fb, target_length=20)
         fi.inject()
 
         expected_html = """
@@ -148,7 +226,7 @@ class TestTts:
         assert tag is not None
 
         fb = FragmentGroupsBuilder()
-        fi = FragmentInjector(tag, fb, set(), target_length=20)
+        fi = FragmentInjector(tag, fb, target_length=20)
         fi.inject()
 
         expected_html = """
@@ -165,7 +243,7 @@ class TestTts:
         assert tag is not None
 
         fb = FragmentGroupsBuilder()
-        fi = FragmentInjector(tag, fb, set(), target_length=20)
+        fi = FragmentInjector(tag, fb, target_length=20)
         fi.inject()
 
         expected_html = """
@@ -182,7 +260,7 @@ class TestTts:
         assert tag is not None
 
         fb = FragmentGroupsBuilder()
-        fi = FragmentInjector(tag, fb, set(), target_length=20)
+        fi = FragmentInjector(tag, fb, target_length=20)
         fi.inject()
 
         expected_html = """
@@ -199,7 +277,7 @@ class TestTts:
         assert tag is not None
 
         fb = FragmentGroupsBuilder()
-        fi = FragmentInjector(tag, fb, set(), target_length=20)
+        fi = FragmentInjector(tag, fb, target_length=20)
         fi.inject()
 
         expected_html = """
@@ -216,9 +294,9 @@ class TestTts:
         assert tag is not None
 
         tokens = tokenize_tag_content(tag)
-        for t in tokens:
-            if t.raw_text == "explain":
-                assert t.add_punctuation_in_tts
+        for i in range(len(tokens)):
+            if tokens.raw_text(i) == "explain":
+                assert tokens.punctuation[i]
                 return
 
         assert False, "Token not found."
@@ -265,3 +343,10 @@ class TestTts:
         print(actual_html_str)
 
         assert "&lt;Error Classification: Omega1.14.3871392&gt;" in actual_html_str
+
+    def test_encoded_entities_lxml(self, test_data_loader):
+        html_str = test_data_loader("encoded_entities.xhtml")
+
+        content_bytes, fragments, frag_id = process_xhtml_inplace(html_str.encode(), 0, injector="lxml")
+
+        assert "&lt;Error Classification: Omega1.14.3871392&gt;" in content_bytes.decode()
@@ -0,0 +1,23 @@
+from io import BytesIO
+
+import pytest
+from blake3 import blake3
+
+from api.utils.upload import spool_upload, UploadTooLarge
+
+
+class TestUpload:
+    def test_spool_upload(self):
+        content = b"0123456789" * 100_000
+        chunks = []
+
+        upload = spool_upload(BytesIO(content), len(content), chunks.append)
+
+        assert upload.size_bytes == len(content)
+        assert upload.file_hash == blake3(content).hexdigest()
+        assert upload.file.read() == content
+        assert b"".join(chunks) == content
+
+    def test_spool_upload_too_large(self):
+        with pytest.raises(UploadTooLarge):
+            spool_upload(BytesIO(b"0" * 101), 100)
@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime
+from typing import List, Optional
 
-from common_lib.models.tts import FragmentGroups
+from common_lib.models.tts import FragmentGroups, FragmentDuration
 from common_lib.rmq import RMQMessage
 
 
@@ -25,3 +26,16 @@ class NarrateResponse(RMQMessage):
     completed: datetime
     duration_s: float
     size_bytes: int
+    # Timeline of the track, the same as in its track manifest. Missing in responses of older workers.
+    timeline: Optional[List[FragmentDuration]] = None
+    # Name of the worker that narrated the track.
+    worker: Optional[str] = None
+    # Time from the worker getting the request until publishing the response, encoding and upload included. Missing in
+    # responses of older workers.
+    processing_s: Optional[float] = None
+
+
+class IngestRequest(RMQMessage):
+    type = "ingest"
+
+    book_id: uuid.UUID
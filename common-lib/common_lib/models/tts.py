@@ -1,11 +1,12 @@
 import logging
 import re
+from bisect import bisect_left
 from dataclasses import dataclass
 from enum import Enum
-from typing import List, Optional, Any, Literal, Union, Annotated
+from typing import List, Optional, Any, Literal, Union, Annotated, Dict
 
 import unicodedata
-from pydantic import BaseModel, RootModel, field_serializer, field_validator, Field
+from pydantic import BaseModel, RootModel, field_serializer, field_validator, Field, PrivateAttr
 
 LOG = logging.getLogger(__name__)
 
@@ -44,7 +45,6 @@ class FragmentId(BaseModel):
 
 class FragmentBase(FragmentId):
     type: FragmentType
-    visited_ids: List[str] = []
 
 
 class TextFragment(FragmentBase):
@@ -76,37 +76,36 @@ class FragmentGroup(RootModel[List[Fragment]]):
 
 
 class FragmentGroups(RootModel[List[FragmentGroup]]):
+    # Maps IDs of the elements in the content to the ID of the first fragment following them.
+    _anchors: Dict[str, int] = PrivateAttr(default_factory=dict)
 
-    def remove_all_by_visited_id(self, idref: Optional[str]) -> List[FragmentGroup]:
-        """Removes all groups having the given idref among visited_ids. Returns the list of removed groups.
+    def remove_all_from_anchor(self, idref: Optional[str]) -> List[FragmentGroup]:
+        """Removes all groups following the element with the given idref. Returns the list of removed groups.
 
         idref: is the fragment ID from the ToC navigation item. We assume it's not possible for one group to be split
-         between ToC items.
+         between ToC items, so the group containing the first fragment following the element is removed as well.
         """
         if idref is None:
             removed = self.root
             self.root = []
             return removed
 
-        removed = []
-        remaining = []
-        for group in self.root:
-            # If any of the fragments in the group has the idref, remove it.
-            remove_group = False
-            for frag in group.root:
-                # Assumption here is that all fragments in the group belong to the same navigation idref.
-                if idref in frag.visited_ids:
-                    remove_group = True
-                    break
-
-            if remove_group:
-                removed.append(group)
-            else:
-                remaining.append(group)
+        boundary = self._anchors.get(idref)
+        if boundary is None:
+            return []
 
-        self.root = remaining
+        # Groups are in ascending order of fragment IDs.
+        index = bisect_left(self.root, boundary, key=lambda group: group.root[-1].id)
+        removed = self.root[index:]
+        self.root = self.root[:index]
         return removed
 
+    def shift_ids(self, offset: int):
+        """Shifts IDs of all fragments and anchors by the given offset."""
+        for frag in self.flatten():
+            frag.id += offset
+        self._anchors = {idref: frag_id + offset for idref, frag_id in self._anchors.items()}
+
     def all_fragment_ids(self) -> List[str]:
         """Returns a list of all fragment IDs in the groups."""
         return [f.formatted_id() for group in self.root for f in group.root]
@@ -115,7 +114,7 @@ class FragmentGroups(RootModel[List[FragmentGroup]]):
         return [f for group in self.root for f in group.root]
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     NORM_PATTERN = re.compile(r'\W+')
     PUNCTUATION_MAP = str.maketrans({
@@ -148,6 +147,7 @@ class Token:
     def __init__(self, text: str):
         self.raw_text = text
         self._tts_text = self._clean_for_tts(text)
+        self.add_punctuation_in_tts = False
 
         self.normalized_text = self.normalize(text)
         self.length = len(self.normalized_text)
@@ -160,12 +160,18 @@ class Token:
         if not self.add_punctuation_in_tts:
             return self._tts_text
 
-        if self._tts_text and self._tts_text[-1].isspace():
-            return self._add_punctuation(self._tts_text.rstrip()) + " "
+        return self.with_punctuation(self._tts_text)
+
+    @staticmethod
+    def with_punctuation(tts_text: str) -> str:
+        """Adds punctuation at the end of the cleaned up text, keeping the trailing whitespace."""
+        if tts_text and tts_text[-1].isspace():
+            return Token._add_punctuation(tts_text.rstrip()) + " "
         else:
-            return self._add_punctuation(self._tts_text)
+            return Token._add_punctuation(tts_text)
 
-    def _add_punctuation(self, text: str):
+    @staticmethod
+    def _add_punctuation(text: str):
         if text and text[-1] not in ":;,.!?":
             return text + "."
         return text
@@ -197,6 +203,7 @@ class FragmentGroupsBuilder(BaseModel):
     current_id: int = 0
     fragment_groups: List[List[Fragment]] = []
     current_group: Optional[List[Fragment]] = None
+    anchors: Dict[str, int] = {}
 
     def next_id(self):
         next_id = self.current_id
@@ -213,8 +220,12 @@ class FragmentGroupsBuilder(BaseModel):
         # noinspection PyTypeChecker
         self.fragment_groups.append(self.current_group)
 
-    def add_pause(self, duration: float, visited_ids: List[str]) -> Fragment:
-        frag = PauseFragment(id=self.next_id(), duration=duration, visited_ids=visited_ids)
+    def add_anchor(self, idref: str):
+        """Records the position of the element with the given ID, unless it's already known."""
+        self.anchors.setdefault(idref, self.current_id)
+
+    def add_pause(self, duration: float) -> Fragment:
+        frag = PauseFragment(id=self.next_id(), duration=duration)
         self.current_group.append(frag)
         return frag
 
@@ -223,11 +234,15 @@ class FragmentGroupsBuilder(BaseModel):
 
     def build(self):
         # noinspection PyArgumentList
-        return FragmentGroups(self.fragment_groups)
+        groups = FragmentGroups(self.fragment_groups)
+        groups._anchors = dict(self.anchors)
+        return groups
+
+    def add_tokens(self, tokens: List[Token]) -> Fragment:
+        return self.add_text("".join([t.tts_text() for t in tokens]))
 
-    def add_tokens(self, tokens: List[Token], visited_ids: List[str]) -> Fragment:
-        text = "".join([t.tts_text() for t in tokens])
-        frag = TextFragment(id=self.next_id(), text=text, visited_ids=visited_ids)
+    def add_text(self, text: str) -> Fragment:
+        frag = TextFragment(id=self.next_id(), text=text)
         self.current_group.append(frag)
         return frag
 
@@ -3,6 +3,7 @@ import logging
 import os
 import random
 from collections import defaultdict
+from concurrent.futures import Future
 from dataclasses import dataclass
 from enum import StrEnum
 from functools import partial
@@ -43,11 +44,14 @@ class Topology:
     default_exchange = "narrator"
     api_queue = "api"
     narration_queue = "narration"
+    ingestion_queue = "ingestion"
 
 
 class RMQClient(Service):
-    def __init__(self, exchange: str):
+    def __init__(self, exchange: str, prefetch_count: int = 1):
         self.exchange = exchange
+        # Number of unacknowledged messages delivered to the consumer at a time.
+        self.prefetch_count = prefetch_count
 
         self._publisher_connection = WatchedConnectionProvider(default_connection_params, ConnectionPurpose.PUBLISHER)
         self._consumer_connection = WatchedConnectionProvider(default_connection_params, ConnectionPurpose.CONSUMER)
@@ -55,6 +59,8 @@ class RMQClient(Service):
         self._consumer_thread = Thread(name="rmq-consumer", target=self._consume, daemon=True)
         self._message_handler_registry: QueueMessageHandlerRegistry = defaultdict(dict)
         self._message_processor = MessageProcessor(int(os.getenv("RMQ_CONCURRENCY", 1)))
+        # Queues handled by their own processors, so slow messages of one queue don't hold back the others.
+        self._queue_processors: dict[str, MessageProcessor] = {}
 
         self._close = Event()
 
@@ -65,14 +71,22 @@ class RMQClient(Service):
         channel.close()
 
     def get_queue_size(self, queue_name: str) -> int:
+        return self.get_queue_state(queue_name).message_count
+
+    def get_queue_state(self, queue_name: str) -> "QueueState":
         channel = self._publisher_connection.default_channel()
         declare_ok = channel.queue_declare(queue_name, passive=True)
-        return declare_ok.method.message_count
+        return QueueState(message_count=declare_ok.method.message_count,
+                          consumer_count=declare_ok.method.consumer_count)
 
     def set_queue_message_handler(self, queue: str, cls: type[SubclassOfRMQMessage],
                                   message_handler: Callable[[SubclassOfRMQMessage], Any]):
         self._message_handler_registry[queue][cls.type] = MsgHandlerContext(msg_type=cls, handler=message_handler)
 
+    def set_queue_concurrency(self, queue: str, concurrency: int):
+        """Handles messages of the queue by a dedicated processor with the given number of threads."""
+        self._queue_processors[queue] = MessageProcessor(concurrency, name=queue)
+
     def start_consuming(self):
         LOG.info("Starting RMQ consumer thread")
         LOG.debug("Message handler registry: \n%s", self._message_handler_registry)
@@ -83,7 +97,7 @@ class RMQClient(Service):
             channel_name = "unknown"
             try:
                 ch = self._consumer_connection.channel()
-                ch.basic_qos(prefetch_count=1)
+                ch.basic_qos(prefetch_count=self.prefetch_count)
                 connection_name = ch.connection._impl.params.client_properties.get('connection_name')
                 channel_name = f"{connection_name} ({ch.channel_number})"
 
@@ -105,8 +119,9 @@ class RMQClient(Service):
         if msg_type in message_handlers:
             ctx = message_handlers[msg_type]
             payload = ctx.msg_type.model_validate_json(body)
-            self._message_processor.put(MsgHandlerInvocation(context=ctx, payload=payload, channel=channel,
-                                                             delivery_tag=method.delivery_tag))
+            processor = self._queue_processors.get(queue, self._message_processor)
+            processor.put(MsgHandlerInvocation(context=ctx, payload=payload, channel=channel,
+                                               delivery_tag=method.delivery_tag))
         else:
             LOG.warning("Received message of type '%s' from queue '%s', but no handler is registered. Dropping it...",
                         msg_type, queue)
@@ -127,6 +142,15 @@ class RMQClient(Service):
         self._publisher_connection.close()
         self._consumer_connection.close()
         self._message_processor.close()
+        for processor in self._queue_processors.values():
+            processor.close()
+
+
+@dataclass
+class QueueState:
+    # Messages ready to be delivered, not including the ones being processed by consumers.
+    message_count: int
+    consumer_count: int
 
 
 @dataclass
@@ -148,15 +172,19 @@ QueueMessageHandlerRegistry = defaultdict[str, MessageHandlers]
 
 
 class MessageProcessor:
-    """A single threaded message processor. All enqueued messages are handled in FIFO order."""
+    """A single threaded message processor. All enqueued messages are handled in FIFO order.
 
-    def __init__(self, concurrency: int):
+    A message is acknowledged once its handler returns. A handler can return a Future instead to continue the handling
+    in the background, then the message is acknowledged once the future is done, or rejected if it fails.
+    """
+
+    def __init__(self, concurrency: int, name: str = "message-processor"):
         self._close = Event()
 
         self.invocation_queue: Queue[MsgHandlerInvocation] = Queue()
         self.threads = []
         for i in range(concurrency):
-            self.thread = Thread(name=f"message-processor-{i}", target=self._process_queue, daemon=True)
+            self.thread = Thread(name=f"{name}-{i}", target=self._process_queue, daemon=True)
             self.threads.append(self.thread)
             self.thread.start()
 
@@ -174,20 +202,41 @@ class MessageProcessor:
 
     @staticmethod
     def _handle_invocation(invocation: MsgHandlerInvocation):
-        conn: BlockingConnection = invocation.channel.connection
         try:
             if invocation.channel.is_open:
-                invocation.context.handler(invocation.payload)
-                conn.add_callback_threadsafe(
-                    lambda: invocation.channel.basic_ack(delivery_tag=invocation.delivery_tag)
-                )
+                result = invocation.context.handler(invocation.payload)
+                if isinstance(result, Future):
+                    result.add_done_callback(partial(MessageProcessor._complete_future_invocation, invocation))
+                else:
+                    MessageProcessor._ack(invocation)
             else:
                 LOG.warning(f"Channel is closed before handling message of type {invocation.payload.type}.")
         except Exception:
             LOG.exception(f"Error while handling message of type {invocation.payload.type}. Ignoring it...")
-            conn.add_callback_threadsafe(
-                lambda: invocation.channel.basic_reject(delivery_tag=invocation.delivery_tag)
-            )
+            MessageProcessor._reject(invocation)
+
+    @staticmethod
+    def _complete_future_invocation(invocation: MsgHandlerInvocation, future: Future):
+        if future.exception() is None:
+            MessageProcessor._ack(invocation)
+        else:
+            LOG.error(f"Error while handling message of type {invocation.payload.type}. Ignoring it...",
+                      exc_info=future.exception())
+            MessageProcessor._reject(invocation)
+
+    @staticmethod
+    def _ack(invocation: MsgHandlerInvocation):
+        conn: BlockingConnection = invocation.channel.connection
+        conn.add_callback_threadsafe(
+            lambda: invocation.channel.basic_ack(delivery_tag=invocation.delivery_tag)
+        )
+
+    @staticmethod
+    def _reject(invocation: MsgHandlerInvocation):
+        conn: BlockingConnection = invocation.channel.connection
+        conn.add_callback_threadsafe(
+            lambda: invocation.channel.basic_reject(delivery_tag=invocation.delivery_tag)
+        )
 
     def close(self):
         self._close.set()
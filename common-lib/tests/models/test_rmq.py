@@ -1,4 +1,6 @@
-from common_lib.rmq import RMQMessage
+from concurrent.futures import Future
+
+from common_lib.rmq import RMQMessage, MessageProcessor, MsgHandlerContext, MsgHandlerInvocation
 
 
 class DummyMessage(RMQMessage):
@@ -21,3 +23,75 @@ def test_rmq_message_deserialization_type_override():
     msg = DummyMessage.model_validate_json('{"prop":"used","type":"should_be_ignored"}')
     assert msg.prop == "used"
     assert msg.type == "test_type"
+
+
+class StubConnection:
+    def __init__(self):
+        self.callbacks = []
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+
+class StubChannel:
+    def __init__(self):
+        self.is_open = True
+        self.connection = StubConnection()
+        self.acked = []
+        self.rejected = []
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag):
+        self.rejected.append(delivery_tag)
+
+    def run_callbacks(self):
+        for callback in self.connection.callbacks:
+            callback()
+        self.connection.callbacks.clear()
+
+
+def invoke(handler) -> StubChannel:
+    channel = StubChannel()
+    context = MsgHandlerContext(msg_type=DummyMessage, handler=handler)
+    MessageProcessor._handle_invocation(MsgHandlerInvocation(context=context, payload=DummyMessage(prop="value"),
+                                                             channel=channel, delivery_tag=7))
+    channel.run_callbacks()
+    return channel
+
+
+def test_ack_when_handler_returns():
+    channel = invoke(lambda payload: None)
+    assert channel.acked == [7]
+    assert channel.rejected == []
+
+
+def test_reject_when_handler_fails():
+    def handler(payload):
+        raise RuntimeError("failed")
+
+    channel = invoke(handler)
+    assert channel.acked == []
+    assert channel.rejected == [7]
+
+
+def test_ack_when_returned_future_completes():
+    future = Future()
+    channel = invoke(lambda payload: future)
+    assert channel.acked == []
+
+    future.set_result(None)
+    channel.run_callbacks()
+    assert channel.acked == [7]
+    assert channel.rejected == []
+
+
+def test_reject_when_returned_future_fails():
+    future = Future()
+    channel = invoke(lambda payload: future)
+
+    future.set_exception(RuntimeError("failed"))
+    channel.run_callbacks()
+    assert channel.acked == []
+    assert channel.rejected == [7]
@@ -1,4 +1,4 @@
-from common_lib.models.tts import Token
+from common_lib.models.tts import Token, FragmentGroupsBuilder
 
 
 class TestTTS:
@@ -46,3 +46,37 @@ class TestTTS:
         for text, expected in translation_cases:
             actual = text.translate(Token.PUNCTUATION_MAP)
             assert actual == expected
+
+    def test_remove_all_from_anchor(self):
+        builder = FragmentGroupsBuilder()
+        builder.add_anchor("chapter-1")
+        for text in ["One.", "Two."]:
+            builder.next_group()
+            builder.add_text(text)
+        builder.add_anchor("chapter-2")
+        builder.next_group()
+        builder.add_pause(1)
+        builder.next_group()
+        builder.add_text("Three.")
+        builder.add_text("Four.")
+        # Only the first occurrence counts.
+        builder.add_anchor("chapter-1")
+        groups = builder.build()
+
+        assert groups.remove_all_from_anchor("unknown") == []
+        assert [f.id for g in groups.remove_all_from_anchor("chapter-2") for f in g.root] == [2, 3, 4]
+        assert [f.id for g in groups.remove_all_from_anchor("chapter-1") for f in g.root] == [0, 1]
+        assert groups.root == []
+
+    def test_shift_ids(self):
+        builder = FragmentGroupsBuilder()
+        builder.next_group()
+        builder.add_text("One.")
+        builder.add_anchor("chapter-2")
+        builder.add_text("Two.")
+        groups = builder.build()
+
+        groups.shift_ids(10)
+
+        assert groups.all_fragment_ids() == ["n-00010", "n-00011"]
+        assert len(groups.remove_all_from_anchor("chapter-2")) == 1
@@ -1 +1 @@
-from epub_lib.epub import Epub
+from epub_lib.epub import Epub, EpubRewriter
@@ -3,8 +3,8 @@ import re
 from io import BytesIO
 from os import PathLike
 from pathlib import Path
-from typing import IO, List, Optional, Tuple
-from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from typing import IO, List, Optional, Tuple, Callable, Dict, Set
+from zipfile import ZipFile, ZIP_STORED
 
 import imagehash
 from PIL import Image
@@ -17,6 +17,7 @@ from epub_lib.model.container import CONTAINER_XML, Container
 from epub_lib.model.nav import TocItem, TableOfContent, PublicationContentBuilder, PublicationContent
 from epub_lib.model.ncx import NavigationControl
 from epub_lib.model.package import Package, Item
+from epub_lib.util.zip import ZipWriter
 
 LOG = logging.getLogger(__name__)
 
@@ -315,34 +316,100 @@ class Epub:
 
     def add_manifest_item(self, id: str, href: str, media_type: str, body: str) -> BytesIO:
         """Adds the new item to the manifest, appends the file to the archive, and returns bytes of the modified archive."""
-
-        out_bytes = BytesIO()
-        with ZipFile(out_bytes, "w", ZIP_DEFLATED) as out_zip:
-            out_zip.writestr("mimetype", self.zip_file.read("mimetype"), compress_type=ZIP_STORED)
-
-            # Copy all unmodified files.
-            for fileinfo in self.zip_file.infolist():
-                if fileinfo.is_dir():
-                    continue
-                if fileinfo.filename == self.root_file:
-                    # The root file is updated separately.
+        rewriter = EpubRewriter(self)
+        rewriter.add_manifest_item(id=id, href=href, media_type=media_type, body=body)
+        return rewriter.write()
+
+
+# Transforms content of a single archive entry.
+EntryTransform = Callable[[bytes], bytes]
+
+
+class EpubRewriter:
+    """Rewrites an EPUB archive in a single pass.
+
+    Transforms are registered per archive entry and applied when the entry is rendered. Every entry is read and
+    decompressed at most once, and entries without transforms are copied over raw, without recompression, in chunks.
+    """
+
+    def __init__(self, epub: Epub):
+        self.epub = epub
+
+        # Pending transforms per entry, in the order of registration.
+        self._transforms: Dict[str, List[EntryTransform]] = {}
+        # Rendered content of the modified entries. Written to the archive in the order of insertion.
+        self._content: Dict[str, bytes] = {}
+        self._excluded: Set[str] = set()
+        self._package_modified = False
+
+    def transform(self, filename: str, func: EntryTransform) -> "EpubRewriter":
+        """Registers a transform of the entry. Transforms of the same entry are chained."""
+        if filename in self._excluded:
+            raise ValueError(f"Entry '{filename}' is excluded from the archive.")
+        self._transforms.setdefault(filename, []).append(func)
+        return self
+
+    def exclude(self, filename: str) -> "EpubRewriter":
+        """Drops the entry from the resulting archive."""
+        self._excluded.add(filename)
+        self._transforms.pop(filename, None)
+        self._content.pop(filename, None)
+        return self
+
+    def replace(self, filename: str, body: bytes | str) -> "EpubRewriter":
+        """Sets the content of the entry, replacing the original one and any pending transforms."""
+        self._transforms.pop(filename, None)
+        self._content[filename] = body.encode() if isinstance(body, str) else body
+        return self
+
+    def render(self, filename: str) -> bytes:
+        """Returns the content of the entry with all registered transforms applied."""
+        content = self._content.get(filename)
+        if content is None:
+            content = self.epub.zip_file.read(filename)
+
+        for func in self._transforms.pop(filename, []):
+            content = func(content)
+
+        self._content[filename] = content
+        return content
+
+    def add_manifest_item(self, id: str, href: str, media_type: str, body: bytes | str) -> "EpubRewriter":
+        """Adds the file to the archive and the corresponding item to the package manifest."""
+        self.replace(self.epub._resource_path(href), body)
+        self.epub.package.manifest.item.append(Item(id=id, href=href, media_type=media_type))
+        self.epub.manifest_item_dict[id] = self.epub.package.manifest.item[-1]
+        self._package_modified = True
+        return self
+
+    def write(self, out: Optional[IO[bytes]] = None) -> IO[bytes]:
+        """Writes the resulting archive into `out` (a new buffer by default), and returns it rewound."""
+        out = out if out is not None else BytesIO()
+        src_zip = self.epub.zip_file
+
+        if self._package_modified:
+            self.replace(self.epub.root_file, self.epub.package.to_xml(exclude_none=True, xml_declaration=True))
+
+        # Render the entries with pending transforms upfront, so they are written in the order of registration.
+        for filename in list(self._transforms.keys()):
+            self.render(filename)
+
+        with ZipWriter(out) as out_zip:
+            # mimetype must go first and without compression.
+            out_zip.write("mimetype", src_zip.read("mimetype"), compress_type=ZIP_STORED)
+
+            for filename, content in self._content.items():
+                LOG.debug("Writing modified %s", filename)
+                out_zip.write(filename, content)
+
+            for fileinfo in src_zip.infolist():
+                if fileinfo.is_dir() or fileinfo.filename == "mimetype":
                     continue
-                if fileinfo.filename == "mimetype":
-                    # mimetype is added the first without compression.
+                if fileinfo.filename in self._content or fileinfo.filename in self._excluded:
                     continue
 
-                LOG.debug("Processing %s", fileinfo.filename)
-                out_zip.writestr(fileinfo.filename, self.zip_file.read(fileinfo.filename))
-
-
-            # Add the content to the archive.
-            out_zip.writestr(str(self.root_file_dir.joinpath(href)), body)
-
-            # Add the new item to the manifest.
-            new_map_item = Item(id=id, href=href, media_type=media_type)
-            self.package.manifest.item.append(new_map_item)
-            xml_str = self.package.to_xml(exclude_none=True, xml_declaration=True)
-            out_zip.writestr(self.root_file, xml_str)
+                LOG.debug("Copying %s", fileinfo.filename)
+                out_zip.copy(src_zip, fileinfo)
 
-        out_bytes.seek(0)
-        return out_bytes
+        out.seek(0)
+        return out
@@ -0,0 +1,149 @@
+import struct
+import time
+import zlib
+from typing import IO, Iterable, List, Tuple
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED, ZIP64_LIMIT
+
+# Record layouts of the ZIP format (APPNOTE.TXT sections 4.3.7, 4.3.12 and 4.3.16).
+LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_FILE_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_DIRECTORY_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+CENTRAL_DIRECTORY_HEADER_SIGNATURE = b"PK\x01\x02"
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<4s4H2LH")
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = b"PK\x05\x06"
+
+# Version 2.0 of the format covers the stored and deflated entries without ZIP64 extensions.
+ZIP_VERSION = 20
+FLAG_ENCRYPTED = 0x1
+FLAG_UTF8 = 0x800
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def read_raw(src_zip: ZipFile, info: ZipInfo, chunk_size: int = COPY_CHUNK_SIZE) -> Iterable[bytes]:
+    """Yields the compressed bytes of the entry as stored in the archive, located by its local file header."""
+    src = src_zip.fp
+    src.seek(info.header_offset)
+    header = LOCAL_FILE_HEADER.unpack(src.read(LOCAL_FILE_HEADER.size))
+    if header[0] != LOCAL_FILE_HEADER_SIGNATURE:
+        raise ValueError(f"Bad local file header of '{info.filename}'.")
+    name_length, extra_length = header[-2:]
+    src.seek(name_length + extra_length, 1)
+
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError(f"Unexpected end of data of '{info.filename}'.")
+        remaining -= len(chunk)
+        yield chunk
+
+
+class ZipWriter:
+    """Writes a ZIP archive sequentially, copying the compressed bytes of entries from other archives as is.
+
+    ZipFile can only write an entry by compressing its content, so copying an entry that way decompresses and
+    compresses it again. Only what EPUB files need is supported: stored and deflated entries below the ZIP64 limits.
+    """
+
+    def __init__(self, out: IO[bytes]):
+        self.out = out
+        self._offset = 0
+        self._entries: List[ZipInfo] = []
+        self._names = set()
+
+    def __enter__(self) -> "ZipWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, filename: str, data: bytes, compress_type: int = ZIP_DEFLATED):
+        """Adds an entry with the given content."""
+        info = ZipInfo(filename, date_time=time.localtime(time.time())[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o600 << 16
+        self._write_content(info, data)
+
+    def copy(self, src_zip: ZipFile, src_info: ZipInfo):
+        """Adds the entry of another archive, copying its compressed bytes without recompression where possible."""
+        info = ZipInfo(src_info.filename, date_time=src_info.date_time)
+        info.compress_type = src_info.compress_type
+        info.external_attr = src_info.external_attr
+        info.comment = src_info.comment
+
+        if src_info.flag_bits & FLAG_ENCRYPTED:
+            # The encryption header is part of the raw bytes, the content is decrypted and compressed again instead.
+            info.compress_type = ZIP_DEFLATED
+            self._write_content(info, src_zip.read(src_info))
+            return
+
+        # The sizes come from the central directory, so entries with ZIP64 extra fields are copied raw as well, as long
+        # as they don't actually exceed the limits.
+        info.CRC = src_info.CRC
+        info.file_size = src_info.file_size
+        info.compress_size = src_info.compress_size
+        self._write_entry(info, read_raw(src_zip, src_info))
+
+    def _write_content(self, info: ZipInfo, data: bytes):
+        if info.compress_type == ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            compressed = compressor.compress(data) + compressor.flush()
+        elif info.compress_type == ZIP_STORED:
+            compressed = data
+        else:
+            raise ValueError(f"Unsupported compression method {info.compress_type} of '{info.filename}'.")
+        info.CRC = zlib.crc32(data)
+        info.file_size = len(data)
+        info.compress_size = len(compressed)
+        self._write_entry(info, [compressed])
+
+    def _write_entry(self, info: ZipInfo, chunks: Iterable[bytes]):
+        if info.filename in self._names:
+            raise ValueError(f"Duplicate entry '{info.filename}'.")
+        if info.file_size >= ZIP64_LIMIT or info.compress_size >= ZIP64_LIMIT or self._offset >= ZIP64_LIMIT:
+            raise ValueError(f"Entry '{info.filename}' needs ZIP64 extensions, which are not supported.")
+        self._names.add(info.filename)
+
+        name, flags = self._encode_name(info.filename)
+        info.flag_bits = flags
+        info.header_offset = self._offset
+        dos_time, dos_date = self._dos_date_time(info)
+        self._write(LOCAL_FILE_HEADER.pack(LOCAL_FILE_HEADER_SIGNATURE, ZIP_VERSION, 0, flags, info.compress_type,
+                                           dos_time, dos_date, info.CRC, info.compress_size, info.file_size,
+                                           len(name), 0))
+        self._write(name)
+        for chunk in chunks:
+            self._write(chunk)
+        self._entries.append(info)
+
+    def close(self):
+        """Writes the central directory. The archive is complete only after this."""
+        start = self._offset
+        for info in self._entries:
+            name, flags = self._encode_name(info.filename)
+            dos_time, dos_date = self._dos_date_time(info)
+            self._write(CENTRAL_DIRECTORY_HEADER.pack(CENTRAL_DIRECTORY_HEADER_SIGNATURE, ZIP_VERSION,
+                                                      info.create_system, ZIP_VERSION, 0, flags, info.compress_type,
+                                                      dos_time, dos_date, info.CRC, info.compress_size,
+                                                      info.file_size, len(name), 0, len(info.comment), 0, 0,
+                                                      info.external_attr, info.header_offset))
+            self._write(name)
+            self._write(info.comment)
+        self._write(END_OF_CENTRAL_DIRECTORY.pack(END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(self._entries),
+                                                  len(self._entries), self._offset - start, start, 0))
+
+    def _write(self, data: bytes):
+        self.out.write(data)
+        self._offset += len(data)
+
+    @staticmethod
+    def _encode_name(filename: str) -> Tuple[bytes, int]:
+        if filename.isascii():
+            return filename.encode("ascii"), 0
+        return filename.encode("utf-8"), FLAG_UTF8
+
+    @staticmethod
+    def _dos_date_time(info: ZipInfo) -> Tuple[int, int]:
+        year, month, day, hour, minute, second = info.date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
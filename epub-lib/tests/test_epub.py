@@ -1,9 +1,11 @@
 import os
 from pathlib import Path
+from zipfile import ZipFile, ZIP_STORED
 
 import pytest
 
-from epub_lib import Epub
+from epub_lib import Epub, EpubRewriter
+from epub_lib.util.zip import read_raw
 
 
 class TestEpub:
@@ -25,6 +27,72 @@ class TestEpub:
         unique_spine_refs = set([i.idref for i in epub.package.spine.items])
         assert len(toc.spine_items) == len(unique_spine_refs)
 
+    def test_rewriter_copies_unmodified_entries(self):
+        epub = Epub("tests/test_data/Dungeon_Crawler_Carl.epub")
+        out_bytes = EpubRewriter(epub).write()
+
+        out_zip = ZipFile(out_bytes)
+        assert out_zip.testzip() is None
+        assert out_zip.infolist()[0].filename == "mimetype"
+        assert out_zip.infolist()[0].compress_type == ZIP_STORED
+
+        src_infos = {i.filename: i for i in epub.zip_file.infolist() if not i.is_dir()}
+        assert set(out_zip.namelist()) == set(src_infos.keys())
+        for out_info in out_zip.infolist():
+            src_info = src_infos[out_info.filename]
+            assert out_info.compress_type == src_info.compress_type
+            assert out_info.compress_size == src_info.compress_size
+            assert out_zip.read(out_info) == epub.zip_file.read(src_info)
+
+    def test_rewriter_copies_compressed_bytes_raw(self):
+        epub = Epub("tests/test_data/Swing_Shift_3.epub")
+        spine_file = epub.get_spine_files()[0]
+        rewriter = EpubRewriter(epub)
+        rewriter.transform(spine_file, lambda b: b.replace(b"</body>", b"<p>one</p></body>"))
+        out_zip = ZipFile(rewriter.write())
+        assert out_zip.testzip() is None
+
+        copied = [i for i in epub.zip_file.infolist() if not i.is_dir() and i.filename not in ("mimetype", spine_file)]
+        assert copied
+        for src_info in copied:
+            out_info = out_zip.getinfo(src_info.filename)
+            assert (out_info.CRC, out_info.file_size, out_info.compress_size, out_info.compress_type) == \
+                   (src_info.CRC, src_info.file_size, src_info.compress_size, src_info.compress_type)
+            assert b"".join(read_raw(out_zip, out_info)) == b"".join(read_raw(epub.zip_file, src_info))
+
+    def test_rewriter_transforms(self):
+        epub = Epub("tests/test_data/Swing_Shift_3.epub")
+        spine_file = epub.get_spine_files()[0]
+        excluded_file = epub.get_spine_files()[1]
+
+        rewriter = EpubRewriter(epub)
+        rewriter.transform(spine_file, lambda b: b.replace(b"</body>", b"<p>one</p></body>"))
+        rewriter.transform(spine_file, lambda b: b.replace(b"</body>", b"<p>two</p></body>"))
+        rewriter.exclude(excluded_file)
+        rewriter.add_manifest_item(id="fragment-map", href="fragment-map.json", media_type="application/json",
+                                   body="[]")
+        out_bytes = rewriter.write()
+
+        out_epub = Epub(out_bytes)
+        assert b"<p>one</p><p>two</p></body>" in out_epub._read_file(spine_file)
+        assert excluded_file not in out_epub.zip_file.namelist()
+        fragment_map_item = out_epub.manifest_item_dict["fragment-map"]
+        assert out_epub._read_file(out_epub._resource_path(fragment_map_item.href)) == b"[]"
+
+    def test_rewriter_render_applies_transforms_once(self):
+        epub = Epub("tests/test_data/Swing_Shift_3.epub")
+        spine_file = epub.get_spine_files()[0]
+        calls = []
+
+        rewriter = EpubRewriter(epub)
+        rewriter.transform(spine_file, lambda b: calls.append(b) or b + b"<!-- x -->")
+        rendered = rewriter.render(spine_file)
+        assert rewriter.render(spine_file) == rendered
+
+        out_epub = Epub(rewriter.write())
+        assert out_epub._read_file(spine_file) == rendered
+        assert len(calls) == 1
+
     @pytest.mark.skip(reason="For manual execution only.")
     def test_toc_all_files(self):
         dir_path = os.path.expanduser("~/Downloads/epub")
@@ -1,38 +1,30 @@
 from contextlib import asynccontextmanager
+from dataclasses import asdict
 from dotenv import load_dotenv
-from fastapi import FastAPI, APIRouter
-from pika.adapters.blocking_connection import BlockingChannel
-from pika.exchange_type import ExchangeType
+from fastapi import FastAPI, APIRouter, HTTPException
 
 from api.speechgen import SpeechGenService
-from common_lib import RMQClient
-from common_lib.models import rmq
-from common_lib.rmq import Topology
+from api.worker import start_speech_worker, stop_speech_worker, ReplicaSupervisor, SPEECH_REPLICAS, SPEECH_THREADS_PER_REPLICA
 from common_lib.uvicorn import EndpointFilter
 
 load_dotenv()
 EndpointFilter.add_filter("/api/")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    exchange = "narrator"
-    rmq_client: RMQClient = RMQClient(exchange)
-    speech_gen_svc = SpeechGenService(rmq_client)
+supervisor: ReplicaSupervisor | None = None
 
-    # Configure topology.
-    def configure(channel: BlockingChannel):
-        channel.exchange_declare(exchange, ExchangeType.topic, durable=True)
-        channel.queue_declare(Topology.narration_queue, durable=True, arguments={"x-queue-type": "quorum"})
-        channel.queue_bind(Topology.narration_queue, exchange, "narrate")
 
-    rmq_client.configure(configure)
-
-    # Configure message handlers and start consuming.
-    rmq_client.set_queue_message_handler(Topology.narration_queue,
-                                         rmq.NarrateRequest,
-                                         speech_gen_svc.handle_narrate_msg)
-    rmq_client.start_consuming()
-    yield
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supervisor
+    if SPEECH_REPLICAS > 1:
+        supervisor = ReplicaSupervisor(SPEECH_REPLICAS, SPEECH_THREADS_PER_REPLICA)
+        supervisor.start()
+        yield
+        supervisor.stop()
+    else:
+        rmq_client = start_speech_worker()
+        yield
+        stop_speech_worker(rmq_client)
 
 
 app = FastAPI(lifespan=lifespan)
@@ -42,6 +34,17 @@ base_url_router = APIRouter(prefix="/api")
 
 @base_url_router.get("/")
 def health():
+    if supervisor is not None:
+        return {"status": "ok", "replicas": supervisor.alive()}
     return {"status": "ok"}
 
+
+@base_url_router.get("/g2p-cache")
+def g2p_cache():
+    """Hit rates of the memoized G2P. Only available when narrating in-process, replicas log them per track."""
+    if SpeechGenService.instance is None:
+        raise HTTPException(status_code=404, detail="Speech generation runs in replicas.")
+    return {name: {**asdict(stats), "hit_rate": stats.hit_rate}
+            for name, stats in SpeechGenService.instance.g2p.stats().items()}
+
 app.include_router(base_url_router)
@@ -0,0 +1,205 @@
+import copy
+import fcntl
+import os
+import pickle
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from importlib.metadata import version
+from threading import RLock
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from kokoro import KPipeline
+from misaki.token import MToken
+
+from api import get_logger
+
+LOG = get_logger(__name__)
+
+# Maximum number of fragments and of words with memoized phonemes.
+G2P_CACHE_FRAGMENTS = int(os.getenv("G2P_CACHE_FRAGMENTS", 20000))
+G2P_CACHE_WORDS = int(os.getenv("G2P_CACHE_WORDS", 50000))
+# File the memoized phonemes are persisted to, so they survive restarts. Nothing is persisted if not set.
+G2P_CACHE_PATH = os.getenv("G2P_CACHE_PATH")
+# Minimum interval between writes of the cache to the disk.
+G2P_CACHE_SAVE_INTERVAL_SEC = 300
+# Incremented when the format of the persisted cache changes, older files are ignored.
+G2P_CACHE_VERSION = 2
+# Phonemes depend on the G2P version, files written by other versions are ignored.
+MISAKI_VERSION = version("misaki")
+
+
+@dataclass
+class CacheStats:
+    size: int
+    hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0
+
+
+class LRUCache:
+    """A thread-safe cache keeping up to max_size most recently used entries."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def put_all(self, items: List[Tuple[Hashable, Any]]):
+        """Adds the entries, least recently used first."""
+        with self._lock:
+            for key, value in items:
+                self.put(key, value)
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """Returns the entries, least recently used first."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(size=len(self._entries), hits=self.hits, misses=self.misses)
+
+
+class MemoizedG2P:
+    """Grapheme-to-phoneme conversion of the pipeline, memoized per fragment and per word.
+
+    Book text is repetitive: names, dialogue tags, headings. Phonemes of whole fragments are memoized by their text, so
+    a repeated fragment skips G2P entirely. Phonemes of words missing from the lexicon, looked up by the much slower
+    fallback, are memoized by the word. Both are keyed by the language code as well.
+    """
+
+    def __init__(self, pipeline: KPipeline, lang_code: str, fragments_size: int = G2P_CACHE_FRAGMENTS,
+                 words_size: int = G2P_CACHE_WORDS, path: Optional[str] = G2P_CACHE_PATH):
+        self.pipeline = pipeline
+        self.lang_code = lang_code
+        self.fragments = LRUCache(fragments_size)
+        self.words = LRUCache(words_size)
+        self.path = path
+        self._last_save = time.monotonic()
+        self._lock = RLock()
+
+        self._load()
+
+        fallback = getattr(pipeline.g2p, "fallback", None)
+        if fallback is not None:
+            # Replace the fallback memoized by another instance sharing the pipeline, rather than memoizing it twice.
+            pipeline.g2p.fallback = self._memoized_fallback(getattr(fallback, "__wrapped__", fallback))
+
+    def __call__(self, text: str) -> List[MToken]:
+        key = (self.lang_code, text)
+        tokens = self.fragments.get(key)
+        if tokens is None:
+            _, tokens = self.pipeline.g2p(text)
+            self.fragments.put(key, tokens)
+        # The tokens are updated with timestamps once narrated, so every caller gets its own copy.
+        return copy.deepcopy(tokens)
+
+    def _memoized_fallback(self, fallback: Callable[[MToken], Tuple[Optional[str], Any]]):
+        def memoized(token: MToken):
+            key = (self.lang_code, token.text)
+            result = self.words.get(key)
+            if result is None:
+                result = fallback(token)
+                self.words.put(key, result)
+            return result
+
+        memoized.__wrapped__ = fallback
+        return memoized
+
+    def stats(self) -> Dict[str, CacheStats]:
+        return {"fragments": self.fragments.stats(), "words": self.words.stats()}
+
+    def save_if_due(self):
+        """Persists the cache if enough time passed since it was last saved."""
+        if self.path and time.monotonic() - self._last_save >= G2P_CACHE_SAVE_INTERVAL_SEC:
+            self.save()
+
+    def save(self):
+        """Persists the cache, merged with the entries saved meanwhile by other replicas sharing the file."""
+        if not self.path:
+            return
+        with self._lock:
+            self._last_save = time.monotonic()
+            try:
+                # Replicas take turns, so none of them overwrites the entries saved by another one.
+                with open(f"{self.path}.lock", "w") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    state = self._read()
+                    if state is not None:
+                        # Entries of the other replicas are older than the ones in use here.
+                        fragments, words = LRUCache(self.fragments.max_size), LRUCache(self.words.max_size)
+                        fragments.put_all(state["fragments"])
+                        fragments.put_all(self.fragments.items())
+                        words.put_all(state["words"])
+                        words.put_all(self.words.items())
+                    else:
+                        fragments, words = self.fragments, self.words
+                    self._write({
+                        "version": G2P_CACHE_VERSION,
+                        "misaki": MISAKI_VERSION,
+                        "fragments": fragments.items(),
+                        "words": words.items(),
+                    })
+            except OSError:
+                LOG.exception("Failed to save G2P cache to %s.", self.path)
+                return
+        LOG.info("Saved G2P cache to %s: %s.", self.path, self.stats())
+
+    def _write(self, state: dict):
+        # The replace makes sure the file is never read partially written.
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def _read(self) -> Optional[dict]:
+        """Reads the persisted cache, None if there is none or it can't be used."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+        except Exception:
+            LOG.exception("Failed to load G2P cache from %s, ignoring it.", self.path)
+            return None
+        if state.get("version") != G2P_CACHE_VERSION or state.get("misaki") != MISAKI_VERSION:
+            LOG.warning("Ignoring G2P cache %s of version %s written with misaki %s.", self.path, state.get("version"),
+                        state.get("misaki"))
+            return None
+        return state
+
+    def _load(self):
+        if not self.path:
+            return
+        state = self._read()
+        if state is None:
+            return
+
+        self.fragments.put_all(state["fragments"])
+        self.words.put_all(state["words"])
+        LOG.info("Loaded G2P cache from %s: %s fragments, %s words.", self.path, len(state["fragments"]),
+                 len(state["words"]))
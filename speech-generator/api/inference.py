@@ -0,0 +1,194 @@
+import math
+from dataclasses import dataclass
+from typing import List
+
+import torch
+from kokoro import KModel, KPipeline
+from misaki.token import MToken
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+from api import get_logger
+
+LOG = get_logger(__name__)
+
+# Maximum number of phonemes the model narrates in a single forward pass, excluding the boundary tokens.
+PHONEME_BUDGET = 510
+# Tokens ending a sentence, preferred as chunk boundaries.
+SENTENCE_ENDS = {".", "!", "?", "…"}
+# Maximum number of chunks narrated by a single forward pass.
+MAX_BATCH_SIZE = 8
+# Chunks are batched together only if the longest one is at most this much longer than the shortest one, to limit the
+# computation wasted on the padding.
+MAX_LENGTH_RATIO = 1.5
+
+
+@dataclass
+class Chunk:
+    """A piece of text narrated by a single forward pass of the model."""
+    graphemes: str
+    phonemes: str
+    tokens: List[MToken]
+
+
+class BatchedInference:
+    """Narrates chunks of text in batches of chunks with a similar number of phonemes.
+
+    Text encoding and duration prediction run once for the whole batch, with the padding masked out the same way the
+    model masks it internally. Prosody prediction and decoding normalize over the whole length of the audio, so they
+    run per chunk to keep the output identical to the unbatched one.
+    """
+
+    def __init__(self, pipeline: KPipeline, max_batch_size: int = MAX_BATCH_SIZE,
+                 max_length_ratio: float = MAX_LENGTH_RATIO):
+        self.pipeline = pipeline
+        self.model: KModel = pipeline.model
+        self.max_batch_size = max_batch_size
+        self.max_length_ratio = max_length_ratio
+
+    def chunk(self, tokens: List[MToken]) -> List[Chunk]:
+        """Splits the tokens into chunks the same way the pipeline does it."""
+        chunks = []
+        for graphemes, phonemes, chunk_tokens in self.pipeline.en_tokenize(tokens):
+            if not phonemes:
+                continue
+            if len(phonemes) > PHONEME_BUDGET:
+                LOG.warning("Unexpected len(phonemes) > %s: %s, truncating.", PHONEME_BUDGET, len(phonemes))
+                phonemes = phonemes[:PHONEME_BUDGET]
+            chunks.append(Chunk(graphemes=graphemes, phonemes=phonemes, tokens=chunk_tokens))
+        return chunks
+
+    def pack(self, fragment_tokens: List[List[MToken]], budget: int = PHONEME_BUDGET) -> List[Chunk]:
+        """Packs whole fragments into chunks within the phoneme budget of the model.
+
+        The pipeline fills chunks greedily and splits wherever the budget runs out, leaving a short last chunk and
+        chunk boundaries in the middle of fragments. Here the fragments are spread evenly over the least number of
+        chunks, preferring to end chunks at the end of a sentence. Only a fragment exceeding the budget on its own is
+        split, the same way the pipeline does it.
+        """
+        sizes = [self._phoneme_count(tokens) for tokens in fragment_tokens]
+        total = sum(min(size, budget) for size in sizes)
+        if total == 0:
+            return []
+        target = total / math.ceil(total / budget)
+
+        chunks = []
+        current: List[MToken] = []
+        current_size = 0
+        for tokens, size in zip(fragment_tokens, sizes):
+            if size > budget:
+                chunks.extend(self._to_chunks(current))
+                chunks.extend(self.chunk(tokens))
+                current, current_size = [], 0
+                continue
+
+            if current and (current_size + 1 + size > budget or
+                            current_size >= target and current[-1].text in SENTENCE_ENDS):
+                chunks.extend(self._to_chunks(current))
+                current, current_size = [], 0
+            if current:
+                # Keep the fragments apart, the last token of a fragment may have no trailing whitespace.
+                current[-1].whitespace = current[-1].whitespace or " "
+                current_size += 1
+            current.extend(tokens)
+            current_size += size
+        chunks.extend(self._to_chunks(current))
+        return chunks
+
+    @staticmethod
+    def _phoneme_count(tokens: List[MToken]) -> int:
+        for t in tokens:
+            if t.phonemes is None:
+                t.phonemes = ""
+        return len(KPipeline.tokens_to_ps(tokens).strip())
+
+    @staticmethod
+    def _to_chunks(tokens: List[MToken]) -> List[Chunk]:
+        phonemes = KPipeline.tokens_to_ps(tokens).strip()
+        if not phonemes:
+            return []
+        return [Chunk(graphemes=KPipeline.tokens_to_text(tokens).strip(), phonemes=phonemes, tokens=tokens)]
+
+    def infer(self, chunks: List[Chunk], voice: str, speed: float = 1) -> List[KPipeline.Result]:
+        """Narrates the chunks and returns the results in the order of the chunks."""
+        pack = self.pipeline.load_voice(voice).to(self.model.device)
+        input_ids = [self._input_ids(chunk.phonemes) for chunk in chunks]
+
+        outputs: List[KModel.Output | None] = [None] * len(chunks)
+        for group in self._group(input_ids):
+            LOG.debug("Narrating a batch of %s chunks with %s to %s phonemes.", len(group),
+                      len(input_ids[group[0]]), len(input_ids[group[-1]]))
+            if len(group) == 1:
+                index = group[0]
+                outputs[index] = self.model(chunks[index].phonemes, pack[len(chunks[index].phonemes) - 1], speed,
+                                            return_output=True)
+                continue
+
+            ref_s = torch.cat([pack[len(chunks[i].phonemes) - 1] for i in group])
+            for index, output in zip(group, self._forward([input_ids[i] for i in group], ref_s, speed)):
+                outputs[index] = output
+
+        results = []
+        for chunk, output in zip(chunks, outputs):
+            KPipeline.join_timestamps(chunk.tokens, output.pred_dur)
+            results.append(KPipeline.Result(graphemes=chunk.graphemes, phonemes=chunk.phonemes, tokens=chunk.tokens,
+                                            output=output))
+        return results
+
+    def _input_ids(self, phonemes: str) -> List[int]:
+        ids = [i for i in map(self.model.vocab.get, phonemes) if i is not None]
+        return [0, *ids, 0]
+
+    def _group(self, input_ids: List[List[int]]) -> List[List[int]]:
+        """Groups indexes of the inputs into batches, shortest first."""
+        groups = []
+        for index in sorted(range(len(input_ids)), key=lambda i: len(input_ids[i])):
+            if groups and len(groups[-1]) < self.max_batch_size and \
+                    len(input_ids[index]) <= len(input_ids[groups[-1][0]]) * self.max_length_ratio:
+                groups[-1].append(index)
+            else:
+                groups.append([index])
+        return groups
+
+    @torch.no_grad()
+    def _forward(self, input_ids: List[List[int]], ref_s: torch.Tensor, speed: float) -> List[KModel.Output]:
+        """Same as KModel.forward_with_tokens, but for a batch of inputs of different lengths."""
+        model = self.model
+        device = model.device
+
+        lengths = torch.tensor([len(ids) for ids in input_ids], dtype=torch.long)
+        max_length = int(lengths.max())
+        padded_ids = torch.zeros((len(input_ids), max_length), dtype=torch.long)
+        for row, ids in enumerate(input_ids):
+            padded_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        padded_ids = padded_ids.to(device)
+        ref_s = ref_s.to(device)
+
+        text_mask = torch.arange(max_length).unsqueeze(0).expand(len(input_ids), -1)
+        text_mask = torch.gt(text_mask + 1, lengths.unsqueeze(1)).to(device)
+
+        bert_dur = model.bert(padded_ids, attention_mask=(~text_mask).int())
+        d_en = model.bert_encoder(bert_dur).transpose(-1, -2)
+        s = ref_s[:, 128:]
+        d = model.predictor.text_encoder(d_en, s, lengths, text_mask)
+        # The model runs the LSTM on the whole input, packing makes it skip the padding of the shorter inputs.
+        x = pack_padded_sequence(d, lengths, batch_first=True, enforce_sorted=False)
+        x, _ = model.predictor.lstm(x)
+        x, _ = pad_packed_sequence(x, batch_first=True, total_length=max_length)
+        duration = model.predictor.duration_proj(x)
+        duration = torch.sigmoid(duration).sum(axis=-1) / speed
+        t_en = model.text_encoder(padded_ids, lengths, text_mask)
+
+        outputs = []
+        for row, length in enumerate(lengths.tolist()):
+            pred_dur = torch.round(duration[row, :length]).clamp(min=1).long()
+            indices = torch.repeat_interleave(torch.arange(length, device=device), pred_dur)
+            pred_aln_trg = torch.zeros((length, indices.shape[0]), device=device)
+            pred_aln_trg[indices, torch.arange(indices.shape[0])] = 1
+            pred_aln_trg = pred_aln_trg.unsqueeze(0)
+
+            en = d[row:row + 1, :length].transpose(-1, -2) @ pred_aln_trg
+            f0_pred, n_pred = model.predictor.F0Ntrain(en, s[row:row + 1])
+            asr = t_en[row:row + 1, :, :length] @ pred_aln_trg
+            audio = model.decoder(asr, f0_pred, n_pred, ref_s[row:row + 1, :128]).squeeze()
+            outputs.append(KModel.Output(audio=audio, pred_dur=pred_dur))
+        return outputs
@@ -1,6 +1,10 @@
+import time
 from collections import deque
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
 from logging import DEBUG
+from queue import Queue
+from threading import Thread
 
 import av
 import boto3
@@ -12,9 +16,11 @@ from datetime import datetime, UTC
 from io import BytesIO
 from kokoro import KModel, KPipeline
 from misaki.token import MToken
-from typing import Annotated, Tuple, List
+from typing import Annotated, Tuple, List, Union, Deque
 
 from api import get_logger
+from api.g2p import MemoizedG2P
+from api.inference import BatchedInference, Chunk, MAX_BATCH_SIZE
 from common_lib import RMQClientDep
 from common_lib.models import rmq
 from common_lib.models.tts import FragmentGroups, TextFragment, PauseFragment, FragmentDuration, \
@@ -23,17 +29,71 @@ from common_lib.service import Service
 
 LOG = get_logger(__name__)
 
+# Number of batches phonemized ahead of the one being narrated.
+G2P_LOOKAHEAD = 4
+# Number of narrated tracks waiting to be encoded and uploaded, before narration of the next one is held back.
+FINISH_QUEUE_SIZE = 1
+# Maximum time to wait on shutdown for the narrated tracks to be uploaded.
+DRAIN_TIMEOUT_SEC = 25
+
+
 @dataclass
 class TokenizedFragment:
     fragment: TextFragment
     tokens: List[MToken]
 
 
+@dataclass
+class TokenizedBatch:
+    fragments: List[TokenizedFragment]
+    tokens: List[MToken]
+
+
+@dataclass
+class PendingBatch:
+    """A batch of fragments waiting for its chunks to be narrated together with the chunks of the next batches."""
+    batch: TokenizedBatch
+    chunks: List[Chunk]
+
+
+@dataclass
+class StageTimings:
+    """Time spent by a track in each stage of the pipeline, in seconds."""
+    g2p: float = 0
+    # Time the inference waited for the phonemes, i.e. the part of G2P not overlapped with the inference.
+    g2p_wait: float = 0
+    inference: float = 0
+    encode: float = 0
+    upload: float = 0
+    started: float = field(default_factory=time.perf_counter)
+
+
+@dataclass
+class FinishJob:
+    payload: rmq.NarrateRequest
+    audio_np: np.ndarray
+    timeline: List[FragmentDuration]
+    timings: StageTimings
+    # Time the track occupied the worker, until it was handed over for encoding and upload.
+    narration_time_s: float
+    # Completed once the response is published, the request message is acknowledged only then.
+    done: Future = field(default_factory=Future)
+
+
+def load_speech_model(lang_code: str = "a", model: KModel = None) -> Tuple[KModel, KPipeline]:
+    """Loads the model, unless it's already loaded, and creates the pipeline narrating with it."""
+    model = model or KModel().eval()
+    return model, KPipeline(lang_code, model=model, repo_id="hexgrad/Kokoro-82M")
+
+
 class SpeechGenService(Service):
-    def __init__(self, rmq_client: RMQClientDep, lang_code: str = "a"):
+    def __init__(self, rmq_client: RMQClientDep, lang_code: str = "a",
+                 speech_model: Tuple[KModel, KPipeline] = None):
         self.rmq_client = rmq_client
-        self.model = KModel()
-        self.speech_pipeline = KPipeline(lang_code, model=self.model, repo_id="hexgrad/Kokoro-82M")
+        # The model can be loaded beforehand to be shared by several worker replicas.
+        self.model, self.speech_pipeline = speech_model or load_speech_model(lang_code)
+        self.inference = BatchedInference(self.speech_pipeline)
+        self.g2p = MemoizedG2P(self.speech_pipeline, lang_code)
 
         self.s3_client = boto3.client(
             "s3",
@@ -46,15 +106,65 @@ class SpeechGenService(Service):
         # Kokoro generates audio at 24kHz
         self.sample_rate = 24000
 
-    def handle_narrate_msg(self, payload: rmq.NarrateRequest):
-        start_time = datetime.now(UTC)
+        # The stages are pipelined: G2P of the next batches runs while the current one is narrated, and the previous
+        # track is encoded and uploaded while the next one is narrated.
+        self.g2p_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="g2p")
+        self.finish_queue: Queue[FinishJob] = Queue(maxsize=FINISH_QUEUE_SIZE)
+        self.finish_thread = Thread(name="finish-track", target=self._finish_tracks, daemon=True)
+        self.finish_thread.start()
+
+    def handle_narrate_msg(self, payload: rmq.NarrateRequest) -> Future:
+        """Narrates the track and hands it over for encoding and upload, so the next track can be narrated meanwhile.
+
+        Returns a future completed once the response is published, so the message is acknowledged only then and is
+        redelivered right away if the upload fails.
+        """
+        timings = StageTimings()
         LOG.debug("Processing narration request %s.", payload.queue_id)
-        base_key = f"{payload.book_id}/audio-files/{payload.tts_model}/{payload.voice}/{payload.track_base_name}"
 
+        audio_np, timeline = self._narrate_track(payload.fragments, payload.voice, timings)
+
+        narration_time_s = time.perf_counter() - timings.started
+        job = FinishJob(payload=payload, audio_np=audio_np, timeline=timeline, timings=timings,
+                        narration_time_s=narration_time_s)
+        # Blocks while the previous track is still being encoded and uploaded, bounding the memory used.
+        self.finish_queue.put(job)
+        return job.done
+
+    def _finish_tracks(self):
+        while True:
+            job = self.finish_queue.get()
+            try:
+                self._finish_track(job)
+                job.done.set_result(None)
+            except Exception as e:
+                LOG.exception("Failed to finish narration request %s.", job.payload.queue_id)
+                job.done.set_exception(e)
+            finally:
+                self.finish_queue.task_done()
+
+    def drain(self, timeout: float = DRAIN_TIMEOUT_SEC):
+        """Waits until the narrated tracks are uploaded, so their messages are acknowledged before shutdown."""
+        deadline = time.monotonic() + timeout
+        with self.finish_queue.all_tasks_done:
+            while self.finish_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    LOG.warning("%s narrated tracks are not uploaded before shutdown, they will be redelivered.",
+                                self.finish_queue.unfinished_tasks)
+                    return
+                self.finish_queue.all_tasks_done.wait(remaining)
+
+    def _finish_track(self, job: FinishJob):
+        payload, timings = job.payload, job.timings
+        base_key = f"{payload.book_id}/audio-files/{payload.tts_model}/{payload.voice}/{payload.track_base_name}"
         audio_key = f"{base_key}.aac"
 
-        audio_np, timeline = self._narrate_track(payload.fragments, payload.voice)
-        audio_bytes, duration_s = self._encode_audio(audio_np)
+        stage_start = time.perf_counter()
+        audio_bytes, duration_s = self._encode_audio(job.audio_np)
+        timings.encode = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
         self._upload_file(audio_key, "audio/aac", audio_bytes.getvalue())
 
         track_manifest_key = f"{base_key}.json"
@@ -62,20 +172,31 @@ class SpeechGenService(Service):
             audio_key=audio_key,
             size_bytes=len(audio_bytes.getvalue()),
             track_name=payload.track_base_name,
-            timeline=timeline,
+            timeline=job.timeline,
         )
         self._upload_file(track_manifest_key, "application/json", manifest.model_dump_json().encode())
+        timings.upload = time.perf_counter() - stage_start
 
-        end_time = datetime.now(UTC)
-        narration_time_s = (end_time - start_time).total_seconds()
         response_payload = rmq.NarrateResponse(
             queue_id=payload.queue_id,
             completed=datetime.now(UTC),
-            narration_time_s=narration_time_s,
+            narration_time_s=job.narration_time_s,
             duration_s=duration_s,
-            size_bytes=len(audio_bytes.getvalue())
+            size_bytes=len(audio_bytes.getvalue()),
+            timeline=job.timeline,
+            worker=os.getenv("HOSTNAME"),
+            processing_s=time.perf_counter() - timings.started
         )
         self.rmq_client.publish(routing_key="narrate-response", payload=response_payload)
+        self.g2p.save_if_due()
+
+        LOG.info("Narrated track %s (%.1fs of audio) in %.1fs, real-time factor %.3f. Stages: g2p %.2fs "
+                 "(not overlapped %.2fs, cache hit rate %.2f), inference %.2fs, encode %.2fs, upload %.2fs, "
+                 "total %.2fs.",
+                 payload.track_base_name, duration_s, job.narration_time_s,
+                 job.narration_time_s / duration_s if duration_s else 0,
+                 timings.g2p, timings.g2p_wait, self.g2p.fragments.stats().hit_rate, timings.inference,
+                 timings.encode, timings.upload, time.perf_counter() - timings.started)
 
     def _encode_audio(self, audio_np: np.ndarray) -> Tuple[BytesIO, float]:
         output = io.BytesIO()
@@ -99,49 +220,102 @@ class SpeechGenService(Service):
 
         return output, float(total_duration_pts * stream.time_base)
 
-    def _narrate_track(self, fragment_groups: FragmentGroups, voice: str) -> Tuple[
-        np.ndarray, List[FragmentDuration]]:
+    def _narrate_track(self, fragment_groups: FragmentGroups, voice: str,
+                       stage_timings: StageTimings = None) -> Tuple[np.ndarray, List[FragmentDuration]]:
+        stage_timings = stage_timings or StageTimings()
+        segments = self._split_into_batches(fragment_groups)
+
+        # G2P of the next batches is running while the current one is narrated.
+        pending_batches = [s for s in segments if not isinstance(s, PauseFragment)]
+        tokenized_batches: Deque[Future[Tuple[TokenizedBatch, float]]] = deque()
+
+        def submit_g2p():
+            while pending_batches and len(tokenized_batches) < G2P_LOOKAHEAD:
+                tokenized_batches.append(self.g2p_executor.submit(self._timed_tokenize, pending_batches.pop(0)))
+
+        # Chunks of consecutive batches are narrated together, so the inference can batch them. Chunks of other tracks
+        # are not, a track isn't held back by another one (see "Batched inference" in the README).
+        parts: List[Union[PauseFragment, Tuple[np.ndarray, List[FragmentDuration]]]] = []
+        window: List[Tuple[int, PendingBatch]] = []
+
+        def narrate_window():
+            inference_start = time.perf_counter()
+            results = self.inference.infer([c for _, pending in window for c in pending.chunks], voice)
+            stage_timings.inference += time.perf_counter() - inference_start
+            offset = 0
+            for part_index, pending in window:
+                parts[part_index] = self._assemble(pending.batch, results[offset:offset + len(pending.chunks)])
+                offset += len(pending.chunks)
+            window.clear()
+
+        for segment in segments:
+            if isinstance(segment, PauseFragment):
+                parts.append(segment)
+                continue
+
+            submit_g2p()
+            wait_start = time.perf_counter()
+            batch, g2p_s = tokenized_batches.popleft().result()
+            stage_timings.g2p_wait += time.perf_counter() - wait_start
+            stage_timings.g2p += g2p_s
+            submit_g2p()
+
+            window.append((len(parts), PendingBatch(batch=batch, chunks=self._pack(batch))))
+            parts.append(None)
+            if sum(len(pending.chunks) for _, pending in window) >= MAX_BATCH_SIZE:
+                narrate_window()
+        if window:
+            narrate_window()
 
         audio_np = None
         timings: List[FragmentDuration] = []
+        for part in parts:
+            if isinstance(part, PauseFragment):
+                part_audio_np = self._silence(part.duration)
+                timings.append(FragmentDuration(id=part.id, duration=part.duration))
+            else:
+                part_audio_np, part_timings = part
+                timings.extend(part_timings)
+            audio_np = part_audio_np if audio_np is None else np.concatenate((audio_np, part_audio_np), axis=0)
 
+        # noinspection PyTypeChecker
+        return audio_np, timings
+
+    @staticmethod
+    def _split_into_batches(fragment_groups: FragmentGroups) -> List[Union[List[TextFragment], PauseFragment]]:
+        """Splits the fragments into batches of text fragments narrated together, separated by the pauses."""
+        segments = []
         batch = []
         for frag in fragment_groups.flatten():
             if isinstance(frag, TextFragment):
                 batch.append(frag)
             elif isinstance(frag, PauseFragment):
-                if len(batch) > 0:
-                    batch_audio_np, batch_timings = self._narrate_fragments(batch, voice)
-                    audio_np = batch_audio_np if audio_np is None else np.concatenate((audio_np, batch_audio_np), axis=0)
-                    timings.extend(batch_timings)
-
-                # Add the pause
-                pause = self._silence(frag.duration)
-                audio_np = pause if audio_np is None else np.concatenate((audio_np, pause), axis=0)
-                timings.append(FragmentDuration(id=frag.id, duration=frag.duration))
-
+                if batch:
+                    segments.append(batch)
+                segments.append(frag)
                 # Restart the batch
                 batch = []
-
-        if len(batch) > 0:
-            # narrate the batch
-            batch_audio_np, batch_timings = self._narrate_fragments(batch, voice)
-            audio_np = batch_audio_np if audio_np is None else np.concatenate((audio_np, batch_audio_np), axis=0)
-            timings.extend(batch_timings)
-
-        # noinspection PyTypeChecker
-        return audio_np, timings
+        if batch:
+            segments.append(batch)
+        return segments
 
     def _silence(self, duration_s: float):
         return np.zeros(int(duration_s * self.sample_rate), dtype=np.int16)
 
     def _narrate_fragments(self, fragments: List[TextFragment], voice: str) -> Tuple[np.ndarray, List[FragmentDuration]]:
-        audio_np = None
+        return self._synthesize(self._tokenize(fragments), voice)
+
+    def _timed_tokenize(self, fragments: List[TextFragment]) -> Tuple[TokenizedBatch, float]:
+        start = time.perf_counter()
+        batch = self._tokenize(fragments)
+        return batch, time.perf_counter() - start
+
+    def _tokenize(self, fragments: List[TextFragment]) -> TokenizedBatch:
         tokenized_fragments: List[TokenizedFragment] = []
 
         all_tokens = []
         for fragment in fragments:
-            _, tokens = self.speech_pipeline.g2p(fragment.text)
+            tokens = self.g2p(fragment.text)
             if not tokens:
                 LOG.warning("No tokens generated for fragment '%s'.", fragment)
             all_tokens.extend(tokens)
@@ -151,17 +325,22 @@ class SpeechGenService(Service):
                     tokens=tokens
                 )
             )
+        return TokenizedBatch(fragments=tokenized_fragments, tokens=all_tokens)
+
+    def _synthesize(self, batch: TokenizedBatch, voice: str) -> Tuple[np.ndarray, List[FragmentDuration]]:
+        return self._assemble(batch, self.inference.infer(self._pack(batch), voice))
 
-        results: List[KPipeline.Result] = []
-        tokens_processed = 0
-        for result in self.speech_pipeline.generate_from_tokens(all_tokens, voice):
+    def _pack(self, batch: TokenizedBatch) -> List[Chunk]:
+        return self.inference.pack([f.tokens for f in batch.fragments])
+
+    def _assemble(self, batch: TokenizedBatch, results: List[KPipeline.Result]) -> Tuple[
+        np.ndarray, List[FragmentDuration]]:
+        """Joins the audio of the narrated chunks of the batch and calculates its timeline."""
+        audio_np = None
+        for result in results:
             if result.tokens is None:
                 raise RuntimeError(f"No tokens available in the result.")
 
-            results.append(result)
-
-            tokens_processed += len(result.tokens)
-            LOG.info("Batch progress: %.1f%%", tokens_processed/len(all_tokens)*100)
             # if LOG.isEnabledFor(DEBUG):
             #     LOG.debug(result.graphemes)
             #     for t in result.tokens:
@@ -181,7 +360,7 @@ class SpeechGenService(Service):
         duration_s = audio_np.size / self.sample_rate
         LOG.debug("Total duration seconds: %s", duration_s)
 
-        return audio_np, self._calculate_timeline(tokenized_fragments, results)
+        return audio_np, self._calculate_timeline(batch.fragments, results)
 
     def _fix_token_times(self, result: KPipeline.Result):
         if result.tokens is None:
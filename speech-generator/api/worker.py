@@ -0,0 +1,153 @@
+import os
+import signal
+from multiprocessing.process import BaseProcess
+from threading import Event, Thread
+from typing import List, Optional, Tuple
+
+import torch
+import torch.multiprocessing
+from kokoro import KModel, KPipeline
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.exchange_type import ExchangeType
+
+from api import get_logger
+from api.speechgen import SpeechGenService, load_speech_model
+from common_lib import RMQClient
+from common_lib.models import rmq
+from common_lib.rmq import Topology
+
+LOG = get_logger(__name__)
+
+EXCHANGE = "narrator"
+# Number of worker processes narrating in parallel. All of them share the model weights loaded once by the parent.
+SPEECH_REPLICAS = int(os.getenv("SPEECH_REPLICAS", 1))
+# Torch intra-op threads per replica, the available CPUs are split evenly between the replicas by default.
+SPEECH_THREADS_PER_REPLICA = int(os.getenv("SPEECH_THREADS_PER_REPLICA", 0))
+# Narration requests delivered at a time, so the next track is narrated while the previous one is uploaded.
+NARRATION_PREFETCH = 2
+# Delay before a replica that died is started again.
+REPLICA_RESTART_DELAY_SEC = 5
+
+
+def start_speech_worker(speech_model: Tuple[KModel, KPipeline] = None) -> RMQClient:
+    """Creates the speech generation service and starts consuming narration requests in the current process."""
+    rmq_client = RMQClient(EXCHANGE, prefetch_count=NARRATION_PREFETCH)
+    speech_gen_svc = SpeechGenService(rmq_client, speech_model=speech_model)
+
+    # Configure topology.
+    def configure(channel: BlockingChannel):
+        channel.exchange_declare(EXCHANGE, ExchangeType.topic, durable=True)
+        channel.queue_declare(Topology.narration_queue, durable=True, arguments={"x-queue-type": "quorum"})
+        channel.queue_bind(Topology.narration_queue, EXCHANGE, "narrate")
+
+    rmq_client.configure(configure)
+
+    # Configure message handlers and start consuming.
+    rmq_client.set_queue_message_handler(Topology.narration_queue,
+                                         rmq.NarrateRequest,
+                                         speech_gen_svc.handle_narrate_msg)
+    rmq_client.start_consuming()
+    return rmq_client
+
+
+def stop_speech_worker(rmq_client: RMQClient):
+    """Finishes uploading the narrated tracks before closing the connection, so their messages are acknowledged."""
+    speech_gen_svc: SpeechGenService = SpeechGenService.instance
+    speech_gen_svc.drain()
+    rmq_client.close()
+    speech_gen_svc.g2p.save()
+
+
+def _available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ReplicaSupervisor:
+    """Loads the speech model once and starts the worker replicas sharing it.
+
+    The weights are moved to shared memory and passed to the replicas as handles to it, so the replicas never copy
+    them. Replicas are spawned rather than forked, forking a process running torch threads, or forking from the
+    watchdog thread, leaves the child with locks held by threads it doesn't have. Each replica has its own RMQ consumer
+    and a pinned number of torch threads, bound to its own CPUs when there are enough of them, so the replicas don't
+    contend on the same cores. Replicas that die are started again.
+    """
+
+    def __init__(self, replicas: int, threads_per_replica: int = 0):
+        self.replicas = replicas
+        cpus = _available_cpus()
+        self.threads_per_replica = threads_per_replica or max(1, len(cpus) // replicas)
+        if self.threads_per_replica * replicas <= len(cpus):
+            self.cpu_sets: List[Optional[List[int]]] = [
+                cpus[i * self.threads_per_replica:(i + 1) * self.threads_per_replica] for i in range(replicas)
+            ]
+        else:
+            LOG.warning("%s replicas with %s threads each oversubscribe %s CPUs, replicas are not pinned to CPUs.",
+                        replicas, self.threads_per_replica, len(cpus))
+            self.cpu_sets = [None] * replicas
+
+        self._context = torch.multiprocessing.get_context("spawn")
+        self._processes: List[Optional[BaseProcess]] = [None] * replicas
+        self._model: Optional[KModel] = None
+        self._close = Event()
+        self._watchdog_thread = Thread(name="replica-watchdog", target=self._watchdog, daemon=True)
+
+    def start(self):
+        LOG.info("Loading speech model for %s replicas with %s threads each...", self.replicas,
+                 self.threads_per_replica)
+        # Only the model is shared, every replica creates its own pipeline around it.
+        model, _ = load_speech_model()
+        self._model = model.share_memory()
+
+        for index in range(self.replicas):
+            self._start_replica(index)
+        self._watchdog_thread.start()
+
+    def alive(self) -> int:
+        return sum(1 for p in self._processes if p is not None and p.is_alive())
+
+    def _start_replica(self, index: int):
+        process = self._context.Process(name=f"speech-replica-{index}", target=_run_replica, daemon=True,
+                                        args=(index, self.threads_per_replica, self.cpu_sets[index],
+                                              self._model))
+        process.start()
+        LOG.info("Started speech replica %s (pid %s) on CPUs %s.", index, process.pid, self.cpu_sets[index] or "any")
+        self._processes[index] = process
+
+    def _watchdog(self):
+        while not self._close.wait(REPLICA_RESTART_DELAY_SEC):
+            for index, process in enumerate(self._processes):
+                if not process.is_alive() and not self._close.is_set():
+                    LOG.warning("Speech replica %s exited with code %s, restarting it.", index, process.exitcode)
+                    self._start_replica(index)
+
+    def stop(self):
+        LOG.info("Stopping speech replicas...")
+        self._close.set()
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=REPLICA_RESTART_DELAY_SEC)
+
+
+def _run_replica(index: int, threads: int, cpus: Optional[List[int]], model: KModel):
+    stop = Event()
+    # Stopped by the supervisor with SIGTERM, SIGINT is sent to the whole process group on Ctrl+C.
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        LOG.warning("Torch inter-op thread pool of replica %s is already started, keeping its size.", index)
+
+    rmq_client = start_speech_worker(load_speech_model(model=model))
+    LOG.info("Speech replica %s is consuming with %s torch threads.", index, threads)
+    stop.wait()
+    stop_speech_worker(rmq_client)
@@ -0,0 +1,138 @@
+"""Compares splitting of the text into chunks narrated by a single forward pass of the model.
+
+The "pipeline" strategy is the Kokoro pipeline splitting the whole token stream greedily at its phoneme limit, the
+"packed" one packs whole fragments evenly within the phoneme budget. Tracks are taken from narration manifests of
+ingested books. With --narrate, every chunk is also narrated one at a time to measure the real-time factor, and the
+packed chunks are narrated in batches too, the way the worker does it, to measure the gain of the batched inference.
+
+Usage:
+    python -m scripts.benchmark_chunking narration-manifest.json [...] [--tracks N] [--narrate] [--output results.json]
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional, Dict, Callable
+
+from api.inference import BatchedInference, Chunk, PHONEME_BUDGET, MAX_BATCH_SIZE
+from api.speechgen import SpeechGenService, load_speech_model
+from common_lib.models.tts import FragmentGroups, TextFragment
+
+LOG = logging.getLogger(__name__)
+
+SAMPLE_RATE = 24000
+# Chunks shorter than this are considered short, they narrate a few words only.
+SHORT_CHUNK_PHONEMES = 100
+
+
+def load_tracks(manifests: List[Path], limit: int) -> List[FragmentGroups]:
+    tracks = []
+    for manifest in manifests:
+        for content_file in json.loads(manifest.read_text()):
+            for nav_item in content_file["navigation_items"]:
+                for track in nav_item["audio_tracks"]:
+                    tracks.append(FragmentGroups.model_validate(track["fragment_groups"]))
+                    if len(tracks) == limit:
+                        return tracks
+    return tracks
+
+
+def measure(inference: BatchedInference, tracks: List[FragmentGroups], voice: str, narrate: bool,
+            split: Callable[[List[list]], List[Chunk]]) -> Dict[str, float]:
+    chunk_sizes = []
+    split_fragments = 0
+    narration_s = 0
+    audio_s = 0
+    # Chunks of consecutive batches are narrated together, the same way the worker does it.
+    window: List[Chunk] = []
+
+    def narrate_window():
+        nonlocal narration_s, audio_s
+        start = time.perf_counter()
+        results = inference.infer(window, voice)
+        narration_s += time.perf_counter() - start
+        audio_s += sum(r.audio.numpy().size for r in results) / SAMPLE_RATE
+        window.clear()
+
+    for track in tracks:
+        for batch in SpeechGenService._split_into_batches(track):
+            if not isinstance(batch, list):
+                continue
+            fragment_tokens = [inference.pipeline.g2p(f.text)[1] for f in batch if isinstance(f, TextFragment)]
+            first_tokens = {id(tokens[0]) for tokens in fragment_tokens if tokens}
+
+            chunks = split(fragment_tokens)
+            chunk_sizes.extend(len(c.phonemes) for c in chunks)
+            # A chunk not starting with the first token of a fragment splits the fragment across two forward passes.
+            split_fragments += sum(1 for c in chunks[1:] if id(c.tokens[0]) not in first_tokens)
+
+            if narrate:
+                window.extend(chunks)
+                if len(window) >= MAX_BATCH_SIZE:
+                    narrate_window()
+        if window:
+            narrate_window()
+
+    passes = len(chunk_sizes)
+    result = {
+        "forward_passes": passes,
+        "mean_phonemes": sum(chunk_sizes) / passes if passes else 0,
+        "fill": sum(chunk_sizes) / (passes * PHONEME_BUDGET) if passes else 0,
+        "short_chunks": sum(1 for size in chunk_sizes if size < SHORT_CHUNK_PHONEMES),
+        "split_fragments": split_fragments,
+    }
+    if narrate:
+        result.update({"narration_s": narration_s, "audio_s": audio_s, "rtf": narration_s / audio_s if audio_s else 0})
+    return result
+
+
+def run(manifests: List[Path], limit: int, voice: str, narrate: bool) -> dict:
+    tracks = load_tracks(manifests, limit)
+    LOG.info("Benchmarking chunking of %s tracks...", len(tracks))
+    model, pipeline = load_speech_model()
+    # Chunks are narrated one at a time, so only the chunking differs between the strategies.
+    inference = BatchedInference(pipeline, max_batch_size=1)
+
+    strategies = {
+        "pipeline": lambda fragment_tokens: inference.chunk([t for tokens in fragment_tokens for t in tokens]),
+        "packed": inference.pack,
+    }
+    results = {name: measure(inference, tracks, voice, narrate, split) for name, split in strategies.items()}
+    if not narrate:
+        return {"tracks": len(tracks), "strategies": results}
+
+    # The same chunks narrated in batches, so only the inference differs from "packed".
+    batched_inference = BatchedInference(pipeline)
+    results["packed_batched"] = measure(batched_inference, tracks, voice, narrate, batched_inference.pack)
+    batched_rtf = results["packed_batched"]["rtf"]
+    return {
+        "tracks": len(tracks),
+        "strategies": results,
+        # Above 1 if the batched inference narrates faster than one chunk at a time.
+        "batching_speedup": results["packed"]["rtf"] / batched_rtf if batched_rtf else 0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark of splitting tracks into chunks narrated by the model.")
+    parser.add_argument("manifests", type=Path, nargs="+", help="Narration manifests (narration-manifest.json).")
+    parser.add_argument("--tracks", type=int, default=20, help="Maximum number of tracks to benchmark.")
+    parser.add_argument("--voice", default="am_michael")
+    parser.add_argument("--narrate", action="store_true", help="Narrate the chunks to measure the real-time factor, "
+                                                                      "unbatched and batched.")
+    parser.add_argument("--output", type=Path, help="File to write JSON results to, stdout by default.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    results = json.dumps(run(args.manifests, args.tracks, args.voice, args.narrate), indent=2)
+    if args.output:
+        args.output.write_text(results)
+    else:
+        print(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,38 @@
 import logging
+import uuid
 
+import pytest
+import torch
+
+from api.g2p import MemoizedG2P
+from api.inference import BatchedInference
 from api.speechgen import SpeechGenService
-from common_lib.models.tts import TextFragment
+from common_lib.models import rmq
+from common_lib.models.tts import TextFragment, FragmentGroups
 
 LOG = logging.getLogger(__name__)
 
 speechgen = SpeechGenService(None)
 
 
+class StubRMQClient:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, routing_key, payload):
+        self.published.append((routing_key, payload))
+
+
+def narrate_request(queue_id: int) -> rmq.NarrateRequest:
+    fragment_groups = FragmentGroups.model_validate([[
+        {"id": 1, "type": "text", "text": "The Borant Corporation retains all rights to broadcast."},
+        {"id": 2, "type": "pause", "duration": 0.5},
+        {"id": 3, "type": "text", "text": "Exploit, and otherwise control the World Dungeon."},
+    ]])
+    return rmq.NarrateRequest(queue_id=queue_id, book_id=uuid.uuid4(), tts_model="kokoro", voice="am_michael",
+                              track_base_name="1-3", order=0, fragments=fragment_groups)
+
+
 class TestSpeechGenService:
     def test_fragments(self, project_dist_path):
         fragments = [
@@ -26,3 +51,98 @@ class TestSpeechGenService:
         LOG.info("AAC duration: %s", aac_duration)
         with open(project_dist_path / "test_fragments.aac", "wb") as f:
             f.write(audio_bytes.getvalue())
+
+    def test_batched_inference(self):
+        texts = [
+            "Per the Mined Material Reclamation act along with subsection 35 of the Indigenous Planetary Species "
+            "Protection Act, any surviving humans will be given the opportunity to reclaim their lost matter.",
+            "The Borant Corporation retains all rights to broadcast.",
+            "Exploit, and otherwise control all aspects of the World Dungeon.",
+        ]
+
+        def chunks():
+            return [c for text in texts for c in speechgen.inference.chunk(speechgen.speech_pipeline.g2p(text)[1])]
+
+        batched = BatchedInference(speechgen.speech_pipeline, max_length_ratio=10).infer(chunks(), "am_michael")
+        unbatched = BatchedInference(speechgen.speech_pipeline, max_batch_size=1).infer(chunks(), "am_michael")
+
+        assert len(batched) == len(unbatched) == 3
+        for b, u in zip(batched, unbatched):
+            assert torch.equal(b.output.pred_dur, u.output.pred_dur)
+            assert torch.allclose(b.audio, u.audio, atol=1e-4)
+            assert [(t.start_ts, t.end_ts) for t in b.tokens] == [(t.start_ts, t.end_ts) for t in u.tokens]
+
+    def test_pack(self):
+        texts = ["The Borant Corporation retains all rights to broadcast, exploit, and otherwise control all aspects "
+                 "of the World Dungeon."] * 12
+        fragment_tokens = [speechgen.speech_pipeline.g2p(text)[1] for text in texts]
+        chunks = speechgen.inference.pack(fragment_tokens)
+
+        # 12 fragments of ~100 phonemes fit in 3 chunks, filled evenly.
+        assert len(chunks) == 3
+        assert all(len(c.phonemes) <= 510 for c in chunks)
+        first_tokens = {id(tokens[0]) for tokens in fragment_tokens}
+        assert all(id(c.tokens[0]) in first_tokens for c in chunks)
+        assert sum(len(c.tokens) for c in chunks) == sum(len(tokens) for tokens in fragment_tokens)
+
+    def test_memoized_g2p(self, tmp_path):
+        path = str(tmp_path / "g2p-cache.pkl")
+        g2p = MemoizedG2P(speechgen.speech_pipeline, "a", path=path)
+        text = "Carl looked at Donut, who looked at the Syndicate crawler."
+
+        first = g2p(text)
+        second = g2p(text)
+        assert [t.phonemes for t in first] == [t.phonemes for t in second]
+        assert first[0] is not second[0]
+        assert g2p.stats()["fragments"].hits == 1
+        assert g2p.stats()["fragments"].misses == 1
+
+        g2p.save()
+        restored = MemoizedG2P(speechgen.speech_pipeline, "a", path=path)
+        assert [t.phonemes for t in restored(text)] == [t.phonemes for t in first]
+        assert restored.stats()["fragments"].hits == 1
+
+    def test_memoized_g2p_merges_saved_caches(self, tmp_path):
+        path = str(tmp_path / "g2p-cache.pkl")
+        # Replicas sharing the file save the fragments they narrated, the last one doesn't drop the others.
+        replicas = [MemoizedG2P(speechgen.speech_pipeline, "a", path=path) for _ in range(2)]
+        texts = ["Carl looked at Donut.", "Mordecai sighed."]
+        for replica, text in zip(replicas, texts):
+            replica(text)
+            replica.save()
+
+        restored = MemoizedG2P(speechgen.speech_pipeline, "a", path=path)
+        assert restored.stats()["fragments"].size == 2
+
+    def test_handle_narrate_msg(self, monkeypatch):
+        rmq_client = StubRMQClient()
+        uploads = []
+        monkeypatch.setattr(speechgen, "rmq_client", rmq_client)
+        monkeypatch.setattr(speechgen, "_upload_file", lambda key, content_type, body: uploads.append(key))
+
+        # The second track is narrated while the first one is uploaded, each is done only once published.
+        first = speechgen.handle_narrate_msg(narrate_request(1))
+        second = speechgen.handle_narrate_msg(narrate_request(2))
+        first.result(timeout=60)
+        second.result(timeout=60)
+
+        assert [payload.queue_id for _, payload in rmq_client.published] == [1, 2]
+        assert all(routing_key == "narrate-response" for routing_key, _ in rmq_client.published)
+        assert [t.id for t in rmq_client.published[0][1].timeline] == [1, 2, 3]
+        assert len(uploads) == 4
+
+    def test_handle_narrate_msg_upload_failure(self, monkeypatch):
+        rmq_client = StubRMQClient()
+        monkeypatch.setattr(speechgen, "rmq_client", rmq_client)
+
+        def fail_upload(key, content_type, body):
+            raise RuntimeError("S3 is down")
+
+        monkeypatch.setattr(speechgen, "_upload_file", fail_upload)
+
+        # The failure is reported to the message processor to reject the message, nothing is published.
+        with pytest.raises(RuntimeError):
+            speechgen.handle_narrate_msg(narrate_request(3)).result(timeout=60)
+        speechgen.drain()
+        assert rmq_client.published == []
+
@@ -241,7 +241,9 @@ export class AudioPlayer {
           return this.bookService.updatePlaybackInfo({
             "book_id": bookDetails.id,
             "data": {
-              "progress_seconds": progressSeconds
+              "progress_seconds": progressSeconds,
+              // Lets the narration prioritize the tracks right after the current position.
+              "fragment_id": this.currentFragment$.value?.id
             }
           });
         })
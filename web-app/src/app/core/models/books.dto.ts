@@ -1,4 +1,7 @@
 export enum BookStatus {
+  /** Initial processing of the uploaded book failed. */
+  failed = "failed",
+
   /** Just uploaded book is going through initial processing. */
   processing = "processing",
 
@@ -16,6 +19,7 @@ export enum BookStatus {
 }
 
 const BookStatusRank: Record<BookStatus, number> = {
+  [BookStatus.failed]: 0,
   [BookStatus.processing]: 1,
   [BookStatus.ready_for_toc_review]: 4,
   [BookStatus.queued]: 5,